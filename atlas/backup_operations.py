@@ -8,16 +8,17 @@
 """
 import logging
 import os
+import shutil
+import stat
 
 from datetime import datetime
 from time import time
 
-from atlas import utilities
 from atlas.config import (ENVIRONMENT, INSTANCE_ROOT, WEB_ROOT, CORE_WEB_ROOT_SYMLINKS,
                           NFS_MOUNT_FILES_DIR, NFS_MOUNT_LOCATION, SAML_AUTH,
                           SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD, VARNISH_CONTROL_KEY,
                           SMTP_PASSWORD, WEBSERVER_USER_GROUP, ATLAS_LOCATION, SITE_DOWN_PATH,
-                          SSH_USER, BACKUP_PATH)
+                          SSH_USER, BACKUP_PATH, BACKUP_SNAPSHOT_PATH)
 from atlas.config_servers import (SERVERDEFS, ATLAS_LOGGING_URLS, API_URLS,
                                   VARNISH_CONTROL_TERMINALS, BASE_URLS)
 
@@ -25,6 +26,12 @@ from atlas.config_servers import (SERVERDEFS, ATLAS_LOGGING_URLS, API_URLS,
 log = logging.getLogger('atlas.backup_operations')
 
 
+def _snapshot_remove_error(function, path, exc_info):
+    """Log a path that could not be removed from a snapshot, instead of stopping the removal.
+    """
+    log.error('Backup | Delete | Snapshot | Cannot remove - %s | Error - %s', path, exc_info[1])
+
+
 def backup_delete(item):
     """Remove backup files from servers
 
@@ -34,15 +41,31 @@ def backup_delete(item):
     log.debug('Backup | Delete | Item - %s', item)
     log.info('Backup | Delete | Item - %s ', item['_id'])
 
-    instance = utilities.get_single_eve('sites', item['site'], item['site_version'])
-    pretty_filename = '{0}_{1}'.format(
-        instance['sid'], item['backup_date'].strftime("%Y-%m-%d-%H-%M-%S"))
-    pretty_database_filename = '{0}.sql'.format(pretty_filename)
-    database_path = '{0}/backups/{1}'.format(BACKUP_PATH, pretty_database_filename)
-    pretty_files_filename = '{0}.tar.gz'.format(pretty_filename)
-    files_path = '{0}/backups/{1}'.format(BACKUP_PATH, pretty_files_filename)
-
-    os.remove(files_path)
-    os.remove(database_path)
+    # The record has the file names, whatever format the backup was created in. Pending backups do
+    # not have files yet.
+    if item.get('database'):
+        database_path = '{0}/backups/{1}'.format(BACKUP_PATH, item['database'])
+        if os.path.exists(database_path):
+            os.remove(database_path)
+    if item.get('files') and item.get('files_type') == 'snapshot':
+        # Files in a snapshot are hardlinks shared with the other snapshots for the instance, so
+        # removing it only frees the files that no other snapshot references.
+        snapshot_path = '{0}/{1}'.format(BACKUP_SNAPSHOT_PATH, item['files'])
+        # Read-only directories copied from an instance cannot have their contents removed.
+        for root, directories, files in os.walk(snapshot_path):
+            for directory in directories:
+                path = os.path.join(root, directory)
+                if not os.path.islink(path):
+                    os.chmod(path, os.stat(path).st_mode | stat.S_IWUSR)
+        if os.path.isdir(snapshot_path):
+            os.chmod(snapshot_path, os.stat(snapshot_path).st_mode | stat.S_IWUSR)
+        shutil.rmtree(snapshot_path, onerror=_snapshot_remove_error)
+        site_snapshot_dir = os.path.dirname(snapshot_path)
+        if os.path.isdir(site_snapshot_dir) and not os.listdir(site_snapshot_dir):
+            os.rmdir(site_snapshot_dir)
+    elif item.get('files'):
+        files_path = '{0}/backups/{1}'.format(BACKUP_PATH, item['files'])
+        if os.path.exists(files_path):
+            os.remove(files_path)
 
     log.info('Backup | Delete | Complete | Item - %s', item['_id'])
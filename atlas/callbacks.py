@@ -10,6 +10,7 @@ from flask import abort, g
 from bson import ObjectId
 from celery import chord
 
+from atlas import instance_operations
 from atlas import tasks
 from atlas import utilities
 from atlas.config import (ATLAS_LOCATION, DEFAULT_CORE, DEFAULT_PROFILE, SERVICE_ACCOUNT_USERNAME,
@@ -71,6 +72,15 @@ def pre_patch_sites(request, payload):
     if 'path' in json.loads(request.data) and json.loads(request.data)['path'] in PROTECTED_PATHS:
         log.error('sites | PATCH | Pre patch callback | Protected path')
         abort(409, 'Error: Cannot use this path, it is on the protected list.')
+    # Check the web root index for another instance that owns the path.
+    if 'path' in json.loads(request.data):
+        path = json.loads(request.data)['path']
+        owner = instance_operations.web_root_collision(path)
+        if owner:
+            site = utilities.get_single_eve('sites', payload['_id'])
+            if site['sid'] != owner:
+                log.error('sites | PATCH | Pre patch callback | Path - %s | Owner - %s', path, owner)
+                abort(409, 'Error: Cannot use this path, it is used by {0}.'.format(owner))
 
 
 def pre_put_sites(request, payload):
@@ -175,7 +185,11 @@ def on_inserted_sites(items):
         statistics = utilities.post_eve(resource='statistics', payload=statistics_payload)
         item['statistics'] = str(statistics['_id'])
 
-        tasks.site_provision.delay(item)
+    # Sites that are POSTed together, like the available pool, are provisioned together.
+    if len(items) > 1:
+        tasks.site_provision_batch.delay(items)
+    else:
+        tasks.site_provision.delay(items[0])
 
 
 def on_insert_code(items):
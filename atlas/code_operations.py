@@ -3,14 +3,19 @@
     ~~~~
     Commands that run on servers to deploy code.
 """
+import json
 import logging
 import os
 import shutil
 import subprocess
+import time
+from hashlib import sha256
+
 import git
 
 from atlas import utilities
-from atlas.config import (ENVIRONMENT, CODE_ROOT, WEB_ROOT, DEFAULT_PROFILE)
+from atlas.config import (ENVIRONMENT, CODE_ROOT, WEB_ROOT, DEFAULT_PROFILE, CODE_MIRROR_DIRECTORY,
+                          CODE_ARTIFACT_DIRECTORY, SSH_CONTROL_OPTIONS)
 from atlas.config_servers import (SERVERDEFS)
 
 # Setup a sub-logger. See tasks.py for longer comment.
@@ -31,25 +36,113 @@ def repository_clone(item):
     if os.path.exists(code_dir):
         raise Exception('Destinaton directory already exists')
     os.makedirs(code_dir)
-    clone = git.Repo.clone_from(item['git_url'], code_dir)
+    try:
+        # Borrow objects from the mirror so only objects it does not have are downloaded and stored.
+        mirror_path = repository_mirror(item)
+        clone = git.Repo.clone_from(item['git_url'], code_dir, reference=mirror_path)
+    except git.exc.GitCommandError as error:
+        log.error('Code | Clone | Mirror failed, cloning without it | Error - %s', error)
+        shutil.rmtree(code_dir)
+        os.makedirs(code_dir)
+        clone = git.Repo.clone_from(item['git_url'], code_dir)
     log.info('Code | Clone | Result - %s', clone)
 
 
+def repository_mirror(item):
+    """
+    Create or update the bare mirror of a code item's repository.
+
+    :param item:
+    :return: path to the mirror
+    """
+    mirror_path = utilities.code_mirror_path(item)
+    if os.path.isdir(mirror_path):
+        log.info('Code | Mirror | Update | URL - %s', item['git_url'])
+        git.Repo(mirror_path).git.fetch('origin')
+    else:
+        log.info('Code | Mirror | Create | URL - %s', item['git_url'])
+        mirror = git.Repo.clone_from(item['git_url'], mirror_path, mirror=True)
+        # Checkouts use the mirror's objects in place, so it must never garbage collect them.
+        mirror.git.config('gc.auto', '0')
+    return mirror_path
+
+
 def repository_checkout(item):
     """
     Checkout a code to the local server.
 
     :param item:
-    :return:
+    :return: dict with 'fetched' and 'fetch_time' in seconds, None when no fetch was needed.
     """
     log.info('Code | Checkout | Hash - %s', item['commit_hash'])
     log.debug('Code | Checkout | Item - %s', item)
-    # Inializa and fetch repo
+    # Inialize repo and only go to the network when the commit is not already present.
     repo = git.Repo(utilities.code_path(item))
-    repo.remote().fetch()
+    fetch_time = None
+    try:
+        commit = repo.commit(item['commit_hash'])
+    except (ValueError, git.exc.BadName):
+        start_time = time.time()
+        try:
+            # Fetch only the commit we need. Fall back to a full fetch for servers that do not
+            # allow fetching a commit that is not advertised by a ref.
+            repo.remote().fetch(item['commit_hash'])
+        except git.exc.GitCommandError as error:
+            log.debug('Code | Checkout | Fetch commit failed | %s', error)
+            repo.remote().fetch()
+        fetch_time = time.time() - start_time
+        log.info('Atlas operational statistic | Code Fetch | Item - %s | %s',
+                 item['_id'], fetch_time)
+        commit = repo.commit(item['commit_hash'])
     # Point HEAD to the correct commit and reset
-    repo.head.reference = repo.commit(item['commit_hash'])
+    repo.head.reference = commit
     repo.head.reset(index=True, working_tree=True)
+    return {'fetched': fetch_time is not None, 'fetch_time': fetch_time}
+
+
+def repository_is_current(item):
+    """
+    Check if the local repository already has HEAD at the item's commit with a clean working tree.
+    Does not touch the network.
+
+    :param item:
+    :return: bool
+    """
+    try:
+        repo = git.Repo(utilities.code_path(item))
+        return repo.head.commit.hexsha == item['commit_hash'] and not repo.is_dirty()
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, ValueError) as error:
+        log.debug('Code | Current | Item - %s | %s', item['_id'], error)
+        return False
+
+
+def code_heal(item):
+    """
+    Make sure a code item is cloned and checked out at its commit. Git operations are skipped when
+    the local repository is already correct.
+
+    :param item:
+    :return: 'cloned', 'moved', or 'correct'
+    """
+    if not os.path.isdir(utilities.code_path(item)):
+        repository_clone(item)
+        result = 'cloned'
+    elif repository_is_current(item):
+        result = 'correct'
+    else:
+        result = 'moved'
+    if result != 'correct':
+        repository_checkout(item)
+        write_manifest(item)
+    if item['meta']['is_current']:
+        update_symlink_current(item)
+    # The full sync leaves out artifact trees, the servers are healed from the artifact. Hosts that
+    # already have it unpacked are skipped.
+    if item['meta']['code_type'] != 'static':
+        hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
+        utilities.push_artifact(build_artifact(item), hosts, utilities.code_path(item))
+    log.info('Code | Heal | Item - %s | Result - %s', item['_id'], result)
+    return result
 
 
 def repository_remove(item):
@@ -62,6 +155,135 @@ def repository_remove(item):
     log.info('Code | Remove | Item - %s', item['_id'])
     log.debug('Code | Remove | Item - %s', item)
     shutil.rmtree(utilities.code_path(item))
+    # Remove the linkable file manifest that lives next to the code.
+    if os.path.isfile(utilities.code_manifest_path(item)):
+        os.remove(utilities.code_manifest_path(item))
+
+
+def write_manifest(item):
+    """Compute the linkable file manifest for a code item and store it next to the code, so that
+    instance operations do not need to scan and regex-match the code tree for every instance.
+
+    Arguments:
+        item {dict} -- code item that has been checked out
+    """
+    log.info('Code | Manifest | Item - %s', item['_id'])
+    manifest = utilities.write_code_manifest(item)
+    log.debug('Code | Manifest | Item - %s | Manifest - %s', item['_id'], manifest)
+    return manifest
+
+
+def build_artifact(item):
+    """Build the code artifact for an item: a tarball of its commit without VCS metadata or files
+    that match INSTANCE_CODE_IGNORE_REGEX. Artifacts are named by git tree hash, so an item with the
+    same content as an earlier one reuses its artifact.
+
+    Arguments:
+        item {dict} -- code item that has been checked out
+
+    Returns:
+        dict -- 'path', 'digest' (sha256 of the tarball), and 'tree' hash
+    """
+    repo = git.Repo(utilities.code_path(item))
+    tree = repo.commit(item['commit_hash']).tree
+    artifact_path = utilities.code_artifact_path(tree.hexsha)
+    digest_path = artifact_path + '.sha256'
+    if not os.path.isfile(digest_path):
+        log.info('Code | Artifact | Build | Item - %s | Tree - %s', item['_id'], tree.hexsha)
+        if not os.path.isdir(os.path.dirname(artifact_path)):
+            os.makedirs(os.path.dirname(artifact_path))
+        # git archive leaves out .git, ignored top level entries are left out by path.
+        paths = [entry.path for entry in tree if not utilities.ignore_code_file(entry.name)]
+        with open(artifact_path + '.tmp', 'wb') as artifact_file:
+            repo.archive(artifact_file, treeish=item['commit_hash'], format='tar.gz', path=paths)
+        digest = sha256()
+        with open(artifact_path + '.tmp', 'rb') as artifact_file:
+            for chunk in iter(lambda: artifact_file.read(1 << 20), b''):
+                digest.update(chunk)
+        os.rename(artifact_path + '.tmp', artifact_path)
+        # The digest file is written last, it marks the artifact as complete.
+        with open(digest_path, 'w') as digest_file:
+            digest_file.write(digest.hexdigest())
+    with open(digest_path) as digest_file:
+        digest = digest_file.read().strip()
+    # Keep the tree in the item's manifest, so finding the items that share an artifact does not
+    # need their repositories.
+    manifest = utilities.get_code_manifest(item)
+    if manifest.get('tree') != tree.hexsha:
+        manifest['tree'] = tree.hexsha
+        utilities.write_code_manifest(item, manifest)
+    return {'path': artifact_path, 'digest': digest, 'tree': tree.hexsha}
+
+
+def artifact_tree(item):
+    """Read the tree hash of a code item's artifact from its manifest.
+
+    Arguments:
+        item {dict} -- code item
+
+    Returns:
+        string -- tree hash, None if no artifact was built for the item's commit
+    """
+    try:
+        with open(utilities.code_manifest_path(item)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('commit_hash') != item['commit_hash']:
+        return None
+    return manifest.get('tree')
+
+
+def remove_artifact(item):
+    """Remove the code artifact for an item from Atlas and the servers, unless another code item
+    has the same tree. Run before the manifest is removed, the tree hash is read from it.
+
+    Arguments:
+        item {dict} -- code item that is being removed
+    """
+    tree = artifact_tree(item)
+    if not tree:
+        log.info('Code | Artifact | Remove | Item - %s | No artifact', item['_id'])
+        return
+    for other in utilities.get_eve('code')['_items']:
+        if other['_id'] == item['_id'] or other['meta']['code_type'] == 'static':
+            continue
+        if artifact_tree(other) == tree:
+            log.info('Code | Artifact | Remove | Item - %s | Kept for item - %s', item['_id'],
+                     other['_id'])
+            return
+    artifact_path = utilities.code_artifact_path(tree)
+    log.info('Code | Artifact | Remove | Item - %s | Artifact - %s', item['_id'], artifact_path)
+    for path in [artifact_path, artifact_path + '.sha256', artifact_path + '.tmp']:
+        if os.path.isfile(path):
+            os.remove(path)
+    # The servers only have the tarball.
+    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
+    for host in set(hosts):
+        cmd = 'ssh {0} {1} rm -f {2}'.format(SSH_CONTROL_OPTIONS, host, artifact_path)
+        try:
+            subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            log.error('Code | Artifact | Remove | Failed | Return code - %s | StdErr - %s | Host - %s',
+                      e.returncode, e.output, host)
+
+
+def deploy_artifact(item):
+    """Build the artifact for a code item and unpack it on all of the relevant nodes, then sync
+    the rest of the item without its checkout.
+
+    Arguments:
+        item {dict} -- code item that has been checked out
+
+    Returns:
+        dict -- {host: 'unchanged', 'unpacked', or 'failed'}
+    """
+    artifact = build_artifact(item)
+    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
+    results = utilities.push_artifact(artifact, hosts, utilities.code_path(item))
+    sync_code(item, checkout=False)
+    log.info('Code | Artifact | Deploy | Item - %s | Results - %s', item['_id'], results)
+    return results
 
 
 def update_symlink_current(item):
@@ -95,15 +317,50 @@ def update_symlink_current(item):
                 os.unlink(code_folder_current)
 
 
-def sync_code():
+def sync_code(item=None, checkout=True):
     """Copy the code to all of the relevant nodes.
+
+    Keyword Arguments:
+        item {dict} -- Only sync the checkout, manifest, -current symlink, and static link for this
+        code item. Without an item all of CODE_ROOT and WEB_ROOT/static are synced, which is only
+        needed when healing (default: {None})
+        checkout {bool} -- Include the checkout for the item, False when it was deployed as an
+        artifact (default: {True})
+
+    Returns:
+        dict -- 'bytes_scanned' and 'bytes_sent' totals for all hosts
     """
-    log.info('Code | Sync')
+    log.info('Code | Sync | Item - %s', item['_id'] if item else None)
     hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
-    # Sync code root
-    utilities.sync(CODE_ROOT, hosts, CODE_ROOT)
-    # Sync static items
-    utilities.sync(WEB_ROOT + '/static', hosts, WEB_ROOT + '/static')
+    if item:
+        code_folder = os.path.dirname(utilities.code_path(item))
+        code_paths = [os.path.relpath(path, CODE_ROOT) for path in [
+            utilities.code_manifest_path(item),
+            '{0}/{1}-current'.format(code_folder, item['meta']['name'])]]
+        if checkout:
+            code_paths.append(os.path.relpath(utilities.code_path(item), CODE_ROOT))
+        stats = utilities.sync_paths(CODE_ROOT, code_paths, hosts, CODE_ROOT, recursive=True)
+        if item['meta']['code_type'] == 'static':
+            static_path = 'static/{0}/{1}'.format(item['meta']['name'], item['meta']['version'])
+            static_stats = utilities.sync_paths(WEB_ROOT, [static_path], hosts, WEB_ROOT)
+            for key in stats:
+                stats[key] += static_stats[key]
+    else:
+        # Sync code root, the webservers only need the checkouts. Checkouts other than static ones
+        # are deployed as artifacts and healed by code_heal, syncing them would replace the artifact
+        # trees and their markers. The trailing slash only matches directories, so the manifests and
+        # -current symlinks next to them are still synced.
+        exclude = ['/' + CODE_MIRROR_DIRECTORY, '/' + CODE_ARTIFACT_DIRECTORY]
+        exclude += ['/{0}/*/*/'.format(utilities.code_type_directory_name(code_type))
+                    for code_type in ['library', 'theme', 'module', 'core', 'profile']]
+        stats = utilities.sync(CODE_ROOT, hosts, CODE_ROOT, exclude=exclude)
+        # Sync static items
+        static_stats = utilities.sync(WEB_ROOT + '/static', hosts, WEB_ROOT + '/static')
+        for key in stats:
+            stats[key] += static_stats[key]
+    log.info('Atlas operational statistic | Code Sync | Item - %s | Bytes scanned - %s | Bytes sent - %s',
+             item['_id'] if item else None, stats['bytes_scanned'], stats['bytes_sent'])
+    return stats
 
 
 def deploy_static(item):
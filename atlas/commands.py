@@ -31,7 +31,19 @@ COMMANDS = [
     },
     {
         'machine_name': u'heal_instances',
-        'description': u'Check that all instances are present and the directory structure is correct. Fix any instances that are irregular.',
+        'description': u'Check that all instances are present and the directory structure is correct. Repair only the differences for instances that are irregular. To delete and recreate every instance instead, include the payload `{"rebuild":true}`. To only heal the instances that drifted in an audit, include the payload `{"audit":"<audit _id>"}`.',
+    },
+    {
+        'machine_name': u'audit_instances',
+        'description': u'Check the directory structure of all instances against their records without changing anything. Missing links, wrong code versions, stale settings files, and orphaned directories are stored as an `audit` item.',
+    },
+    {
+        'machine_name': u'provision_benchmark',
+        'description': u'Time `drush site-install` and loading the database template on the same scratch instance.',
+    },
+    {
+        'machine_name': u'backup_benchmark',
+        'description': u'Compare the time and size of each backup format for the largest instances.',
     },
     {
         'machine_name': u'sync_instances',
@@ -54,6 +54,15 @@ PROTECTED_PATHS = ['opcache', 'static', 'includes', 'misc',
 INSTANCE_CODE_IGNORE_REGEX = ['^.DS_Store', '^.git',
                               '(?<!^robots)\.txt$', '(.+).patch$', '(.+).md$']
 
+# Installed database dumps, one per core and profile pair, that are loaded into new instances
+# instead of running `drush site-install`. BACKUP_PATH is shared between Atlas and the
+# operations server.
+DATABASE_TEMPLATE_PATH = BACKUP_PATH + '/templates'
+
+# Index of WEB_ROOT paths and the instance sid that owns them. It lives in INSTANCE_ROOT so that it
+# is not served and is synced to the webservers along with the instances.
+WEB_ROOT_INDEX = INSTANCE_ROOT + '/.web_root_index.json'
+
 # Drupal core paths to symlink into the WEB_ROOT for the homepage instances. .htaccess or robots.txt
 # are not included since they are managed seperately for this instance; web.config is not used in
 # linux deployments.
@@ -61,6 +70,109 @@ CORE_WEB_ROOT_SYMLINKS = ['authorize.php', 'cron.php', 'includes', 'index.php',
                           'misc', 'modules', 'profiles', 'scripts', 'sites', 'themes', 'update.php',
                           'xmlrpc.php']
 
+# Directory in CODE_ROOT for the bare mirrors that code checkouts borrow git objects from. It is not
+# synced to the webservers.
+CODE_MIRROR_DIRECTORY = 'mirrors'
+
+# Directory in CODE_ROOT for the code artifacts, tarballs of a commit's tree without VCS metadata,
+# that are pushed to the webservers. Named by the git tree hash, so identical content is only
+# built and sent once.
+CODE_ARTIFACT_DIRECTORY = 'artifacts'
+
+# Seconds an SSH connection to a server can be idle before it is closed. Fabric tasks reuse one
+# connection per host in each worker, and rsync and ssh commands share one multiplexed connection
+# per host through an OpenSSH control socket.
+SSH_CONNECTION_IDLE_TIMEOUT = 300
+SSH_CONTROL_OPTIONS = ('-o ControlMaster=auto -o ControlPath=~/.ssh/atlas-%r@%h:%p '
+                       '-o ControlPersist={0}'.format(SSH_CONNECTION_IDLE_TIMEOUT))
+# At most SSH_CONNECTION_LIMIT fabric connections to a host are open at once across all of the
+# workers. A connection counts until it is closed, idle ones after SSH_CONNECTION_IDLE_TIMEOUT. A
+# worker waits up to SSH_CONNECTION_WAIT seconds for one to be free.
+SSH_CONNECTION_LIMIT = 32
+SSH_CONNECTION_WAIT = 120
+# Each worker writes its handshake and reuse counts here, they are summed for /ssh/stats.
+SSH_STATS_DIRECTORY = '/tmp/atlas_ssh_stats'
+
+# CLI work for instances (drush commands, cron, updb, cache clears) runs on the SERVERDEFS
+# 'cli_servers'. Each host runs at most its 'cli_concurrency' value (or CLI_DEFAULT_CONCURRENCY)
+# drush processes at once, tracked with lock files in CLI_SLOT_DIRECTORY. Without 'cli_servers' the
+# work runs on the 'operations_server' with no limit.
+# The lock files are local to the Atlas server, so every Celery worker has to run on it, as with the
+# local BROKER_URL in config_celery.py. Workers on other machines would not see the slots. The same
+# applies to the backup and SSH connection slots.
+# CLI_HOST_STRATEGY is 'least_loaded', 'least_active', or 'round_robin'. 'least_loaded' picks the
+# host with the lowest 1 minute load average per CPU, sampled over SSH at most every
+# CLI_LOAD_INTERVAL seconds. 'least_active' picks the host with the fewest slots taken.
+CLI_HOST_STRATEGY = 'least_loaded'
+CLI_LOAD_INTERVAL = 30
+CLI_DEFAULT_CONCURRENCY = 4
+CLI_SLOT_DIRECTORY = '/tmp/atlas_cli_slots'
+# Seconds to wait for a free slot before giving up.
+CLI_HOST_WAIT = 300
+
+# Scheduled cron runs for a status are spread over this fraction of the time until the next
+# scheduled run, so that the last sites finish before the next round starts. 0 runs them all at once.
+CRON_SPREAD_FRACTION = 0.9
+
+# Adaptive cron for these statuses. Activity is the fewest days since the last edit or login in
+# the site's statistics. Each tier is (maximum days of inactivity, scheduled rounds between runs),
+# checked in order, None matches everything. With an hourly schedule the defaults run active sites
+# hourly, quiet sites every 6 hours, and dormant sites daily.
+CRON_ADAPTIVE_STATUSES = ['launched']
+CRON_ADAPTIVE_TIERS = [(7, 1), (60, 6), (None, 24)]
+# Activity only counts edits and logins, so busy public sites that nobody logs into would look
+# dormant. Sites with these paths, or with 'cron_adaptive' set to false on their record, run cron
+# every round.
+CRON_ADAPTIVE_EXCLUDE_PATHS = BACKUPS_LARGE_INSTANCES
+
+# Size in bytes of the capped collection that keeps the most recent cron runs.
+CRON_HISTORY_SIZE = 64 * 1024 * 1024
+
+# Routine backups are queued longest first by their last backup duration. At most
+# BACKUP_DATABASE_CONCURRENCY database dumps run against a database server, and
+# BACKUP_FILES_CONCURRENCY files archives read from an NFS mount, at once. Backups wait up to
+# BACKUP_SLOT_WAIT seconds for a free slot, then are queued again after BACKUP_RETRY_COUNTDOWN
+# seconds, up to BACKUP_RETRIES times, so that waiting backups do not hold a worker.
+BACKUP_DATABASE_CONCURRENCY = 2
+BACKUP_FILES_CONCURRENCY = 2
+BACKUP_SLOT_WAIT = 60
+BACKUP_RETRY_COUNTDOWN = 300
+BACKUP_RETRIES = 24
+# Instances whose last backup took longer than this many seconds are backed up weekly with the
+# BACKUPS_LARGE_INSTANCES paths instead of nightly.
+BACKUP_LARGE_DURATION = 600
+# Days of backup records that the durations and sizes are read from. Covers the weekly backups of
+# large instances.
+BACKUP_HISTORY_DAYS = 14
+
+# Format for new backups. 'gzip' writes an uncompressed database dump and a `tar -z` files archive.
+# 'zstd' and 'pigz' stream the dump and the files archive through a compressor running
+# BACKUP_COMPRESSION_THREADS threads. Restores go by the file extensions, so any format can be
+# restored.
+BACKUP_FORMAT = 'gzip'
+BACKUP_COMPRESSION_THREADS = 4
+# With BACKUP_FILES_INCREMENTAL, files backups are snapshot directories in BACKUP_SNAPSHOT_PATH
+# instead of archives. Files that have not changed since the instance's previous snapshot are
+# hardlinks to it, so each night only new and changed files are written. Removing a snapshot only
+# frees the files that no other snapshot links to.
+BACKUP_FILES_INCREMENTAL = False
+BACKUP_SNAPSHOT_PATH = BACKUP_PATH + '/snapshots'
+# Number of the largest instances, by their last backup size, that backup_benchmark compares the
+# formats for.
+BACKUP_BENCHMARK_INSTANCES = 3
+
+# Drush commands for many instances are run in batches of DRUSH_BATCH_SIZE instances per SSH
+# session, with DRUSH_BATCH_PARALLEL drush processes at a time in each session.
+DRUSH_BATCH_SIZE = 200
+DRUSH_BATCH_PARALLEL = 8
+# Seconds a chunk may run before the commands still running are stopped and reported as failed.
+# Sites that finished keep their results. Allows about 2 minutes per site.
+DRUSH_BATCH_TIME_LIMIT = DRUSH_BATCH_SIZE / DRUSH_BATCH_PARALLEL * 120
+
+# Number of code items that code_heal will run git operations for at the same time. Keeps a heal of
+# every code item from hitting the git server with one fetch per item at once.
+CODE_HEAL_GIT_CONCURRENCY = 4
+
 # This allows us to use a self signed cert for local dev.
 SSL_VERIFICATION = True
 if ENVIRONMENT == 'local':
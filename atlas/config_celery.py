@@ -29,6 +29,9 @@ CELERY_ROUTES = {
     'atlas.tasks.site_provision': {
         'queue': 'atlas_queue'
     },
+    'atlas.tasks.site_provision_batch': {
+        'queue': 'atlas_queue'
+    },
     'atlas.tasks.site_update': {
         'queue': 'update_queue'
     },
@@ -41,6 +44,9 @@ CELERY_ROUTES = {
     'atlas.tasks.drush_command_run': {
         'queue': 'command_queue'
     },
+    'atlas.tasks.drush_command_run_batch': {
+        'queue': 'command_queue'
+    },
     'atlas.tasks.cron': {
         'queue': 'cron_queue'
     },
@@ -102,6 +108,10 @@ CELERYBEAT_SCHEDULE = {
             "status": "available",
         },
     },
+    'cron_adaptive_report': {
+        'task': 'atlas.tasks.cron_adaptive_report',
+        'schedule': crontab(minute=30, hour=6),
+    },
     'available_sites_check': {
         'task': 'atlas.tasks.available_sites_check',
         'schedule': timedelta(minutes=5),
@@ -194,6 +194,15 @@ SITES_SCHEMA = {
     'update_group': {
         'type': 'integer',
     },
+    # False runs cron every scheduled round whatever the site's activity, see config.py.
+    'cron_adaptive': {
+        'type': 'boolean',
+        'default': True,
+    },
+    # Time in seconds for each stage of provisioning the instance.
+    'provision_timings': {
+        'type': 'dict',
+    },
     'settings': {
         'type': 'dict',
         'schema': {
@@ -287,6 +296,16 @@ SITES_SCHEMA = {
             'unique': True,
         },
     },
+    # Backup to load into the instance once it is installed. Set by a restore and cleared when
+    # site_update starts the load.
+    'restore_backup': {
+        'type': 'objectid',
+        'nullable': True,
+        'data_relation': {
+            'resource': 'backup',
+            'field': '_id',
+        },
+    },
     'created_by': {
         'type': 'string',
     },
@@ -877,7 +896,7 @@ STATISTICS_SCHEMA = {
 BACKUP_SCHEMA = {
     'state': {
         'type': 'string',
-        'allowed': ['pending', 'complete'],
+        'allowed': ['pending', 'complete', 'failed'],
         'default': 'pending',
         'required': True,
     },
@@ -905,9 +924,30 @@ BACKUP_SCHEMA = {
     'files': {
         'type': 'string',
     },
+    # 'snapshot' files backups are a directory in BACKUP_SNAPSHOT_PATH, see config.py.
+    'files_type': {
+        'type': 'string',
+        'allowed': ['archive', 'snapshot'],
+        'default': 'archive',
+    },
     'database': {
         'type': 'string',
     },
+    # Seconds to create the backup and size in bytes of each part, used to schedule backups.
+    'duration': {
+        'type': 'float',
+    },
+    'database_size': {
+        'type': 'integer',
+    },
+    'files_size': {
+        'type': 'integer',
+    },
+    # Bytes written for the files backup. Less than files_size for snapshots, where unchanged files
+    # are hardlinks to the previous snapshot.
+    'files_written': {
+        'type': 'integer',
+    },
     'created_by': {
         'type': 'string',
     },
@@ -944,6 +984,80 @@ DRUSH_SCHEMA = {
     },
 }
 
+AUDIT_SCHEMA = {
+    'batch': {
+        'type': 'string',
+        'required': True,
+    },
+    'total': {
+        'type': 'integer',
+    },
+    'correct': {
+        'type': 'list',
+        'schema': {
+            'type': 'string',
+        },
+    },
+    # List of dicts with 'site', 'sid', and 'differences' for instances that do not match their
+    # record.
+    'drifted': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+        },
+    },
+    'orphans': {
+        'type': 'dict',
+        'schema': {
+            'instance_root': {
+                'type': 'list',
+            },
+            'web_root': {
+                'type': 'list',
+            },
+        },
+    },
+    'created_by': {
+        'type': 'string',
+    },
+    'modified_by': {
+        'type': 'string',
+    },
+}
+
+CRON_HISTORY_SCHEMA = {
+    'site': {
+        'type': 'objectid',
+        'data_relation': {
+            'resource': 'sites',
+            'field': '_id',
+        },
+    },
+    'sid': {
+        'type': 'string',
+        'required': True,
+    },
+    'status': {
+        'type': 'string',
+        'allowed': [
+            'success',
+            'failed',
+        ],
+    },
+    # Seconds
+    'duration': {
+        'type': 'float',
+    },
+    'host': {
+        'type': 'string',
+        'nullable': True,
+    },
+    'error': {
+        'type': 'string',
+        'nullable': True,
+    },
+}
+
 """
 Definitions of Resources.
 Tells Eve what methods and schemas apply to a given resource.
@@ -1009,6 +1123,24 @@ DRUSH = {
     'schema': DRUSH_SCHEMA,
 }
 
+# Audit resource
+AUDIT = {
+    'item_title': 'audit',
+    'public_methods': ['GET'],
+    'public_item_methods': ['GET'],
+    'schema': AUDIT_SCHEMA,
+}
+
+# Cron history resource, stored in a capped collection that run.py creates.
+CRON_HISTORY = {
+    'item_title': 'cron_history',
+    'public_methods': ['GET'],
+    'public_item_methods': ['GET'],
+    'resource_methods': ['GET', 'POST'],
+    'item_methods': ['GET'],
+    'schema': CRON_HISTORY_SCHEMA,
+}
+
 # Domain definition. Tells Eve what resources are available on this domain.
 DOMAIN = {
     'sites': SITES,
@@ -1017,4 +1149,6 @@ DOMAIN = {
     'query': QUERY,
     'statistics': STATISTICS,
     'backup': BACKUP,
+    'audit': AUDIT,
+    'cron_history': CRON_HISTORY,
 }
@@ -10,19 +10,28 @@ import json
 
 import requests
 from datetime import datetime
-from time import time, sleep, strftime
+from StringIO import StringIO
+from time import time, strftime
 
+import fabric.context_managers
+import fabric.operations
+import fabric.state
+import fabric.tasks
 from fabric.contrib.files import exists, upload_template
 from fabric.operations import put
 from fabric.api import *
-from fabric.network import disconnect_all
+from fabric.network import normalize, normalize_to_string, HostConnectionCache
 
 from atlas import utilities
 from atlas.config import (ATLAS_LOCATION, ENVIRONMENT, SSH_USER, CODE_ROOT, INSTANCE_ROOT,
                           WEB_ROOT, WEBSERVER_USER, WEBSERVER_USER_GROUP, NFS_MOUNT_FILES_DIR,
                           BACKUP_PATH, SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD,
                           SITE_DOWN_PATH, VARNISH_CONTROL_KEY, STATIC_WEB_PATH, SSL_VERIFICATION,
-                          CORE_WEB_ROOT_SYMLINKS, SAML_AUTH, SMTP_PASSWORD)
+                          CORE_WEB_ROOT_SYMLINKS, SAML_AUTH, SMTP_PASSWORD,
+                          DATABASE_TEMPLATE_PATH, SSH_CONNECTION_IDLE_TIMEOUT,
+                          BACKUP_DATABASE_CONCURRENCY, BACKUP_FILES_CONCURRENCY, BACKUP_SLOT_WAIT,
+                          BACKUP_FORMAT, BACKUP_FILES_INCREMENTAL, BACKUP_SNAPSHOT_PATH,
+                          SSH_CONTROL_OPTIONS, SSH_CONNECTION_LIMIT, SSH_CONNECTION_WAIT)
 from atlas.config_servers import (SERVERDEFS, NFS_MOUNT_LOCATION, API_URLS,
                                   VARNISH_CONTROL_TERMINALS, BASE_URLS, ATLAS_LOGGING_URLS)
 
@@ -35,6 +44,100 @@ env.user = SSH_USER
 # Allow ~/.ssh/config to be utilized.
 env.use_ssh_config = True
 env.roledefs = SERVERDEFS[ENVIRONMENT]
+# Send keepalives so that connections kept between tasks are not dropped by the server.
+env.keepalive = 60
+
+# Directories in an instance's files that are generated, and left out of backups.
+BACKUP_FILES_EXCLUDE = ['imagecache', 'css', 'js', 'backup_migrate', 'styles', 'xmlsitemap',
+                        'honeypot']
+
+
+class ReusedConnectionCache(HostConnectionCache):
+    """
+    Fabric connection cache that keeps SSH connections open between `execute` calls in a worker.
+    Connections that have been idle for longer than SSH_CONNECTION_IDLE_TIMEOUT, or are no longer
+    active, are closed. Each open connection holds one of the SSH_CONNECTION_LIMIT slots for its
+    host, shared by all of the workers. Handshakes and the commands that reused a connection instead
+    are counted and written with `utilities.ssh_stats_write`.
+    """
+    # Seconds between writes of the counts, handshakes are always written.
+    stats_interval = 10
+
+    def __init__(self):
+        HostConnectionCache.__init__(self)
+        self.last_used = {}
+        self.slots = {}
+        self.stats = {'handshakes': 0, 'reused': 0}
+        self.stats_written = 0
+
+    def connect(self, key):
+        real_key = normalize_to_string(key)
+        host = normalize(key)[1]
+        self.slots[real_key] = utilities.resource_slot_take(
+            'ssh-' + host, SSH_CONNECTION_LIMIT, SSH_CONNECTION_WAIT)
+        self.count('handshakes')
+        log.info('Atlas operational statistic | SSH | Connect | Host - %s | Handshakes - %s | Reused - %s',
+                 real_key, self.stats['handshakes'], self.stats['reused'])
+        try:
+            HostConnectionCache.connect(self, key)
+        except (Exception, SystemExit):
+            self.close(real_key)
+            raise
+
+    def __getitem__(self, key):
+        real_key = normalize_to_string(key)
+        now = time()
+        for host, used in self.last_used.items():
+            if now - used > SSH_CONNECTION_IDLE_TIMEOUT:
+                log.debug('SSH | Idle | Host - %s', host)
+                self.close(host)
+        if dict.__contains__(self, real_key):
+            transport = dict.__getitem__(self, real_key).get_transport()
+            if transport and transport.is_active():
+                self.count('reused')
+            else:
+                self.close(real_key)
+        self.last_used[real_key] = now
+        return HostConnectionCache.__getitem__(self, key)
+
+    def close(self, key):
+        """
+        Close and forget the connection to a host, and free its slot.
+        """
+        if dict.__contains__(self, key):
+            dict.__getitem__(self, key).close()
+            dict.__delitem__(self, key)
+        self.last_used.pop(key, None)
+        slot_file = self.slots.pop(key, None)
+        if slot_file:
+            slot_file.close()
+
+    def count(self, counter):
+        """
+        Count a handshake or reuse, and write the counts if they are due.
+        """
+        self.stats[counter] += 1
+        now = time()
+        if counter == 'handshakes' or now - self.stats_written > self.stats_interval:
+            utilities.ssh_stats_write(self.stats)
+            self.stats_written = now
+
+
+def connection_cache_install():
+    """
+    Replace fabric's connection cache with a ReusedConnectionCache. Fabric modules import the cache
+    object by name when they are loaded, so each module that holds the original is pointed at the
+    new one, not only fabric.state.
+    """
+    original = fabric.state.connections
+    cache = ReusedConnectionCache()
+    for module in [fabric.state, fabric.operations, fabric.context_managers, fabric.tasks]:
+        if getattr(module, 'connections', None) is original:
+            module.connections = cache
+    return cache
+
+
+connection_cache_install()
 
 
 class FabricException(Exception):
@@ -75,6 +178,49 @@ def command_run_single(site, command, warn_only=False):
                 return command_result
 
 
+@roles('operations_server')
+def command_run_batch(commands, parallel, batch_id, time_limit=None):
+    """
+    Run commands for several sites in one session, up to `parallel` at a time.
+
+    :param commands: List of (sid, command) tuples. Commands run in the site's web directory.
+    :param parallel: Number of commands to run at the same time.
+    :param batch_id: Identifier used for the remote files.
+    :param time_limit: Seconds before the commands still running are stopped. The results of the
+        commands that finished are still returned.
+    :return: List of dicts with 'sid', 'status', 'time' in seconds, and 'output'.
+    """
+    log.info('Command | Batch | Batch - %s | Sites - %s | Parallel - %s',
+             batch_id, len(commands), parallel)
+    remote_file = '/tmp/atlas_drush_batch_{0}'.format(batch_id)
+    upload_template('drush_batch.sh', remote_file + '.sh',
+                    context={'web_root': WEB_ROOT, 'lock_file': remote_file + '.lock'},
+                    use_jinja=True, template_dir=ATLAS_LOCATION + '/templates')
+    # Base64 keeps each command on a single line with no quoting to worry about.
+    command_lines = ''.join('{0} {1}\n'.format(sid, command.encode('base64').replace('\n', ''))
+                            for sid, command in commands)
+    put(StringIO(command_lines), remote_file + '.in')
+    with settings(warn_only=True):
+        batch_command = 'bash {0}.sh {1} < {0}.in'.format(remote_file, parallel)
+        if time_limit:
+            # timeout signals the whole process group, so the running drush processes stop too.
+            batch_command = 'timeout {0} {1}'.format(time_limit, batch_command)
+        batch_result = run(batch_command, pty=False, quiet=True)
+        run('rm -f {0}.sh {0}.in {0}.lock'.format(remote_file), quiet=True)
+
+    results = []
+    for line in batch_result.splitlines():
+        # Only strip the line ending, commands with no output end with an empty field.
+        parts = line.rstrip('\r\n').split('\t')
+        try:
+            results.append({'sid': parts[0], 'status': int(parts[1]),
+                            'time': int(parts[2]) / 1000.0, 'output': parts[3].decode('base64')})
+        except (IndexError, ValueError) as error:
+            log.warning('Command | Batch | Batch - %s | Malformed result - %s | %s',
+                        batch_id, line, error)
+    return results
+
+
 @roles('operations_server')
 def update_database(site):
     """
@@ -140,7 +286,48 @@ def site_install(site):
 
 
 @roles('operations_server')
-def backup_create(site, backup_type):
+def database_template_create(site):
+    """Dump the freshly installed database of an instance as the template for its core and profile
+    """
+    code_directory_current = '{0}/{1}/current'.format(INSTANCE_ROOT, site['sid'])
+    template_path = utilities.database_template_path(
+        site['code']['core'], site['code']['profile'])
+    log.info('Site | Database template | Create | Template - %s', template_path)
+
+    run('mkdir -p {0}'.format(DATABASE_TEMPLATE_PATH))
+    with cd(code_directory_current):
+        # Dump to a temporary file and move it into place so that a partial template is never
+        # loaded. Instances installed at the same time just replace each other's dump.
+        run('drush sql-dump --structure-tables-list=cache,cache_*,sessions,watchdog,history --result-file={0}.{1}'.format(
+            template_path, site['sid']))
+        run('mv {0}.{1} {0}'.format(template_path, site['sid']))
+
+
+@roles('operations_server')
+def database_template_load(site, template_path):
+    """Load a database template into an instance instead of running `drush site-install`, then
+    replace the values that have to be unique to the instance.
+    """
+    code_directory_current = '{0}/{1}/current'.format(INSTANCE_ROOT, site['sid'])
+    log.info('Site | Database template | Load | Instance - %s | Template - %s',
+             site['sid'], template_path)
+
+    try:
+        with cd(code_directory_current):
+            run('drush sql-cli < {0}'.format(template_path))
+            run('drush vset -y cron_key {0}'.format(utilities.randomstring(43)))
+            run('drush vset -y drupal_private_key {0}'.format(utilities.randomstring(43)))
+            run('drush vset -y install_time $(date +%s)')
+            # The template admin password is shared, make it unusable. Login is through LDAP.
+            run('drush sql-query "UPDATE users SET pass = \'\' WHERE uid = 1"')
+            run('sg {0} -c "drush cc all"'.format(WEBSERVER_USER_GROUP))
+    except FabricException as error:
+        log.error('Site | Database template | Load failed | Error - %s', error)
+        raise
+
+
+@roles('operations_server')
+def backup_create(site, backup_type, backup_format=BACKUP_FORMAT):
     """
     Backup the database and files for an site.
     """
@@ -168,36 +355,55 @@ def backup_create(site, backup_type):
     backup_item = post.json()
     log.info('Backup | Create | POST | Backup item - %s', backup_item)
     # Setup dates and times.
-    start_time = time()
     date = datetime.now()
     date_time_string = date.strftime("%Y-%m-%d-%H-%M-%S")
     datetime_string = date.strftime("%Y-%m-%d %H:%M:%S GMT")
 
     # Instance paths
-    web_directory = '{0}/{1}'.format(WEB_ROOT, site['sid'])
-    database_result_file = '{0}_{1}.sql'.format(site['sid'], date_time_string)
+    database_result_file, files_result_file = utilities.backup_file_names(
+        site['sid'], date_time_string, backup_format)
     database_result_file_path = '{0}/backups/{1}'.format(BACKUP_PATH, database_result_file)
-    if NFS_MOUNT_FILES_DIR:
-        files_dir = '{0}/{1}/files'.format(NFS_MOUNT_LOCATION[ENVIRONMENT], site['sid'])
-    else:
-        files_dir = '{0}/{1}/sites/default/files'.format(WEB_ROOT, site['sid'])
-    files_result_file = '{0}_{1}.tar.gz'.format(site['sid'], date_time_string)
     files_result_file_path = '{0}/backups/{1}'.format(BACKUP_PATH, files_result_file)
 
-    # Start the actual process.
-    with cd(web_directory):
-        run('drush sql-dump --structure-tables-list=cache,cache_*,sessions,watchdog,history --result-file={0}'.format(
-            database_result_file_path))
-    with cd(files_dir):
-        log.debug('File dir | %s', files_dir)
-        run('tar --exclude "imagecache" --exclude "css" --exclude "js" --exclude "backup_migrate" --exclude "styles" --exclude "xmlsitemap" --exclude "honeypot" -czf {0} *'.format(
-            files_result_file_path))
-
-    backup_time = time() - start_time
-
+    # Start the actual process. The duration only counts the time spent working, not waiting for a
+    # slot, since it is used to schedule the next backups.
+    try:
+        database_time = backup_database_dump(site, database_result_file_path, backup_format)
+        if BACKUP_FILES_INCREMENTAL:
+            files_type = 'snapshot'
+            files_result_file = '{0}/{1}'.format(site['sid'], date_time_string)
+            snapshot = backup_files_snapshot(site, date_time_string)
+            files_bytes = snapshot['bytes_scanned']
+            # Only the new and changed files are written.
+            files_written = snapshot['bytes_transferred']
+            files_time = snapshot['time']
+        else:
+            files_type = 'archive'
+            files_time = backup_files_archive(site, files_result_file_path, backup_format)
+            files_bytes = os.path.getsize(files_result_file_path)
+            files_written = files_bytes
+    except utilities.ResourceSlotTimeout:
+        # Nothing was backed up. Remove what was written and the record, the task queues the
+        # backup again.
+        log.info('Backup | Create | SID - %s | No free slot, removing pending backup - %s',
+                 site['sid'], backup_item['_id'])
+        for path in [database_result_file_path, files_result_file_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        utilities.delete_eve('backup', backup_item['_id'])
+        raise
+    except (Exception, SystemExit) as error:
+        log.error('Backup | Create | SID - %s | Backup - %s | Failed - %s', site['sid'],
+                  backup_item['_id'], error)
+        utilities.patch_eve('backup', backup_item['_id'], {'state': 'failed'})
+        raise
+
+    backup_time = database_time + files_time
+
+    database_bytes = os.path.getsize(database_result_file_path)
     # File size with thousand seperator, converted to MB.
-    db_size = '{:,.0f}'.format(os.path.getsize(database_result_file_path)/float(1 << 20))+" MB"
-    file_size = '{:,.0f}'.format(os.path.getsize(files_result_file_path)/float(1 << 20))+" MB"
+    db_size = '{:,.0f}'.format(database_bytes/float(1 << 20))+" MB"
+    file_size = '{:,.0f}'.format(files_bytes/float(1 << 20))+" MB"
 
     patch_payload = {
         'site': site['_id'],
@@ -205,7 +411,12 @@ def backup_create(site, backup_type):
         'backup_date': datetime_string,
         'backup_type': backup_type,
         'files': files_result_file,
+        'files_type': files_type,
         'database': database_result_file,
+        'duration': backup_time,
+        'database_size': database_bytes,
+        'files_size': files_bytes,
+        'files_written': files_written,
         'state': 'complete'
     }
 
@@ -216,52 +427,172 @@ def backup_create(site, backup_type):
              site['sid'], backup_time, db_size, file_size)
 
 
-@roles('operations_server')
-def backup_restore(backup_record, original_instance, package_list):
+def backup_database_dump(site, database_path, backup_format):
     """
-    Restore database and files to a new instance.
+    Dump the database for a site to a file. Formats other than 'gzip' stream the dump through their
+    compressor. Holds one of the BACKUP_DATABASE_CONCURRENCY slots for the database server, so that
+    a batch of backups does not overload it.
+
+    :return: Seconds the dump took, once it had a slot.
     """
-    log.info('Instance | Restore Backup | %s | %s', backup_record, original_instance)
-    start_time = time()
-    file_date = datetime.strptime(backup_record['backup_date'], "%Y-%m-%d %H:%M:%S %Z")
-    pretty_filename = '{0}_{1}'.format(
-        original_instance['sid'], file_date.strftime("%Y-%m-%d-%H-%M-%S"))
-    pretty_database_filename = '{0}.sql'.format(pretty_filename)
-    database_path = '{0}/backups/{1}'.format(BACKUP_PATH, pretty_database_filename)
-    pretty_files_filename = '{0}.tar.gz'.format(pretty_filename)
-    files_path = '{0}/backups/{1}'.format(BACKUP_PATH, pretty_files_filename)
-
-    # Grab available instance and add packages if needed
-    available_instances = utilities.get_eve('sites', 'where={"status":"available"}')
-    log.debug('Instance | Restore Backup | Avaiable Instances - %s', available_instances)
-    new_instance = next(iter(available_instances['_items']), None)
-    # TODO: Don't switch if the code is the same
-    if new_instance is not None:
-        payload = {'status': 'installing'}
-        if package_list:
-            packages = {'code': {'package': package_list}}
-            payload.update(packages)
-        utilities.patch_eve('sites', new_instance['_id'], payload)
+    web_directory = '{0}/{1}'.format(WEB_ROOT, site['sid'])
+    database_resource = 'backup_database.{0}'.format(
+        SERVERDEFS[ENVIRONMENT]['database_servers']['master'])
+    compressor = utilities.backup_compress_command(backup_format)
+    dump = 'drush sql-dump --structure-tables-list=cache,cache_*,sessions,watchdog,history'
+    with utilities.resource_slot(database_resource, BACKUP_DATABASE_CONCURRENCY, BACKUP_SLOT_WAIT):
+        dump_start = time()
+        with cd(web_directory):
+            if compressor:
+                run('set -o pipefail; {0} | {1} > {2}'.format(dump, compressor, database_path))
+            else:
+                run('{0} --result-file={1}'.format(dump, database_path))
+        return time() - dump_start
+
+
+def backup_files_directory(site):
+    """
+    Files directory for a site and the name of the resource slot that limits the backups reading
+    from it.
+
+    :return: tuple of (files directory, resource name)
+    """
+    if NFS_MOUNT_FILES_DIR:
+        files_dir = '{0}/{1}/files'.format(NFS_MOUNT_LOCATION[ENVIRONMENT], site['sid'])
+        files_resource = 'backup_files.{0}'.format(NFS_MOUNT_LOCATION[ENVIRONMENT].replace('/', '_'))
     else:
-        exit('No available instances.')
+        files_dir = '{0}/{1}/sites/default/files'.format(WEB_ROOT, site['sid'])
+        files_resource = 'backup_files.{0}'.format(env.host_string)
+    return files_dir, files_resource
 
-    # Wait for code and status to update.
-    attempts = 18  # Tries every 10 seconds to a max of 18 (or 3 minutes).
-    while attempts:
-        try:
-            new_instance_refresh = utilities.get_single_eve('sites', new_instance['_id'])
-            if new_instance_refresh['status'] != 'installed':
-                log.info('Instance | Restore Backup | New instance is not ready | %s', new_instance['_id'])
-                raise ValueError('Status has not yet updated.')
-            break
-        except ValueError, e:
-            # If the status is not updated and we have attempts left,
-            # remove an attempt and wait 10 seconds.
-            attempts -= 1
-            if attempts is not 0:
-                sleep(10)
+
+def backup_files_archive(site, files_path, backup_format):
+    """
+    Archive the files directory for a site. Formats other than 'gzip' stream the archive through
+    their compressor. Holds one of the BACKUP_FILES_CONCURRENCY slots for the files mount.
+
+    :return: Seconds the archive took, once it had a slot.
+    """
+    files_dir, files_resource = backup_files_directory(site)
+    compressor = utilities.backup_compress_command(backup_format)
+    tar = 'tar ' + ' '.join('--exclude "{0}"'.format(exclude) for exclude in BACKUP_FILES_EXCLUDE)
+    with utilities.resource_slot(files_resource, BACKUP_FILES_CONCURRENCY, BACKUP_SLOT_WAIT):
+        archive_start = time()
+        with cd(files_dir):
+            log.debug('File dir | %s', files_dir)
+            if compressor:
+                run('set -o pipefail; {0} -cf - * | {1} > {2}'.format(tar, compressor, files_path))
             else:
-                exit(str(e))
+                run('{0} -czf {1} *'.format(tar, files_path))
+        return time() - archive_start
+
+
+def backup_files_snapshot(site, snapshot_name):
+    """
+    Snapshot the files directory for a site into BACKUP_SNAPSHOT_PATH/<sid>/<snapshot_name>. Files
+    that have not changed since the previous snapshot for the site are hardlinked to it instead of
+    copied. Holds one of the BACKUP_FILES_CONCURRENCY slots for the files mount.
+
+    :param site: A single site.
+    :param snapshot_name: Name of the snapshot directory, the backup date.
+    :return: dict of the rsync_stats for the snapshot and the 'time' it took, once it had a slot.
+    """
+    files_dir, files_resource = backup_files_directory(site)
+    site_snapshot_dir = '{0}/{1}'.format(BACKUP_SNAPSHOT_PATH, site['sid'])
+    snapshot_dir = '{0}/{1}'.format(site_snapshot_dir, snapshot_name)
+    # Snapshots are written to a '.partial' directory and renamed when they are complete, so a
+    # failed backup is never used as the base for the next one. Only this backup's partial is
+    # removed, another backup of the site may be writing its own.
+    run('mkdir -p {0}'.format(site_snapshot_dir))
+    run('rm -rf {0}.partial'.format(snapshot_dir))
+    # Snapshot names are dates, so the last complete one is the most recent.
+    previous = run('ls -1 {0} | grep -v "\\.partial$" | tail -n 1'.format(site_snapshot_dir)).strip()
+    link_dest = '--link-dest={0}/{1}'.format(site_snapshot_dir, previous) if previous else ''
+    excludes = ' '.join('--exclude "{0}"'.format(exclude) for exclude in BACKUP_FILES_EXCLUDE)
+    with utilities.resource_slot(files_resource, BACKUP_FILES_CONCURRENCY, BACKUP_SLOT_WAIT):
+        snapshot_start = time()
+        output = run('rsync -a --stats {0} {1} {2}/ {3}.partial/'.format(
+            excludes, link_dest, files_dir, snapshot_dir))
+        snapshot_time = time() - snapshot_start
+    run('mv {0}.partial {0}'.format(snapshot_dir))
+    stats = utilities.rsync_stats(output)
+    stats['time'] = snapshot_time
+    log.info('Backup | Snapshot | SID - %s | Previous - %s | Scanned - %s | Copied - %s | Time - %s',
+             site['sid'], previous, stats['bytes_scanned'], stats['bytes_transferred'],
+             snapshot_time)
+    return stats
+
+
+def backup_files_extract(files_path, files_type='archive'):
+    """
+    Extract a files backup, an archive in any format or a snapshot directory, into the current
+    directory.
+    """
+    if files_type == 'snapshot':
+        run('rsync -a {0}/ .'.format(files_path))
+    else:
+        run('set -o pipefail; {0} {1} | tar -xf -'.format(
+            utilities.backup_decompress_command(files_path), files_path))
+
+
+def backup_database_load(database_path):
+    """
+    Load a database backup, in any format, into the instance in the current directory.
+    """
+    if database_path.endswith('.sql'):
+        run('drush sql-cli < {0}'.format(database_path))
+    else:
+        run('set -o pipefail; {0} {1} | drush sql-cli'.format(
+            utilities.backup_decompress_command(database_path), database_path))
+
+
+@roles('operations_server')
+def backup_benchmark(site, backup_formats):
+    """
+    Create a database and files backup for a site in each format, to compare the time they take
+    and their size. The backups are written to BACKUP_PATH/benchmark and removed afterwards.
+
+    :param site: A single site.
+    :param backup_formats: List of formats to compare.
+    :return: dict of {'database_time', 'database_size', 'files_time', 'files_size'} keyed by format.
+    """
+    benchmark_dir = '{0}/benchmark'.format(BACKUP_PATH)
+    run('mkdir -p {0}'.format(benchmark_dir))
+    results = {}
+    for backup_format in backup_formats:
+        database_file, files_file = utilities.backup_file_names(
+            site['sid'], 'benchmark', backup_format)
+        database_path = '{0}/{1}'.format(benchmark_dir, database_file)
+        files_path = '{0}/{1}'.format(benchmark_dir, files_file)
+        try:
+            database_time = backup_database_dump(site, database_path, backup_format)
+            files_time = backup_files_archive(site, files_path, backup_format)
+            results[backup_format] = {
+                'database_time': database_time,
+                'files_time': files_time,
+                'database_size': int(run('stat -c %s {0}'.format(database_path))),
+                'files_size': int(run('stat -c %s {0}'.format(files_path))),
+            }
+        finally:
+            run('rm -f {0} {1}'.format(database_path, files_path))
+        log.info('Backup | Benchmark | SID - %s | Format - %s | %s',
+                 site['sid'], backup_format, results[backup_format])
+    return results
+
+
+@roles('operations_server')
+def backup_restore(backup_record, new_instance):
+    """
+    Restore database and files to a new instance, once site_update has installed it.
+    """
+    log.info('Instance | Restore Backup | %s | %s', backup_record, new_instance)
+    start_time = time()
+    database_path = '{0}/backups/{1}'.format(BACKUP_PATH, backup_record['database'])
+    files_type = backup_record.get('files_type', 'archive')
+    if files_type == 'snapshot':
+        files_path = '{0}/{1}'.format(BACKUP_SNAPSHOT_PATH, backup_record['files'])
+    else:
+        files_path = '{0}/backups/{1}'.format(BACKUP_PATH, backup_record['files'])
 
     log.info('Instance | Restore Backup | New instance is ready for DB and files | %s',
              new_instance['_id'])
@@ -269,11 +600,11 @@ def backup_restore(backup_record, original_instance, package_list):
     nfs_files_dir = '{0}/{1}/files'.format(NFS_MOUNT_LOCATION[ENVIRONMENT], new_instance['sid'])
 
     with cd(nfs_files_dir):
-        run('tar -xzf {0}'.format(files_path))
+        backup_files_extract(files_path, files_type)
         log.info('Instance | Restore Backup | Files replaced')
 
     with cd(web_directory):
-        run('drush sql-cli < {0}'.format(database_path))
+        backup_database_load(database_path)
         log.info('Instance | Restore Backup | DB imported')
         run('drush cc all')
 
@@ -282,54 +613,85 @@ def backup_restore(backup_record, original_instance, package_list):
              backup_record['_id'], new_instance['_id'], new_instance['sid'], restore_time)
 
 
+def backup_stream(local_path, remote_command):
+    """
+    Stream a local backup file over SSH into the stdin of a command on the current host.
+
+    :param local_path: Path to the backup file on this server.
+    :param remote_command: Command to read the file from stdin.
+    :return: tuple of (bytes sent, seconds)
+    """
+    stage_start = time()
+    local('ssh {0} {1}@{2} \'bash -l -c "set -o pipefail; {3}"\' < {4}'.format(
+        SSH_CONTROL_OPTIONS, env.user, env.host, remote_command, local_path))
+    return os.path.getsize(local_path), time() - stage_start
+
+
 @roles('operations_server')
 def import_backup(backup, target_instance, source_env=ENVIRONMENT):
     """
-    Connect to a single applicaiton server, copy over the database and file backups to a temp
-    directory, restore them into the Drupal instance, and remove the backup files.
+    Connect to a single applicaiton server and stream the database and file backups straight into
+    the Drupal instance, without copying them to the server first. Logs the throughput of each
+    stage.
     """
     log.info('Import Backup | Backup - %s | Target Instance - %s',
              backup, target_instance)
 
     start_time = time()
 
-    # Copy db and files
-    backup_db = backup['database']
-    backup_files = backup['files']
     backup_source_path = '/nfs/{0}_backups/backups'.format(source_env)
     backup_db_path = '{0}/{1}'.format(backup_source_path, backup['database'])
     backup_files_path = '{0}/{1}'.format(backup_source_path, backup['files'])
-
-    backup_tmp_dir = '{0}/tmp'.format(BACKUP_PATH)
-    put(backup_db_path, backup_tmp_dir)
-    put(backup_files_path, backup_tmp_dir)
-
-    # Get the path for the file
-    files_path = '{0}/{1}'.format(backup_tmp_dir, backup_files)
-    database_path = '{0}/{1}'.format(backup_tmp_dir, backup_db)
-    log.debug('Import backup | File path - %s | DB path - %s', files_path, database_path)
+    log.debug('Import backup | File path - %s | DB path - %s', backup_files_path, backup_db_path)
     web_directory = '{0}/{1}'.format(WEB_ROOT, target_instance['sid'])
     nfs_files_dir = '{0}/{1}/files'.format(
         NFS_MOUNT_LOCATION[ENVIRONMENT], target_instance['sid'])
-
-    with cd(nfs_files_dir):
-        run('tar -xzf {0}'.format(files_path))
-        run('find {0} -type f -or -type d -exec chgrp {1} {{}} \\;'
-            .format(nfs_files_dir, WEBSERVER_USER_GROUP), warn_only=True)
-        run('find {0} -type f -exec chmod g+rw {{}} \\;'.format(nfs_files_dir), warn_only=True)
-        run('find {0} -type d -exec chmod g+rws {{}} \\;'.format(nfs_files_dir), warn_only=True)
-        log.debug('Instance | Restore Backup | Files replaced')
-
+    # List of (stage, bytes sent, seconds).
+    stages = []
+
+    if backup.get('files_type') == 'snapshot':
+        # Snapshots are directories, rsync them straight into the files directory.
+        snapshot_path = '/nfs/{0}_backups/{1}/{2}'.format(
+            source_env, os.path.basename(BACKUP_SNAPSHOT_PATH), backup['files'])
+        stage_start = time()
+        output = local('rsync -a --stats -e "ssh {0}" {1}/ {2}@{3}:{4}/'.format(
+            SSH_CONTROL_OPTIONS, snapshot_path, env.user, env.host, nfs_files_dir), capture=True)
+        stages.append(('files', utilities.rsync_stats(output)['bytes_sent'], time() - stage_start))
+    else:
+        files_bytes, files_time = backup_stream(backup_files_path, 'cd {0} && {1} | tar -xf -'.format(
+            nfs_files_dir, utilities.backup_decompress_command(backup_files_path)))
+        stages.append(('files', files_bytes, files_time))
+    log.debug('Instance | Restore Backup | Files replaced')
+
+    # Fix the group and permissions with as many paths as fit in each command, instead of a process
+    # per file.
+    stage_start = time()
+    run('chgrp -R {0} {1}'.format(WEBSERVER_USER_GROUP, nfs_files_dir), warn_only=True)
+    run('find {0} -type f -exec chmod g+rw {{}} +'.format(nfs_files_dir), warn_only=True)
+    run('find {0} -type d -exec chmod g+rws {{}} +'.format(nfs_files_dir), warn_only=True)
+    stages.append(('permissions', None, time() - stage_start))
+
+    database_bytes, database_time = backup_stream(backup_db_path, 'cd {0} && {1} | drush sql-cli'.format(
+        web_directory, utilities.backup_decompress_command(backup_db_path)))
+    stages.append(('database', database_bytes, database_time))
+    log.debug('Instance | Restore Backup | DB imported')
+
+    stage_start = time()
     with cd(web_directory):
-        run('drush sql-cli < {0}'.format(database_path))
-        log.debug('Instance | Restore Backup | DB imported')
         with settings(warn_only=True):
             run('drush rr')
         run('drush elysia-cron run --ignore-time')
         run('drush xmlsitemap-regenerate')
-
-    run('rm {0}'.format(files_path))
-    run('rm {0}'.format(database_path))
+    stages.append(('drush', None, time() - stage_start))
+
+    for stage, stage_bytes, stage_time in stages:
+        if stage_bytes is None:
+            log.info('Atlas operational statistic | Import Backup | Target Instance - %s | Stage - %s | Time - %.1f sec',
+                     target_instance['sid'], stage, stage_time)
+        else:
+            log.info('Atlas operational statistic | Import Backup | Target Instance - %s | Stage - %s | Time - %.1f sec | Size - %.1f MB | Throughput - %.1f MB/s',
+                     target_instance['sid'], stage, stage_time, stage_bytes / float(1 << 20),
+                     stage_bytes / float(1 << 20) / max(stage_time, 0.001))
 
     restore_time = time() - start_time
     log.info('Import Backup | Complete | Target Instance - %s (%s) | %s sec',
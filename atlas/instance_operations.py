@@ -15,12 +15,15 @@
     # Backup - Remote - Create a database and NFS files backup of the instance.
     # Restore - Local - Restore files on an new instance; Remote - Restore database on instance.
 """
+import fcntl
+import json
 import logging
 import os
 import re
 import stat
 
 from grp import getgrnam
+from hashlib import sha1
 from shutil import copyfile, rmtree
 from pwd import getpwuid
 
@@ -28,16 +31,19 @@ from jinja2 import Environment, PackageLoader
 
 from atlas import utilities
 from atlas.config import (ENVIRONMENT, INSTANCE_ROOT, WEB_ROOT, CORE_WEB_ROOT_SYMLINKS,
-                          NFS_MOUNT_FILES_DIR, NFS_MOUNT_LOCATION, SAML_AUTH,
+                          NFS_MOUNT_FILES_DIR, NFS_MOUNT_LOCATION, SAML_AUTH, PROTECTED_PATHS,
                           SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD, VARNISH_CONTROL_KEY,
                           SMTP_PASSWORD, WEBSERVER_USER_GROUP, ATLAS_LOCATION, SITE_DOWN_PATH,
-                          SSH_USER, SERVICENOW_KEY, EXPRESS_SITE_METRICS_SECRET)
+                          SSH_USER, SERVICENOW_KEY, EXPRESS_SITE_METRICS_SECRET, WEB_ROOT_INDEX)
 from atlas.config_servers import (SERVERDEFS, ATLAS_LOGGING_URLS, API_URLS,
                                   VARNISH_CONTROL_TERMINALS, BASE_URLS)
 
 # Setup a sub-logger. See tasks.py for longer comment.
 log = logging.getLogger('atlas.instance_operations')
 
+# Matches the name of a directory that contains a Drupal core.
+CORE_DIRECTORY_PATTERN = re.compile('((drupal)\-([\d\.x]+\-*[dev|alph|beta|rc|pl]*[\d]*))$i')
+
 
 def instance_create(instance, nfs_preserve=False):
     """Create symlink structure, settings file, and NFS space for an instance.
@@ -95,6 +101,8 @@ def instance_create(instance, nfs_preserve=False):
     utilities.relative_symlink(instance_code_path_current, instance_web_path_sid)
     if instance['status'] in ['launched', 'launching']:
         switch_web_root_symlinks(instance)
+    else:
+        web_root_index_update(instance['sid'], web_root_paths(instance))
     # Correct file permissions
     correct_fs_permissions(instance)
 
@@ -138,6 +146,8 @@ def instance_delete(instance, nfs_preserve=False):
         # Check if it exists
         if os.access(directory, os.F_OK):
             rmtree(directory)
+    # Remove the instance from the web root index, and any base directories it leaves empty.
+    web_root_index_update(instance['sid'], [])
 
 
 def switch_core(instance):
@@ -151,8 +161,8 @@ def switch_core(instance):
     # Setup variables
     core_path = utilities.code_path(core)
     instance_code_path_sid = '{0}/{1}/{1}'.format(INSTANCE_ROOT, instance['sid'])
-    # Get a list of files in the Core source directory
-    core_files = os.listdir(core_path)
+    # Get the linkable files in the Core source directory, ignored files are already filtered out.
+    core_manifest = utilities.get_code_manifest(core)
     # Get a list of files in the Instance target directory
     instance_files = os.listdir(instance_code_path_sid)
     # Remove any existing symlinks to a core.
@@ -165,15 +175,12 @@ def switch_core(instance):
             # Get the name of the directory that contains the symlink target
             code_dir = os.path.dirname(symlink_target)
             # Check to see if the directory is a Drupal core, if so remove the symlink.
-            regex = '((drupal)\-([\d\.x]+\-*[dev|alph|beta|rc|pl]*[\d]*))$i'
-            if re.match(regex, code_dir):
+            if CORE_DIRECTORY_PATTERN.match(code_dir):
                 os.remove(full_path)
     # Iterate through the source files and symlink when applicable.
-    for core_file in core_files:
+    for core_file in core_manifest['files']:
         if core_file in ['sites', 'profiles']:
             continue
-        if utilities.ignore_code_file(core_file):
-            continue
         source_path = core_path + '/' + core_file
         destination_path = instance_code_path_sid + '/' + core_file
         # Remove existing symlink and add new one.
@@ -204,8 +211,7 @@ def switch_core(instance):
     copyfile(source_path, destination_path)
     # Include links to the profiles that we are not using so that the site doesn't white screen if
     # the deployed profile gets disabled.
-    core_profiles = os.listdir(core_path + '/profiles')
-    for core_profile in core_profiles:
+    for core_profile in core_manifest['profiles']:
         source_path = core_path + '/profiles/' + core_profile
         destination_path = instance_code_path_sid + '/profiles/' + core_profile
         if os.path.islink(destination_path):
@@ -238,35 +244,46 @@ def switch_profile(instance):
 
 
 def switch_packages(instance):
-    """Switch Package symlinks, if no package symlinks are present add them.
+    """Switch Package symlinks so they match the instance record. Only the links that changed are
+    removed or added.
 
     Arguments:
         instance {dict} -- full instance record
+
+    Returns:
+        dict -- 'added' and 'removed' lists of link paths
     """
     log.info('Instance | Switch package | Instance - %s', instance['sid'])
     log.debug('Instance | Switch package | Instance - %s', instance)
     instance_code_path_sid = '{0}/{1}/{1}'.format(INSTANCE_ROOT, instance['sid'])
-    # Get rid of old symlinks
-    # List sites/all/{modules|themes|libraries} and remove all symlinks
+    # Build the desired set of links, lookup all packages with a single request.
+    desired_links = {}
+    if instance['code'].get('package'):
+        packages = utilities.get_code_items(instance['code']['package'])
+        for package in packages.values():
+            package_type_path = utilities.code_type_directory_name(package['meta']['code_type'])
+            destination_path = instance_code_path_sid + '/sites/all/' + \
+                package_type_path + '/' + package['meta']['name']
+            desired_links[destination_path] = utilities.relative_symlink_target(
+                utilities.code_path(package), destination_path)
+    changes = {'added': [], 'removed': []}
+    # List sites/all/{modules|themes|libraries} and remove symlinks that we do not want.
     for package_type_path in ['modules', 'themes', 'libraries']:
         package_path = instance_code_path_sid + '/sites/all/' + package_type_path
-        log.debug('Instance | Switch Packages | listdir - %s', os.listdir(package_path))
         for item in os.listdir(package_path):
             # Get full path of item
             path = package_path + '/' + item
-            log.debug('Instance | Switch Packages | Item to unlink - %s', path)
-            if os.path.islink(path):
+            if os.path.islink(path) and desired_links.get(path) != os.readlink(path):
+                log.debug('Instance | Switch Packages | Item to unlink - %s', path)
                 os.remove(path)
-    if 'package' in instance['code']:
-        for item in instance['code']['package']:
-            package = utilities.get_single_eve('code', item)
-            package_path = utilities.code_path(package)
-            package_type_path = utilities.code_type_directory_name(package['meta']['code_type'])
-            destination_path = instance_code_path_sid + '/sites/all/' + \
-                package_type_path + '/' + package['meta']['name']
-            # Add new relative symlink
-            if not os.access(destination_path, os.F_OK):
-                utilities.relative_symlink(package_path, destination_path)
+                changes['removed'].append(path)
+    # Add the missing links.
+    for destination_path, target in sorted(desired_links.items()):
+        if not os.path.lexists(destination_path):
+            os.symlink(target, destination_path)
+            changes['added'].append(destination_path)
+    log.info('Instance | Switch package | Instance - %s | Changes - %s', instance['sid'], changes)
+    return changes
 
 
 def switch_settings_files(instance):
@@ -283,6 +300,27 @@ def switch_settings_files(instance):
     # Check to see if file exists and is writable.
     utilities.file_accessable_and_writable(file_destination)
 
+    render = render_settings_file(instance)
+    # Remove the existing file.
+    if os.access(file_destination, os.F_OK):
+        os.remove(file_destination)
+    # Write the render to a file.
+    with open(file_destination, "wb") as open_file:
+        open_file.write(render)
+    # Set file permissions
+    # Octet mode, Python 3 compatible
+    os.chmod(file_destination, 0o444)
+
+
+def render_settings_file(instance):
+    """Render settings.php for an instance from the template.
+
+    Arguments:
+        instance {dict} -- full instance record
+
+    Returns:
+        string -- rendered settings file
+    """
     # Setup variables
     if instance['settings'].get('siteimprove_site'):
         siteimprove_site = instance['settings']['siteimprove_site']
@@ -352,16 +390,7 @@ def switch_settings_files(instance):
     # We don't do autoescaping, because there is no PHP support.
     jinja_env = Environment(loader=PackageLoader('atlas', 'templates'))
     template = jinja_env.get_template('settings.php')
-    render = template.render(settings_variables)
-    # Remove the existing file.
-    if os.access(file_destination, os.F_OK):
-        os.remove(file_destination)
-    # Write the render to a file.
-    with open(file_destination, "wb") as open_file:
-        open_file.write(render)
-    # Set file permissions
-    # Octet mode, Python 3 compatible
-    os.chmod(file_destination, 0o444)
+    return template.render(settings_variables)
 
 
 def correct_fs_permissions(instance):
@@ -430,38 +459,83 @@ def correct_fs_permissions(instance):
                     os.chown(file, -1, group.gr_gid)
 
 
-def sync_instances(sid=None):
+def sync_instances(sid=None, web_root_paths=None):
     """Copy the instance files to all of the relevant nodes.
 
     Keyword Arguments:
         sid {string} -- p1 sid for an instance (default: {None})
+        web_root_paths {list} -- Only sync these WEB_ROOT relative paths and the web root index
+        instead of all of WEB_ROOT (default: {None})
     """
 
-    log.info('Instances | Sync | id - %s', sid)
-    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
+    log.info('Instances | Sync | id - %s | Web root paths - %s', sid, web_root_paths)
+    hosts = sync_hosts()
     # Sync INSTANCE_ROOT then WEB_ROOT
     if sid:
-        sid_local_instance_root = INSTANCE_ROOT + '/' + sid
-        sid_instance_root = INSTANCE_ROOT + '/' + sid
-        utilities.sync(sid_local_instance_root, hosts, sid_instance_root, exclude='opcache')
+        utilities.sync(instance_root_path(sid), hosts, instance_root_path(sid), exclude='opcache')
     else:
         utilities.sync(INSTANCE_ROOT, hosts, INSTANCE_ROOT, exclude='opcache')
-    sync_web_root()
+    if web_root_paths is None:
+        sync_web_root()
+    else:
+        sync_web_root_paths(web_root_paths)
 
 
 def sync_web_root():
     """Copy web root symlinks and directories to the relevant nodes.
     """
     log.info('Instances | Sync | Web root')
-    hosts = SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
-    utilities.sync(WEB_ROOT, hosts, WEB_ROOT, exclude='opcache')
+    utilities.sync(WEB_ROOT, sync_hosts(), WEB_ROOT, exclude='opcache')
+
+
+def sync_instances_batch(sids, web_root_paths):
+    """Copy the files for several instances to all of the relevant nodes in one pass.
+
+    Arguments:
+        sids {list} -- p1 sids for the instances
+        web_root_paths {list} -- WEB_ROOT relative paths that changed for the instances
+    """
+    log.info('Instances | Sync | Batch - %s', sids)
+    utilities.sync_paths(INSTANCE_ROOT, sids, sync_hosts(), INSTANCE_ROOT, recursive=True,
+                         exclude='opcache')
+    sync_web_root_paths(web_root_paths)
+
+
+def sync_web_root_paths(paths):
+    """Copy specific web root paths and the web root index to the relevant nodes. Paths that no
+    longer exist locally are removed from the nodes.
+
+    Arguments:
+        paths {list} -- WEB_ROOT relative paths
+    """
+    log.info('Instances | Sync | Web root paths - %s', paths)
+    hosts = sync_hosts()
+    if paths:
+        utilities.sync_paths(WEB_ROOT, paths, hosts, WEB_ROOT)
+    utilities.sync_paths(os.path.dirname(WEB_ROOT_INDEX), [os.path.basename(WEB_ROOT_INDEX)],
+                         hosts, os.path.dirname(WEB_ROOT_INDEX))
+
+
+def sync_hosts():
+    """List the hosts that instance files are copied to.
+    """
+    return SERVERDEFS[ENVIRONMENT]['webservers'] + SERVERDEFS[ENVIRONMENT]['operations_server']
+
+
+def instance_root_path(sid):
+    """Path to the directory in INSTANCE_ROOT for an instance.
+    """
+    return '{0}/{1}'.format(INSTANCE_ROOT, sid)
 
 
 def switch_web_root_symlinks(instance):
-    """Create symlinks in web root
+    """Create symlinks in web root and update the web root index.
 
     Arguments:
         instance {dict} -- instance object
+
+    Returns:
+        list -- WEB_ROOT relative paths that changed, including removed empty directories
     """
     log.info('Instances | Launch | Instance - %s', instance['_id'])
     instance_code_path_current = '{0}/{1}/current'.format(INSTANCE_ROOT, instance['sid'])
@@ -492,13 +566,18 @@ def switch_web_root_symlinks(instance):
                     utilities.relative_symlink(
                         instance_code_path_current, web_directory_path)
         elif instance['path'] == 'homepage':
-            for link in CORE_WEB_ROOT_SYMLINKS:
+            # Only link the paths that the core actually provides.
+            core = utilities.get_single_eve('code', instance['code']['core'])
+            core_manifest = utilities.get_code_manifest(core)
+            for link in [l for l in CORE_WEB_ROOT_SYMLINKS if l in core_manifest['files']]:
                 source_path = "{0}/{1}".format(instance_code_path_current, link)
                 target_path = "{0}/{1}".format(WEB_ROOT, link)
                 if os.access(target_path, os.F_OK) and os.path.islink(target_path):
                     os.remove(target_path)
                 utilities.relative_symlink(source_path, target_path)
 
+    return web_root_index_update(instance['sid'], web_root_paths(instance))
+
 
 def switch_homepage_files():
     """Replace robots.txt and .htaccess for the homepage
@@ -509,3 +588,372 @@ def switch_homepage_files():
         if os.access(file[1], os.F_OK):
             os.remove(file[1])
         copyfile(file[0], file[1])
+
+
+def instance_layout(instance, code_items=None):
+    """Compute the structure we expect on disk for an instance from its record and code items.
+
+    Arguments:
+        instance {dict} -- full instance record
+
+    Keyword Arguments:
+        code_items {dict} -- code items keyed by '_id', looked up if not provided (default: {None})
+
+    Returns:
+        dict -- 'links' {link path: target}, 'directories' [paths], 'files' {path: source path},
+        'link_directories' [directories where every symlink should be in 'links'], and
+        'settings_hash' sha1 of the rendered settings file.
+    """
+    instance_code_path = '{0}/{1}'.format(INSTANCE_ROOT, instance['sid'])
+    instance_code_path_sid = '{0}/{1}'.format(instance_code_path, instance['sid'])
+    instance_code_path_current = '{0}/current'.format(instance_code_path)
+    # Lookup all of the code for the instance with a single request.
+    code_ids = [instance['code']['core'], instance['code']['profile']]
+    if 'package' in instance['code']:
+        code_ids += instance['code']['package']
+    if code_items is None:
+        code_items = utilities.get_code_items(code_ids)
+    core = code_items[str(instance['code']['core'])]
+    core_path = utilities.code_path(core)
+    core_manifest = utilities.get_code_manifest(core)
+    profile = code_items[str(instance['code']['profile'])]
+
+    links = {}
+    directories = [instance_code_path_sid]
+    for directory in ['sites', 'sites/all', 'sites/all/modules', 'sites/all/libraries',
+                      'sites/all/themes', 'sites/default', 'profiles']:
+        directories.append(instance_code_path_sid + '/' + directory)
+    # Core
+    for core_file in core_manifest['files']:
+        if core_file in ['sites', 'profiles']:
+            continue
+        destination_path = instance_code_path_sid + '/' + core_file
+        links[destination_path] = utilities.relative_symlink_target(
+            core_path + '/' + core_file, destination_path)
+    for core_profile in core_manifest['profiles']:
+        destination_path = instance_code_path_sid + '/profiles/' + core_profile
+        links[destination_path] = utilities.relative_symlink_target(
+            core_path + '/profiles/' + core_profile, destination_path)
+    # Profile
+    destination_path = instance_code_path_sid + '/profiles/' + profile['meta']['name']
+    links[destination_path] = utilities.relative_symlink_target(
+        utilities.code_path(profile), destination_path)
+    # Packages
+    for package_id in instance['code'].get('package', []):
+        package = code_items[str(package_id)]
+        destination_path = '{0}/sites/all/{1}/{2}'.format(
+            instance_code_path_sid,
+            utilities.code_type_directory_name(package['meta']['code_type']),
+            package['meta']['name'])
+        links[destination_path] = utilities.relative_symlink_target(
+            utilities.code_path(package), destination_path)
+    # Files directory
+    if NFS_MOUNT_FILES_DIR:
+        nfs_files_dir = NFS_MOUNT_LOCATION[ENVIRONMENT] + '/' + instance['sid']
+        directories += [nfs_files_dir, nfs_files_dir + '/files', nfs_files_dir + '/tmp']
+        links[instance_code_path_sid + '/sites/default/files'] = nfs_files_dir + '/files'
+    else:
+        directories.append(instance_code_path_sid + '/sites/default/files')
+    # Current and web root
+    links[instance_code_path_current] = utilities.relative_symlink_target(
+        instance_code_path_sid, instance_code_path_current)
+    for web_path in web_root_paths(instance, core_manifest):
+        target_path = '{0}/{1}'.format(WEB_ROOT, web_path)
+        if web_path in [instance['sid'], instance['path']]:
+            source_path = instance_code_path_current
+        else:
+            # Homepage core links
+            source_path = '{0}/{1}'.format(instance_code_path_current, web_path)
+        links[target_path] = utilities.relative_symlink_target(source_path, target_path)
+
+    files = {
+        instance_code_path_sid + '/sites/default/default.settings.php':
+            core_path + '/sites/default/default.settings.php'
+    }
+    link_directories = [instance_code_path_sid,
+                        instance_code_path_sid + '/profiles',
+                        instance_code_path_sid + '/sites/all/modules',
+                        instance_code_path_sid + '/sites/all/themes',
+                        instance_code_path_sid + '/sites/all/libraries']
+
+    return {
+        'links': links,
+        'directories': directories,
+        'files': files,
+        'link_directories': link_directories,
+        'settings_hash': sha1(render_settings_file(instance).encode('utf-8')).hexdigest(),
+    }
+
+
+def instance_diff(instance, layout=None):
+    """Compare the structure on disk for an instance with the layout we expect. Does not modify
+    anything.
+
+    Arguments:
+        instance {dict} -- full instance record
+
+    Keyword Arguments:
+        layout {dict} -- expected layout, computed if not provided (default: {None})
+
+    Returns:
+        list -- differences, each a dict with 'issue', 'path' and, where relevant, 'expected'
+        and 'actual'.
+    """
+    instance_code_path_sid = '{0}/{1}/{1}'.format(INSTANCE_ROOT, instance['sid'])
+    if not os.path.isdir(instance_code_path_sid):
+        return [{'issue': 'missing_instance', 'path': instance_code_path_sid}]
+    if layout is None:
+        layout = instance_layout(instance)
+
+    differences = []
+    for directory in layout['directories']:
+        if not os.path.isdir(directory):
+            differences.append({'issue': 'missing_directory', 'path': directory})
+    for path, target in sorted(layout['links'].items()):
+        if os.path.islink(path):
+            actual = os.readlink(path)
+            if actual != target:
+                differences.append(
+                    {'issue': 'wrong_link', 'path': path, 'expected': target, 'actual': actual})
+        elif os.path.lexists(path):
+            differences.append({'issue': 'not_a_link', 'path': path, 'expected': target})
+        else:
+            differences.append({'issue': 'missing_link', 'path': path, 'expected': target})
+    for directory in layout['link_directories']:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.listdir(directory):
+            path = directory + '/' + entry
+            if os.path.islink(path) and path not in layout['links']:
+                differences.append({'issue': 'stale_link', 'path': path, 'actual': os.readlink(path)})
+    for path, source in layout['files'].items():
+        if not os.path.isfile(path):
+            differences.append({'issue': 'missing_file', 'path': path, 'expected': source})
+    settings_file = instance_code_path_sid + '/sites/default/settings.php'
+    try:
+        with open(settings_file, 'rb') as open_file:
+            actual_hash = sha1(open_file.read()).hexdigest()
+    except IOError:
+        actual_hash = None
+    if actual_hash != layout['settings_hash']:
+        differences.append({'issue': 'stale_settings', 'path': settings_file,
+                            'expected': layout['settings_hash'], 'actual': actual_hash})
+
+    log.debug('Instance | Diff | Instance - %s | Differences - %s', instance['sid'], differences)
+    return differences
+
+
+# Order in which differences are repaired, directories need to exist before we link into them.
+HEAL_ORDER = ['missing_directory', 'stale_link', 'wrong_link', 'missing_link', 'missing_file',
+              'stale_settings', 'not_a_link']
+
+
+def instance_heal(instance):
+    """Repair only the parts of an instance that differ from the expected layout. If the instance
+    directory does not exist at all, create the instance.
+
+    Arguments:
+        instance {dict} -- full instance record
+
+    Returns:
+        dict -- report with '_id', 'sid', 'result' ('correct', 'repaired', or 'created'),
+        'differences', 'unrepaired' differences, and the 'web_root_paths' that changed.
+    """
+    log.info('Instance | Heal | Instance - %s', instance['sid'])
+    report = {'_id': str(instance['_id']), 'sid': instance['sid'], 'unrepaired': [],
+              'web_root_paths': []}
+    differences = instance_diff(instance)
+    report['differences'] = differences
+    # Instances created before the web root index existed are not in it yet, record their paths.
+    # Creating an instance records them itself.
+    if not differences or differences[0]['issue'] != 'missing_instance':
+        paths = web_root_paths(instance)
+        indexed_paths = [path for path, owner in web_root_index_load().items()
+                         if owner == instance['sid']]
+        if sorted(indexed_paths) != sorted(paths):
+            log.info('Instance | Heal | Instance - %s | Web root index - %s', instance['sid'], paths)
+            report['web_root_paths'] += web_root_index_update(instance['sid'], paths)
+    if not differences:
+        report['result'] = 'correct'
+        log.info('Instance | Heal | Instance - %s | Correct', instance['sid'])
+        return report
+    if differences[0]['issue'] == 'missing_instance':
+        instance_create(instance, nfs_preserve=True)
+        report['result'] = 'created'
+        report['web_root_paths'] = web_root_paths(instance)
+        return report
+
+    for difference in sorted(differences, key=lambda d: HEAL_ORDER.index(d['issue'])):
+        log.info('Instance | Heal | Instance - %s | Repair - %s', instance['sid'], difference)
+        path = difference['path']
+        if difference['issue'] == 'missing_directory':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        elif difference['issue'] == 'stale_link':
+            os.remove(path)
+        elif difference['issue'] in ['wrong_link', 'missing_link']:
+            if os.path.islink(path):
+                os.remove(path)
+            # Multipart paths in the web root need their base directories.
+            if not os.access(os.path.dirname(path), os.F_OK):
+                os.makedirs(os.path.dirname(path))
+            os.symlink(difference['expected'], path)
+        elif difference['issue'] == 'missing_file':
+            copyfile(difference['expected'], path)
+        elif difference['issue'] == 'stale_settings':
+            switch_settings_files(instance)
+        else:
+            # We never remove real files or directories during a heal.
+            log.error('Instance | Heal | Instance - %s | Cannot repair - %s',
+                      instance['sid'], difference)
+            report['unrepaired'].append(difference)
+            continue
+        if path.startswith(WEB_ROOT + '/'):
+            report['web_root_paths'].append(os.path.relpath(path, WEB_ROOT))
+    correct_fs_permissions(instance)
+    report['result'] = 'repaired'
+    return report
+
+
+def find_orphans(instances):
+    """List directories and links in INSTANCE_ROOT and WEB_ROOT that do not belong to an instance
+    record. Does not modify anything.
+
+    Arguments:
+        instances {list} -- all instance records
+
+    Returns:
+        dict -- 'instance_root' and 'web_root' lists of orphaned paths
+    """
+    sids = set(instance['sid'] for instance in instances)
+    # Multipart paths are rooted at their first segment.
+    paths = set(instance['path'].split('/')[0] for instance in instances)
+    web_root_known = sids | paths | set(CORE_WEB_ROOT_SYMLINKS) | set(PROTECTED_PATHS) | set(
+        ['.htaccess', 'robots.txt'])
+    orphans = {'instance_root': [], 'web_root': []}
+    if os.path.isdir(INSTANCE_ROOT):
+        index_files = [os.path.basename(WEB_ROOT_INDEX), os.path.basename(WEB_ROOT_INDEX) + '.lock']
+        orphans['instance_root'] = sorted(
+            instance_root_path(entry) for entry in os.listdir(INSTANCE_ROOT)
+            if entry not in sids and entry not in index_files)
+    if os.path.isdir(WEB_ROOT):
+        orphans['web_root'] = sorted('{0}/{1}'.format(WEB_ROOT, entry)
+                                     for entry in os.listdir(WEB_ROOT) if entry not in web_root_known)
+    log.info('Instances | Orphans | %s', orphans)
+    return orphans
+
+
+def web_root_paths(instance, core_manifest=None):
+    """List the WEB_ROOT relative paths that an instance owns in its current status.
+
+    Arguments:
+        instance {dict} -- full instance record
+
+    Keyword Arguments:
+        core_manifest {dict} -- manifest of the instance core, looked up for launched homepage
+        instances if not provided (default: {None})
+    """
+    paths = []
+    if instance['status'] not in ['take_down', 'down']:
+        paths.append(instance['sid'])
+    if instance['status'] in ['launched', 'launching']:
+        if instance['path'] == 'homepage':
+            if core_manifest is None:
+                core = utilities.get_single_eve('code', instance['code']['core'])
+                core_manifest = utilities.get_code_manifest(core)
+            paths += [l for l in CORE_WEB_ROOT_SYMLINKS if l in core_manifest['files']]
+        elif instance['path'] != instance['sid']:
+            paths.append(instance['path'])
+    return paths
+
+
+def web_root_index_load():
+    """Load the web root index, a dict of WEB_ROOT relative path to the sid that owns it.
+    """
+    try:
+        with open(WEB_ROOT_INDEX) as index_file:
+            return json.load(index_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def web_root_index_update(sid, paths):
+    """Replace the web root index entries for an instance, remove the links it no longer owns, and
+    remove base directories of multipart paths that are left empty.
+
+    Arguments:
+        sid {string} -- sid of the instance
+        paths {list} -- WEB_ROOT relative paths the instance now owns
+
+    Returns:
+        list -- WEB_ROOT relative paths that changed, including removed empty directories
+    """
+    # Several workers can update the index at the same time.
+    with open(WEB_ROOT_INDEX + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        index = web_root_index_load()
+        previous_paths = set(path for path, owner in index.items() if owner == sid)
+        for path in previous_paths:
+            del index[path]
+        for path in paths:
+            index[path] = sid
+        # Write to a temporary file and rename it so that readers never see a partial index.
+        with open(WEB_ROOT_INDEX + '.tmp', 'w') as index_file:
+            json.dump(index, index_file, separators=(',', ':'))
+        os.rename(WEB_ROOT_INDEX + '.tmp', WEB_ROOT_INDEX)
+    changed = previous_paths.symmetric_difference(paths)
+    # Remove links the instance no longer owns, without scanning the web root.
+    for path in previous_paths - set(paths):
+        if os.path.islink('{0}/{1}'.format(WEB_ROOT, path)):
+            os.remove('{0}/{1}'.format(WEB_ROOT, path))
+        changed.update(remove_empty_web_root_directories(path))
+    log.info('Instances | Web root index | sid - %s | Paths - %s | Changed - %s',
+             sid, paths, sorted(changed))
+    return sorted(changed)
+
+
+def remove_empty_web_root_directories(path):
+    """Remove the base directories of a multipart WEB_ROOT path if they are empty.
+
+    Arguments:
+        path {string} -- WEB_ROOT relative path
+
+    Returns:
+        list -- WEB_ROOT relative directories that were removed
+    """
+    removed = []
+    base_path = os.path.dirname(path)
+    while base_path:
+        directory = '{0}/{1}'.format(WEB_ROOT, base_path)
+        if os.path.islink(directory) or not os.path.isdir(directory) or os.listdir(directory):
+            break
+        os.rmdir(directory)
+        removed.append(base_path)
+        base_path = os.path.dirname(base_path)
+    return removed
+
+
+def web_root_collision(path, sid=None):
+    """Check the web root index for an instance that already owns a path, one of its base
+    directories, or a path below it.
+
+    Arguments:
+        path {string} -- WEB_ROOT relative path
+
+    Keyword Arguments:
+        sid {string} -- sid that is allowed to own the path (default: {None})
+
+    Returns:
+        string -- sid of the instance that owns the path, None if the path is free
+    """
+    index = web_root_index_load()
+    parts = path.split('/')
+    for depth in range(1, len(parts) + 1):
+        owner = index.get('/'.join(parts[:depth]))
+        if owner and owner != sid:
+            return owner
+    prefix = path + '/'
+    for indexed_path, owner in index.iteritems():
+        if owner != sid and indexed_path.startswith(prefix):
+            return owner
+    return None
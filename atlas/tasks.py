@@ -9,11 +9,12 @@ import json
 
 from datetime import datetime, timedelta
 from collections import Counter
+from hashlib import sha1
 from bson import json_util
 from math import ceil
 from random import randint
 import requests
-from celery import Celery, chord
+from celery import Celery, chord, group
 from celery.utils.log import get_task_logger
 from fabric.api import execute
 from git import GitCommandError
@@ -21,8 +22,16 @@ from git import GitCommandError
 from atlas import fabric_tasks, utilities, config_celery
 from atlas import code_operations, instance_operations, backup_operations
 from atlas.config import (ENVIRONMENT, WEBSERVER_USER, DESIRED_SITE_COUNT, EMAIL_HOST,
-                          SSL_VERIFICATION, CODE_ROOT, BACKUPS_LARGE_INSTANCES, DEFAULT_PROFILE)
+                          SSL_VERIFICATION, CODE_ROOT, BACKUPS_LARGE_INSTANCES, DEFAULT_PROFILE,
+                          DEFAULT_CORE,
+                          CODE_HEAL_GIT_CONCURRENCY, DRUSH_BATCH_SIZE, DRUSH_BATCH_PARALLEL,
+                          DRUSH_BATCH_TIME_LIMIT, CLI_HOST_WAIT,
+                          CRON_SPREAD_FRACTION, CRON_ADAPTIVE_STATUSES, CRON_ADAPTIVE_TIERS,
+                          CRON_ADAPTIVE_EXCLUDE_PATHS,
+                          BACKUP_LARGE_DURATION, BACKUP_BENCHMARK_INSTANCES, BACKUP_RETRY_COUNTDOWN,
+                          BACKUP_RETRIES)
 from atlas.config_servers import (BASE_URLS, API_URLS)
+from atlas.data_structure import SITES_SCHEMA
 
 # Setup a sub-logger
 # Best practice is to setup sub-loggers rather than passing the main logger between different parts of the application.
@@ -129,14 +138,21 @@ def code_deploy(item):
     :return:
     """
     log.debug('Code deploy | %s', item)
+    errors = []
     try:
-        clone = code_operations.repository_clone(item)
+        code_operations.repository_clone(item)
     except GitCommandError:
         log.error('Code | Clone | Cannot clone repository, check URL.')
+        errors.append('Cannot clone repository, check URL.')
+    checked_out = False
     try:
-        checkout = code_operations.repository_checkout(item)
+        code_operations.repository_checkout(item)
     except GitCommandError:
         log.error('Code | Checkout | Cannot checkout requested tag, check value.')
+        errors.append('Cannot checkout requested tag, check value.')
+    else:
+        code_operations.write_manifest(item)
+        checked_out = True
 
     if item['meta']['is_current']:
         code_operations.update_symlink_current(item)
@@ -145,9 +161,22 @@ def code_deploy(item):
     if item['meta']['code_type'] == 'static':
         code_operations.deploy_static(item)
 
-    sync = code_operations.sync_code()
+    # Static items are served directly from the checkout and need files that artifacts leave out.
+    if item['meta']['code_type'] == 'static':
+        code_operations.sync_code(item)
+    elif not checked_out:
+        # There is no commit to build an artifact from.
+        log.error('Code deploy | Artifact | Skipped, checkout failed | Item - %s', item['_id'])
+        errors.append('Artifact not deployed, the checkout failed.')
+    else:
+        results = code_operations.deploy_artifact(item)
+        failed_hosts = sorted(host for host, result in results.items() if result == 'failed')
+        if failed_hosts:
+            errors.append('Artifact failed on {0}'.format(', '.join(failed_hosts)))
+        else:
+            _database_templates_queue(item)
 
-    if clone or sync:
+    if errors:
         text = 'Error'
         slack_color = 'danger'
     else:
@@ -191,8 +220,8 @@ def code_deploy(item):
         "user": item['created_by']
     }
 
-    if clone or sync:
-        error_json = json.dumps(clone + sync)
+    if errors:
+        error_json = json.dumps(errors)
         slack_payload['attachments'].append(
             {
                 "fallback": 'Error message',
@@ -233,13 +262,24 @@ def code_update(updated_item, original_item):
 
     checkout = code_operations.repository_checkout(final_item)
     log.debug('Code deploy | Checkout | %s', checkout)
+    code_operations.write_manifest(final_item)
 
     code_operations.update_symlink_current(final_item)
 
     if final_item['meta']['code_type'] == 'static':
         code_operations.deploy_static(final_item)
 
-    sync = code_operations.sync_code()
+    if final_item['meta']['code_type'] == 'static':
+        code_operations.sync_code(final_item)
+    else:
+        code_operations.deploy_artifact(final_item)
+        # Templates for the item were installed from its previous commit.
+        if final_item['meta']['code_type'] in ['core', 'profile']:
+            utilities.remove_database_templates(final_item['_id'])
+        _database_templates_queue(final_item)
+    if utilities.code_path(final_item) != utilities.code_path(original_item):
+        # Remove the old checkout from the webservers.
+        code_operations.sync_code(original_item)
 
     slack_title = 'Code Update - Success'
     slack_color = 'good'
@@ -291,6 +331,8 @@ def code_remove(item, other_static_assets=True):
     """
 
     log.info('Code remove | %s', item)
+    if item['meta']['code_type'] != 'static':
+        code_operations.remove_artifact(item)
     code_operations.repository_remove(item)
     if item['meta']['is_current']:
         code_folder_current = '{0}/{1}/{2}/{2}-current'.format(
@@ -301,8 +343,10 @@ def code_remove(item, other_static_assets=True):
 
     if item['meta']['code_type'] == 'static':
         code_operations.remove_static(item, other_static_assets)
+    elif item['meta']['code_type'] in ['core', 'profile']:
+        utilities.remove_database_templates(item['_id'])
 
-    sync = code_operations.sync_code()
+    code_operations.sync_code(item)
 
     # Slack notification
     slack_title = 'Code Remove - Success'
@@ -348,31 +392,73 @@ def code_heal(code_items):
     Verify code is correctly deployed.
     """
     log.info('Heal | Code | Item - %s', code_items)
+    # Split the items into CODE_HEAL_GIT_CONCURRENCY lists that are healed one item at a time, so
+    # that only that many git operations run at once.
+    batches = [code_items['_items'][i::CODE_HEAL_GIT_CONCURRENCY]
+               for i in range(CODE_HEAL_GIT_CONCURRENCY)]
     # Setup a chord. Takes a 'group' (list of tasks that should be applied in parallel) and executes
-    # another task after the group is complete.
-    # In the second task, using .si creates an immutable signature so the return value of the
-    # previous tasks will be ignored.
-    task_group = chord((_code_heal.s(code) for code in code_items['_items']), _code_sync.si())()
+    # another task after the group is complete. The report task receives the list of results.
+    task_group = chord((_code_heal.s(batch) for batch in batches if batch), _code_heal_report.s())()
 
 
 @celery.task
-def _code_heal(item):
+def _code_heal(items):
     """
-    Sub task for code_heal. Perform actual heal operations
+    Sub task for code_heal. Perform actual heal operations for a list of items, one at a time.
     """
-    if not os.path.isdir(utilities.code_path(item)):
-        clone = code_operations.repository_clone(item)
-        log.debug('Code heal | Clone | %s', clone)
-    checkout = code_operations.repository_checkout(item)
-    if item['meta']['is_current']:
-        code_operations.update_symlink_current(item)
-    log.debug('Code heal | Checkout | %s', checkout)
+    results = []
+    for item in items:
+        try:
+            result = code_operations.code_heal(item)
+        except Exception as error:
+            log.error('Code heal | Item - %s | Error - %s', item['_id'], error)
+            result = 'failed'
+        results.append({'_id': item['_id'], 'name': '{0}-{1}'.format(
+            item['meta']['name'], item['meta']['version']), 'result': result})
+    return results
+
+
+@celery.task
+def _code_heal_report(results):
+    """
+    Sub task for code_heal. Sync all of the code to the servers and report the results.
+
+    :param results: List of lists of results from the heal tasks.
+    """
+    report = {'cloned': [], 'moved': [], 'correct': [], 'failed': []}
+    for result in [result for batch in results for result in batch]:
+        report[result['result']].append(result['name'])
+    log.info('Heal | Code | Report - %s', report)
+    # Always sync, code that is correct here may have drifted on the webservers.
+    _code_sync()
+
+    slack_fallback = 'Code heal - {0} cloned, {1} moved, {2} correct, {3} failed'.format(
+        len(report['cloned']), len(report['moved']), len(report['correct']), len(report['failed']))
+    slack_payload = {
+        "text": 'Code heal',
+        "attachments": [
+            {
+                "fallback": slack_fallback,
+                "color": 'danger' if report['failed'] else 'good',
+                "fields": [
+                    {"title": "Environment", "value": ENVIRONMENT, "short": True},
+                    {"title": "Already correct", "value": len(report['correct']), "short": True},
+                    {"title": "Cloned", "value": ', '.join(report['cloned']), "short": False},
+                    {"title": "Moved", "value": ', '.join(report['moved']), "short": False},
+                    {"title": "Failed", "value": ', '.join(report['failed']), "short": False}
+                ],
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+    return report
 
 
 @celery.task
 def _code_sync():
     """
-    Sub task for code_heal. Sync healed code to server
+    Sub task for code_heal. Sync healed code to server. Heal is the only time all of the code is
+    synced.
     """
     sync = code_operations.sync_code()
 
@@ -394,49 +480,46 @@ def site_provision(site):
     if site['status'] == 'pending':
         site['status'] = 'available'
 
+    # Timings for installs from a database template are kept separately so they can be compared.
+    template_path = utilities.database_template(site)
+    install_stage = 'install_template' if template_path else 'install'
+    # Provisioning stages as a dependency graph: (name, stages it depends on, function). Database
+    # creation and building the instance are independent, so they run at the same time.
+    stages = [
+        ('database', [], lambda: utilities.create_database(site['sid'], site['db_key'])),
+        # Create instance with requested core, profile, and packages.
+        ('instance_create', [], lambda: instance_operations.instance_create(site)),
+        ('sync', ['instance_create'], lambda: instance_operations.sync_instances(site['sid'])),
+        (install_stage, ['database', 'sync'],
+         lambda: _site_provision_install_stage(site, template_path)),
+        ('permissions', ['instance_create', install_stage],
+         lambda: instance_operations.correct_fs_permissions(site)),
+        ('final_sync', ['permissions'], lambda: instance_operations.sync_instances(site['sid'])),
+    ]
     try:
-        log.debug('Site provision | Create database')
-        utilities.create_database(site['sid'], site['db_key'])
+        timings = utilities.run_stages(stages)
     except Exception as error:
-        log.error('Site provision failed | Database creation failed | %s', error)
+        log.error('Site provision failed | Instance - %s | Error Message | %s', site['sid'], error)
         raise
-    # Create instance with requested core, profile, and packages.
-    try:
-        instance_operations.instance_create(site)
-    except Exception as error:
-        log.error('Site provision failed | Error Message | %s', error)
-        raise
-    # Trigger rsync
-    # ? Is a way to request a sync (w/ install chained)? Sync once when creating 5 instances
-    log.info('Instance | Provision | Rsync')
-    instance_operations.sync_instances(site['sid'])
-    # Run install
-    if site.get('install') and site['install'] is not False:
-        try:
-            execute(fabric_tasks.site_install, site=site)
-        except Exception as error:
-            log.error('Site install failed | Error Message | %s', error)
-            raise
-    # Correct file permissions
-    instance_operations.correct_fs_permissions(site)
-    instance_operations.sync_instances(site['sid'])
 
     # Update instance record
     patch_payload = {'status': site['status'],
                      'db_key': site['db_key'],
                      'statistics': site['statistics'],
-                     'install': None}
+                     'install': None,
+                     'provision_timings': timings}
     patch = utilities.patch_eve('sites', site['_id'], patch_payload)
     log.debug('Site provision | Patch | %s', patch)
 
     provision_time = time.time() - start_time
-    log.info('Atlas operational statistic | Site Provision | %s', provision_time)
+    log.info('Atlas operational statistic | Site Provision | %s | %s', provision_time, timings)
 
     # Slack notification
-    profile = utilities.get_single_eve('code', site['code']['profile'])
+    code_items = utilities.get_code_items([site['code']['profile'], site['code']['core']])
+    profile = code_items[str(site['code']['profile'])]
     profile_string = profile['meta']['name'] + '-' + profile['meta']['version']
 
-    core = utilities.get_single_eve('code', site['code']['core'])
+    core = code_items[str(site['code']['core'])]
     core_string = core['meta']['name'] + '-' + core['meta']['version']
 
     slack_title = 'Site provision - Success'
@@ -483,6 +566,257 @@ def site_provision(site):
     utilities.post_to_slack_payload(slack_payload)
 
 
+def _site_provision_install_stage(site, template_path=None):
+    """
+    Install stage for site_provision. Load the database template for the core and profile when
+    there is one, otherwise run `site-install` and queue a build of the template.
+    """
+    if not site.get('install') or site['install'] is False:
+        return
+    if template_path:
+        try:
+            execute(fabric_tasks.database_template_load, site=site, template_path=template_path)
+            return
+        except Exception as error:
+            log.error('Site install | Instance - %s | Template failed, using site-install | %s',
+                      site['sid'], error)
+    elif not site['code'].get('package'):
+        # Templates are built in a scratch instance, never from a real site's database.
+        database_template_build.delay(site['code']['core'], site['code']['profile'])
+    try:
+        execute(fabric_tasks.site_install, site=site)
+    except Exception as error:
+        log.error('Site install failed | Error Message | %s', error)
+        raise
+
+
+def _database_template_scratch(core_id, profile_id, load_template=False):
+    """
+    Install a scratch instance, that has no record, for a core and profile and dump its database as
+    the template for the pair. With `load_template` the template is then loaded into the same
+    instance, so both install paths are timed on one instance. The instance and its database are
+    removed afterwards.
+
+    :param core_id: _id of the core code item.
+    :param profile_id: _id of the profile code item.
+    :param load_template: Also time loading the template.
+    :return: dict of seconds for 'install', and 'install_template' with load_template.
+    """
+    sid = 'p1' + sha1(utilities.randomstring()).hexdigest()[0:10]
+    site = {'_id': sid, 'sid': sid, 'path': sid, 'status': 'available', 'install': True,
+            'code': {'core': core_id, 'profile': profile_id}, 'statistics': None,
+            'settings': {'page_cache_maximum_age': SITES_SCHEMA['settings']['schema'][
+                'page_cache_maximum_age']['default']},
+            'db_key': utilities.encrypt_string(utilities.mysql_password())}
+    log.info('Database template | Scratch instance | Instance - %s | Core - %s | Profile - %s',
+             sid, core_id, profile_id)
+    timings = {}
+    utilities.create_database(sid, site['db_key'])
+    try:
+        instance_operations.instance_create(site)
+        instance_operations.sync_instances_batch([sid], [sid])
+        stage_start = time.time()
+        result = execute(fabric_tasks.site_install, site=site)
+        # site_install returns the error instead of raising it.
+        errors = [value for value in result.values() if isinstance(value, Exception)]
+        if errors:
+            raise errors[0]
+        timings['install'] = time.time() - stage_start
+        execute(fabric_tasks.database_template_create, site=site)
+        if load_template:
+            stage_start = time.time()
+            execute(fabric_tasks.database_template_load, site=site,
+                    template_path=utilities.database_template_path(core_id, profile_id))
+            timings['install_template'] = time.time() - stage_start
+    finally:
+        instance_operations.instance_delete(site)
+        instance_operations.sync_instances_batch([sid], [sid])
+        utilities.delete_database(sid)
+    log.info('Database template | Scratch instance | Instance - %s | Timings - %s', sid, timings)
+    return timings
+
+
+@celery.task
+def database_template_build(core_id, profile_id):
+    """
+    Build the database template for a core and profile pair, unless there is one already or another
+    worker is building it.
+
+    :param core_id: _id of the core code item.
+    :param profile_id: _id of the profile code item.
+    """
+    if os.path.isfile(utilities.database_template_path(core_id, profile_id)):
+        return
+    try:
+        with utilities.resource_slot('template-{0}_{1}'.format(core_id, profile_id), 1, 0):
+            _database_template_scratch(core_id, profile_id)
+    except utilities.ResourceSlotTimeout:
+        log.info('Database template | Build | Core - %s | Profile - %s | Already building',
+                 core_id, profile_id)
+
+
+def _database_templates_queue(item):
+    """
+    Queue template builds for a core or profile that was deployed, paired with each current
+    profile or core.
+
+    :param item: Code item for a core or profile.
+    """
+    query = 'where={{"meta.code_type":"{0}","meta.is_current":true}}'
+    if item['meta']['code_type'] == 'core':
+        others = utilities.get_eve('code', query.format('profile'))
+        pairs = [(item['_id'], other['_id']) for other in others['_items']]
+    elif item['meta']['code_type'] == 'profile':
+        others = utilities.get_eve('code', query.format('core'))
+        pairs = [(other['_id'], item['_id']) for other in others['_items']]
+    else:
+        return
+    for core_id, profile_id in pairs:
+        log.info('Database template | Queue | Core - %s | Profile - %s', core_id, profile_id)
+        database_template_build.delay(core_id, profile_id)
+
+
+@celery.task
+def site_provision_batch(sites):
+    """
+    Provision several new instances together. Databases are created over a single connection,
+    every instance is built before one sync, and installs run in parallel.
+
+    :param sites: List of sites.
+    :return:
+    """
+    batch_id = str(time.time())
+    log.info('Site provision | Batch - %s | Sites - %s', batch_id, [site['sid'] for site in sites])
+    timings = {}
+
+    stage_start = time.time()
+    for site in sites:
+        # 'db_key' needs to be added here and not in Eve so that the encryption
+        # works properly.
+        site['db_key'] = utilities.encrypt_string(utilities.mysql_password())
+        # Set future site status for settings file creation.
+        if site['status'] == 'pending':
+            site['status'] = 'available'
+    try:
+        utilities.create_databases([(site['sid'], site['db_key']) for site in sites])
+    except Exception as error:
+        log.error('Site provision failed | Batch - %s | Database creation failed | %s',
+                  batch_id, error)
+        raise
+    timings['database'] = time.time() - stage_start
+
+    stage_start = time.time()
+    created = []
+    web_root_paths = []
+    failed = []
+    for site in sites:
+        try:
+            instance_operations.instance_create(site)
+        except Exception as error:
+            _site_provision_failed(site, batch_id, error)
+            failed.append(site['sid'])
+            continue
+        created.append(site)
+        web_root_paths += instance_operations.web_root_paths(site)
+    timings['instance_create'] = time.time() - stage_start
+    if not created:
+        log.error('Site provision failed | Batch - %s | No instances were created', batch_id)
+        return
+
+    stage_start = time.time()
+    instance_operations.sync_instances_batch([site['sid'] for site in created], web_root_paths)
+    timings['sync'] = time.time() - stage_start
+
+    log.info('Site provision | Batch - %s | Timings - %s', batch_id, timings)
+    # The finish task receives the list of sites from the install tasks.
+    task_group = chord((_site_provision_install.s(site, batch_id) for site in created),
+                       _site_provision_batch_finish.s(batch_id, timings, time.time(), failed))()
+
+
+def _site_provision_failed(site, batch_id, error):
+    """
+    Remove a site that failed to provision in a batch. Deleting the record removes its database and
+    files, see `callbacks.pre_delete_sites`.
+    """
+    log.error('Site provision failed | Batch - %s | Instance - %s | Error Message | %s',
+              batch_id, site['sid'], error)
+    utilities.delete_eve('sites', site['_id'])
+
+
+@celery.task
+def _site_provision_install(site, batch_id):
+    """
+    Sub task for site_provision_batch. Install a single instance and correct its permissions.
+
+    :return: The site, or {'failed': sid} if the install failed.
+    """
+    try:
+        _site_provision_install_stage(site, utilities.database_template(site))
+        instance_operations.correct_fs_permissions(site)
+    except Exception as error:
+        _site_provision_failed(site, batch_id, error)
+        return {'failed': site['sid']}
+    return site
+
+
+@celery.task
+def _site_provision_batch_finish(sites, batch_id, timings, install_start, failed):
+    """
+    Sub task for site_provision_batch. Sync the installed instances once and update the records.
+
+    :param sites: List of sites from the install tasks.
+    :param batch_id: Identifier for this batch.
+    :param timings: Time in seconds for each of the earlier stages.
+    :param install_start: Time the install stage started.
+    :param failed: sids of the sites that failed before the install stage.
+    """
+    timings['install'] = time.time() - install_start
+    failed = failed + [site['failed'] for site in sites if 'failed' in site]
+    sites = [site for site in sites if 'failed' not in site]
+
+    stage_start = time.time()
+    instance_operations.sync_instances_batch([site['sid'] for site in sites], [])
+    timings['final_sync'] = time.time() - stage_start
+
+    for site in sites:
+        # Timings are for the whole batch.
+        patch_payload = {'status': site['status'],
+                         'db_key': site['db_key'],
+                         'statistics': site['statistics'],
+                         'install': None,
+                         'provision_timings': timings}
+        patch = utilities.patch_eve('sites', site['_id'], patch_payload)
+        log.debug('Site provision | Batch - %s | Patch | %s', batch_id, patch)
+
+    provision_time = sum(timings.values())
+    log.info('Atlas operational statistic | Site Provision Batch | %s | %s sites | %s',
+             provision_time, len(sites), timings)
+    if failed:
+        log.error('Site provision | Batch - %s | Failed - %s', batch_id, failed)
+
+    slack_text = 'Site provision - Batch - {0} instances'.format(len(sites))
+    slack_payload = {
+        "text": slack_text,
+        "attachments": [
+            {
+                "fallback": slack_text,
+                "color": 'danger' if failed else 'good',
+                "fields": [
+                    {"title": "Environment", "value": ENVIRONMENT, "short": True},
+                    {"title": "Instances", "value": len(sites), "short": True},
+                    {"title": "Failed", "value": ', '.join(failed), "short": False},
+                    {"title": "Time", "value": str(provision_time) + ' sec', "short": True},
+                    {"title": "Stages", "value": ', '.join(
+                        '{0} - {1:.1f} sec'.format(stage, timings[stage]) for stage in
+                        ['database', 'instance_create', 'sync', 'install', 'final_sync']),
+                     "short": False}
+                ],
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+
+
 @celery.task
 def site_update(site, updates, original):
     """
@@ -500,24 +834,30 @@ def site_update(site, updates, original):
     deploy_update_database = False
     deploy_drupal_cache_clear = False
     sync_instances = False
+    # WEB_ROOT paths that changed, only these are synced. None syncs all of WEB_ROOT.
+    web_root_paths = []
 
     if updates.get('code'):
         log.debug('Site update | ID - %s | Found code changes', site['_id'])
-        # If we are updating code, we will need to sync instances
-        sync_instances = True
         code_to_update = []
         if 'core' in updates['code']:
             log.debug('Site update | ID - %s | Found core change', site['_id'])
+            # If we are updating code, we will need to sync instances
+            sync_instances = True
             instance_operations.switch_core(site)
             code_to_update.append(str(updates['code']['core']))
         if 'profile' in updates['code']:
             log.debug('Site update | ID - %s | Found profile change | Profile - %s', site['_id'],
                       str(updates['code']['profile']))
+            sync_instances = True
             instance_operations.switch_profile(site)
             code_to_update.append(str(updates['code']['profile']))
         if 'package' in updates['code']:
             log.debug('Site update | ID - %s | Found package changes', site['_id'])
-            instance_operations.switch_packages(site)
+            package_changes = instance_operations.switch_packages(site)
+            # Only sync if links were actually added or removed.
+            if package_changes['added'] or package_changes['removed']:
+                sync_instances = True
             # Get a single string of all packages.
             for code in updates['code']['package']:
                 code_to_update.append(str(code))
@@ -541,9 +881,12 @@ def site_update(site, updates, original):
         # Email notification if we updated packages.
         if 'package' in updates['code']:
             package_name_string = ""
+            packages = utilities.get_code_items(site['code']['package']) if site['code'][
+                'package'] else {}
             for package in site['code']['package']:
                 # Append the package name and a space.
-                package_name_string += utilities.get_code_label(package) + ", "
+                package_name_string += '{0}-{1}, '.format(
+                    packages[str(package)]['meta']['name'], packages[str(package)]['meta']['version'])
             # Strip the trailing space off the end.
             package_name_string = package_name_string.rstrip()
             if len(package_name_string) > 0:
@@ -570,14 +913,18 @@ def site_update(site, updates, original):
                 # Set new status on site record for update to settings files.
                 site['status'] = 'installed'
                 instance_operations.switch_settings_files(site)
-                patch_payload = '{"status": "installed"}'
+                if site.get('restore_backup'):
+                    patch_payload = {'status': 'installed', 'restore_backup': None}
+                else:
+                    patch_payload = '{"status": "installed"}'
             elif updates['status'] == 'launching':
                 log.debug('Site update | ID - %s | Status changed to launching', site['_id'])
                 site['status'] = 'launched'
                 instance_operations.switch_settings_files(site)
-                instance_operations.switch_web_root_symlinks(site)
+                web_root_paths += instance_operations.switch_web_root_symlinks(site)
                 if site['path'] == 'homepage':
                     instance_operations.switch_homepage_files()
+                    web_root_paths = None
                 deploy_drupal_cache_clear = True
                 # Set update group and status
                 if site['path'] != 'homepage':
@@ -594,7 +941,7 @@ def site_update(site, updates, original):
                 log.debug('Site update | ID - %s | Status changed to take_down', site['_id'])
                 site['status'] = 'down'
                 instance_operations.switch_settings_files(site)
-                instance_operations.switch_web_root_symlinks(site)
+                web_root_paths += instance_operations.switch_web_root_symlinks(site)
                 patch_payload = '{"status": "down"}'
                 # Soft delete stats when we take down an instance.
                 statistics_query = 'where={{"site":"{0}"}}'.format(site['_id'])
@@ -608,7 +955,7 @@ def site_update(site, updates, original):
                 log.debug('Site update | ID - %s | Status changed to restore', site['_id'])
                 site['status'] = 'installed'
                 instance_operations.switch_settings_files(site)
-                instance_operations.switch_web_root_symlinks(site)
+                web_root_paths += instance_operations.switch_web_root_symlinks(site)
                 statistics_patch_payload = '{{"site": "{0}"}}'.format(site['_id'])
                 statistics_patch = utilities.patch_eve(
                     'statistics', site['statistics'], statistics_patch_payload)
@@ -619,6 +966,12 @@ def site_update(site, updates, original):
             patch = utilities.patch_eve('sites', site['_id'], patch_payload)
             log.debug(patch)
 
+    # Move the web root links when the path changes, the web root index removes the old ones.
+    if updates.get('path') and not updates.get('status') and site['status'] == 'launched':
+        log.debug('Site update | ID - %s | Found path change', site['_id'])
+        sync_instances = True
+        web_root_paths += instance_operations.switch_web_root_symlinks(site)
+
     # Don't update settings files a second time if status is changing to 'locked'.
     if updates.get('settings'):
         log.info('Found settings change | %s', updates)
@@ -630,13 +983,21 @@ def site_update(site, updates, original):
     # We want to run these commands in this specific order.
     log.info('Site Update | Closing operations commands | Sync - %s | Drush rr - %s; updb - %s ; cc - %s', sync_instances, deploy_registry_rebuild, deploy_update_database, deploy_drupal_cache_clear)
     if sync_instances:
-        instance_operations.sync_instances(site['sid'])
+        instance_operations.sync_instances(site['sid'], web_root_paths=web_root_paths)
     if deploy_registry_rebuild:
-        execute(fabric_tasks.registry_rebuild, site=site)
+        with utilities.cli_host() as host:
+            execute(fabric_tasks.registry_rebuild, site=site, hosts=[host])
     if deploy_update_database:
-        execute(fabric_tasks.update_database, site=site)
+        with utilities.cli_host() as host:
+            execute(fabric_tasks.update_database, site=site, hosts=[host])
     if deploy_drupal_cache_clear:
-        execute(fabric_tasks.drush_cache_clear, sid=site['sid'])
+        with utilities.cli_host() as host:
+            execute(fabric_tasks.drush_cache_clear, sid=site['sid'], hosts=[host])
+
+    # The instance is installed and synced, continue the restore that is waiting for it.
+    if updates.get('status') == 'installing' and site.get('restore_backup'):
+        log.info('Site update | ID - %s | Restore backup - %s', site['_id'], site['restore_backup'])
+        backup_restore_load.delay(backup_id=str(site['restore_backup']), new_instance=site)
 
     slack_text = 'Site Update - Success - {0}/sites/{1}'.format(API_URLS[ENVIRONMENT], site['_id'])
     slack_color = 'good'
@@ -724,19 +1085,18 @@ def drush_prepare(drush_id, run=True):
     log.debug('Drush | Prepare | Drush command - %s | Ran query - %s', drush_id, sites)
     if not sites['_meta']['total'] == 0 and run is True:
         batch_id = time.time()
-        batch_count = 1
         batch_log = 'Batch started | ID - {0} | Batch size - {1}'.format(
             batch_id, str(sites['_meta']['total']))
         log.info(batch_log)
-        for site in sites['_items']:
-            batch_string = str(batch_count) + ' of ' + str(sites['_meta']['total'])
-            drush_command_run.delay(
-                site=site,
-                command_list=drush_command['commands'],
-                user=drush_command['modified_by'],
-                batch_id=batch_id,
-                batch_count=batch_string)
-            batch_count += 1
+        # Run the sites in chunks, each chunk in a single SSH session.
+        chunks = [sites['_items'][i:i + DRUSH_BATCH_SIZE]
+                  for i in range(0, len(sites['_items']), DRUSH_BATCH_SIZE)]
+        task_group = chord((drush_command_run_batch.s(
+            sites=chunk,
+            command_list=drush_command['commands'],
+            batch_id=batch_id,
+            chunk='{0} of {1}'.format(count + 1, len(chunks))) for count, chunk in enumerate(chunks)),
+            _drush_batch_report.s(batch_id, drush_command['label'], drush_command['modified_by']))()
         return batch_log
     else:
         return sites
@@ -766,8 +1126,9 @@ def drush_command_run(site, command_list, user=None, batch_id=None, batch_count=
 
     start_time = time.time()
 
-    fabric_task_result = execute(fabric_tasks.command_run_single, site=site,
-                                 command=final_command, warn_only=True)
+    with utilities.cli_host() as host:
+        fabric_task_result = execute(fabric_tasks.command_run_single, site=site,
+                                     command=final_command, warn_only=True, hosts=[host])
 
     command_time = time.time() - start_time
     log.info('Batch ID - %s | Count - %s | Command - %s | Time - %s | Result - %s',
@@ -776,6 +1137,98 @@ def drush_command_run(site, command_list, user=None, batch_id=None, batch_count=
              batch_id, batch_count, site['sid'], command_list, command_time, fabric_task_result)
 
 
+# Leave time to wait for a CLI host and for the SSH session on top of the chunk time limit.
+@celery.task(time_limit=DRUSH_BATCH_TIME_LIMIT + CLI_HOST_WAIT + 300)
+def drush_command_run_batch(sites, command_list, batch_id=None, chunk=None):
+    """
+    Run commands for a chunk of sites in one SSH session with DRUSH_BATCH_PARALLEL at a time.
+
+    :param sites: List of complete site items.
+    :param command_list: List of commands to run.
+    :param batch_id: Identifier for the drush_prepare batch.
+    :param chunk: string Position of this chunk in the batch.
+    :return: List of dicts with 'sid', 'status', 'time', and 'output' for each site.
+    """
+    log.info('Batch ID - %s | Chunk - %s | Sites - %s | Command - %s',
+             batch_id, chunk, len(sites), command_list)
+    commands = []
+    for site in sites:
+        if site['path'] != 'homepage':
+            uri = BASE_URLS[ENVIRONMENT] + '/' + site['path']
+        else:
+            # Homepage
+            uri = BASE_URLS[ENVIRONMENT]
+        commands.append((site['sid'], ' && '.join(
+            [command + ' --uri={0}'.format(uri) for command in command_list])))
+
+    start_time = time.time()
+    missing_output = 'No result returned, the command did not finish within {0} seconds'.format(
+        DRUSH_BATCH_TIME_LIMIT)
+    try:
+        # The chunk takes a slot for each drush process it runs at once.
+        with utilities.cli_host(weight=DRUSH_BATCH_PARALLEL) as host:
+            parallel = min(DRUSH_BATCH_PARALLEL,
+                           utilities.cli_host_limit(host) or DRUSH_BATCH_PARALLEL)
+            fabric_task_result = execute(fabric_tasks.command_run_batch, commands=commands,
+                                         parallel=parallel,
+                                         batch_id='{0}_{1}'.format(batch_id, chunk.split(' ')[0]),
+                                         time_limit=DRUSH_BATCH_TIME_LIMIT, hosts=[host])
+        # execute returns a dict of {host: result} for the single host.
+        results = fabric_task_result.values()[0]
+    except (Exception, SystemExit) as error:
+        # Report the chunk as failed instead of failing the drush_prepare chord.
+        log.error('Batch ID - %s | Chunk - %s | Error - %s', batch_id, chunk, error)
+        missing_output = 'Chunk failed - {0}'.format(error)
+        results = []
+    for result in results:
+        log.info('Batch ID - %s | Chunk - %s | Site - %s | Status - %s | Time - %s',
+                 batch_id, chunk, result['sid'], result['status'], result['time'])
+        log.debug('Batch ID - %s | Site - %s | Output - %s', batch_id, result['sid'],
+                  result['output'])
+    missing = set(site['sid'] for site in sites) - set(result['sid'] for result in results)
+    for sid in missing:
+        results.append({'sid': sid, 'status': None, 'time': None, 'output': missing_output})
+    log.info('Batch ID - %s | Chunk - %s | Time - %s', batch_id, chunk, time.time() - start_time)
+    return results
+
+
+@celery.task
+def _drush_batch_report(results, batch_id, label, user):
+    """
+    Sub task for drush_prepare. Summarize the results of every chunk.
+
+    :param results: List of lists of results from drush_command_run_batch.
+    :param batch_id: Identifier for the drush_prepare batch.
+    :param label: Label of the drush command.
+    :param user: Username that last modified the command.
+    """
+    results = [result for chunk in results for result in chunk]
+    failed = sorted(result['sid'] for result in results if result['status'] != 0)
+    times = [result['time'] for result in results if result['time'] is not None]
+    log.info('Batch ID - %s | Complete | Sites - %s | Failed - %s | Total command time - %s',
+             batch_id, len(results), failed, sum(times))
+
+    slack_fallback = 'Drush - {0} - {1} of {2} failed'.format(label, len(failed), len(results))
+    slack_payload = {
+        "text": 'Drush - {0}'.format(label),
+        "attachments": [
+            {
+                "fallback": slack_fallback,
+                "color": 'danger' if failed else 'good',
+                "author_name": user,
+                "fields": [
+                    {"title": "Environment", "value": ENVIRONMENT, "short": True},
+                    {"title": "Instances", "value": len(results), "short": True},
+                    {"title": "Longest", "value": '{0:.1f} sec'.format(max(times) if times else 0),
+                     "short": True},
+                    {"title": "Failed", "value": ', '.join(failed), "short": False}
+                ],
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+
+
 @celery.task
 def cron(status=None):
     """
@@ -803,9 +1256,139 @@ def cron(status=None):
 
     sites = utilities.get_eve('sites', site_query)
     log.info('Cron | Total instance to run cron on - %s', sites['_meta']['total'])
+    # Spread the runs over the time until the next scheduled cron for this status.
+    period = cron_period(status) * CRON_SPREAD_FRACTION
+    # Dormant sites only run in some rounds.
+    if status in CRON_ADAPTIVE_STATUSES and cron_period(status):
+        intervals = cron_intervals(status)
+        round_number = int(time.time() // cron_period(status))
+    else:
+        intervals = {}
+        round_number = 0
+    skipped = 0
     if not sites['_meta']['total'] == 0:
         for site in sites['_items']:
-            cron_run.delay(site)
+            interval = cron_site_interval(site, intervals)
+            if (round_number + cron_offset(site['sid'], interval)) % interval:
+                skipped += 1
+                continue
+            cron_run.apply_async(args=[site], countdown=cron_offset(site['sid'], period))
+    log.info('Cron | Status - %s | Dispatched - %s | Skipped dormant - %s',
+             status, sites['_meta']['total'] - skipped, skipped)
+
+
+def cron_intervals(status):
+    """
+    Decide how often each site should run cron from its activity. Activity is the most recent of
+    `days_since_last_edit` and `days_since_last_login` in the site's statistics.
+
+    :param status: Site status to get statistics for.
+    :return: dict of site _id to the number of scheduled rounds between runs. Sites without
+    statistics are left out and run every round.
+    """
+    statistics_query = 'where={{"status":"{0}"}}&projection={{"site":1,"days_since_last_edit":1,"days_since_last_login":1}}'.format(status)
+    statistics = utilities.get_eve('statistics', statistics_query)
+    intervals = {}
+    for statistic in statistics['_items']:
+        days = [statistic.get(key) for key in ['days_since_last_edit', 'days_since_last_login']
+                if statistic.get(key) is not None]
+        if not days:
+            continue
+        for max_days, interval in CRON_ADAPTIVE_TIERS:
+            if max_days is None or min(days) <= max_days:
+                intervals[statistic['site']] = interval
+                break
+    return intervals
+
+
+def cron_site_interval(site, intervals):
+    """
+    Number of scheduled rounds between cron runs for a site. Sites that are excluded from the
+    adaptive policy run every round.
+
+    :param site: Site with at least '_id' and 'path'.
+    :param intervals: Result of `cron_intervals`.
+    :return: Rounds between runs.
+    """
+    if site['path'] in CRON_ADAPTIVE_EXCLUDE_PATHS or site.get('cron_adaptive') is False:
+        return 1
+    return intervals.get(site['_id'], 1)
+
+
+@celery.task
+def cron_adaptive_report():
+    """
+    Report how many cron executions per day the adaptive policy saves.
+    """
+    report = {}
+    for status in CRON_ADAPTIVE_STATUSES:
+        period = cron_period(status)
+        if not period:
+            continue
+        site_query = 'where={{"status":"{0}"}}&projection={{"sid":1,"path":1,"cron_adaptive":1}}'.format(
+            status)
+        sites = utilities.get_eve('sites', site_query)
+        intervals = cron_intervals(status)
+        rounds_per_day = 86400 / period
+        tiers = Counter(cron_site_interval(site, intervals) for site in sites['_items'])
+        without_policy = rounds_per_day * sites['_meta']['total']
+        with_policy = sum(rounds_per_day / interval * count for interval, count in tiers.items())
+        report[status] = {
+            'sites': sites['_meta']['total'],
+            'sites_by_interval': dict(tiers),
+            'executions_per_day': with_policy,
+            'saved_per_day': without_policy - with_policy,
+        }
+    log.info('Atlas operational statistic | Cron adaptive report | %s', report)
+
+    fields = [{"title": "Environment", "value": ENVIRONMENT, "short": True}]
+    for status, status_report in report.items():
+        fields.append({
+            "title": status.capitalize(),
+            "value": '{0} sites | {1:.0f} runs per day | {2:.0f} runs saved per day | Sites by rounds between runs - {3}'.format(
+                status_report['sites'], status_report['executions_per_day'],
+                status_report['saved_per_day'], status_report['sites_by_interval']),
+            "short": False})
+    slack_payload = {
+        "text": 'Cron adaptive report',
+        "attachments": [
+            {
+                "fallback": 'Cron adaptive report - {0}'.format(report),
+                "color": 'good',
+                "fields": fields,
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+    return report
+
+
+def cron_period(status):
+    """
+    Find how often cron is scheduled for a status in the Celerybeat schedule.
+
+    :param status: Site status the cron task is scheduled with.
+    :return: Seconds between runs, 0 if cron is not scheduled for the status.
+    """
+    for entry in config_celery.CELERYBEAT_SCHEDULE.values():
+        if entry['task'] == 'atlas.tasks.cron' and entry.get('kwargs', {}).get('status') == status \
+                and isinstance(entry['schedule'], timedelta):
+            return entry['schedule'].total_seconds()
+    return 0
+
+
+def cron_offset(sid, period):
+    """
+    Stable delay for a site's cron within a period, from a hash of its sid. Each site runs at the
+    same point in every period and the sites are spread evenly across it.
+
+    :param sid: Site sid.
+    :param period: Seconds to spread the runs over.
+    :return: Seconds to delay the run.
+    """
+    if not period:
+        return 0
+    return int(sha1(sid).hexdigest(), 16) % int(period)
 
 
 @celery.task
@@ -825,14 +1408,23 @@ def cron_run(site):
         uri = BASE_URLS[ENVIRONMENT]
     log.debug('Site - %s | uri - %s', site['sid'], uri)
     command = 'drush elysia-cron run --uri={1}'.format(WEBSERVER_USER, uri)
+    history = {'site': site['_id'], 'sid': site['sid'], 'status': 'success', 'host': None}
     try:
-        execute(fabric_tasks.command_run_single, site=site, command=command)
+        with utilities.cli_host() as host:
+            history['host'] = host
+            execute(fabric_tasks.command_run_single, site=site, command=command, hosts=[host])
         instance_operations.correct_fs_permissions(site)
-    except CronException as error:
+    except (Exception, SystemExit) as error:
+        # Fabric aborts with SystemExit when a command fails.
+        history.update({'status': 'failed', 'error': str(error),
+                        'duration': time.time() - start_time})
+        utilities.post_eve('cron_history', history)
         log.error('Site - %s | Cron failed | Error - %s', site['sid'], error)
         raise
 
     command_time = time.time() - start_time
+    history['duration'] = command_time
+    utilities.post_eve('cron_history', history)
     log.info('Site - %s | Cron success | Time - %s', site['sid'], command_time)
 
 
@@ -846,12 +1438,87 @@ def available_sites_check():
     actual_site_count = sites['_meta']['total']
     if actual_site_count < DESIRED_SITE_COUNT:
         needed_sites_count = DESIRED_SITE_COUNT - actual_site_count
-        while needed_sites_count > 0:
-            payload = {
-                "status": "pending",
+        # POST all of the sites in one request so that they are provisioned as a batch.
+        payload = [{"status": "pending"} for count in range(needed_sites_count)]
+        if len(payload) == 1:
+            payload = payload[0]
+        utilities.post_eve('sites', payload)
+
+
+@celery.task(time_limit=3600)
+def provision_benchmark():
+    """
+    Time `drush site-install` and loading the database template on the same scratch instance, for
+    the current default core and profile, and report the results to Slack. The template for the
+    pair is rebuilt as part of the run.
+    """
+    core_id = utilities.get_current_code(name=DEFAULT_CORE, code_type='core')
+    profile_id = utilities.get_current_code(name=DEFAULT_PROFILE, code_type='profile')
+    with utilities.resource_slot('template-{0}_{1}'.format(core_id, profile_id), 1,
+                                 CLI_HOST_WAIT):
+        report = _database_template_scratch(core_id, profile_id, load_template=True)
+    log.info('Atlas operational statistic | Provision Benchmark | %s', report)
+
+    fields = [
+        {"title": "Environment", "value": ENVIRONMENT, "short": True},
+        {"title": "Site install", "value": '{0:.1f} sec'.format(report['install']), "short": True},
+        {"title": "Database template", "value": '{0:.1f} sec'.format(report['install_template']),
+         "short": True},
+    ]
+    slack_payload = {
+        "text": 'Provision benchmark',
+        "attachments": [
+            {
+                "fallback": 'Provision benchmark - {0}'.format(report),
+                "color": 'good',
+                "fields": fields,
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+    return report
+
+
+@celery.task(time_limit=7200)
+def backup_benchmark():
+    """
+    Compare the wall time and size of each backup format for the largest instances, by their last
+    backup size, and report the results to Slack.
+    """
+    history = utilities.backup_history()
+    largest = sorted(history, key=lambda site_id: history[site_id]['size'],
+                     reverse=True)[:BACKUP_BENCHMARK_INSTANCES]
+    sites = utilities.get_site_items(largest)
+    backup_formats = ['gzip'] + sorted(utilities.BACKUP_COMPRESSORS)
+    report = {}
+    fields = [{"title": "Environment", "value": ENVIRONMENT, "short": True}]
+    for site_id in largest:
+        if site_id not in sites:
+            continue
+        site = sites[site_id]
+        result = execute(fabric_tasks.backup_benchmark, site=site, backup_formats=backup_formats)
+        report[site['sid']] = result.values()[0]
+        lines = []
+        for backup_format in backup_formats:
+            timing = report[site['sid']][backup_format]
+            lines.append('{0}: {1:.0f} sec, {2:,.0f} MB'.format(
+                backup_format, timing['database_time'] + timing['files_time'],
+                (timing['database_size'] + timing['files_size']) / float(1 << 20)))
+        fields.append({"title": site['path'], "value": ' | '.join(lines), "short": False})
+    log.info('Atlas operational statistic | Backup Benchmark | %s', report)
+
+    slack_payload = {
+        "text": 'Backup benchmark',
+        "attachments": [
+            {
+                "fallback": 'Backup benchmark - {0}'.format(report),
+                "color": 'good',
+                "fields": fields,
             }
-            utilities.post_eve('sites', payload)
-            needed_sites_count -= 1
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+    return report
 
 
 @celery.task
@@ -1011,41 +1678,67 @@ def verify_statistics():
         utilities.post_to_slack_payload(slack_payload)
 
 
-@celery.task(time_limit=1200)
-def backup_instances_all(backup_type='routine'):
-    """Backup all instance EXCEPT for the ones that we know are too large, currently `today` and
-    `cwa`
+def _backup_large_instances(history):
+    """Find the instances that are only backed up weekly: the BACKUPS_LARGE_INSTANCES paths and the
+    instances whose last backup took longer than BACKUP_LARGE_DURATION.
 
-    20 minute time limit
+    Arguments:
+        history {dict} -- Result of utilities.backup_history
 
-    Keyword Arguments:
-        backup_type {str} -- 'routine', 'update', or 'on_demand' (default: {'routine'})
+    Returns:
+        list -- Site '_id's
     """
-    log.info('Backup all instances')
-    # Get the instance IDs for excluded paths
-    exclude_instances = utilities.get_eve(
-        'sites', 'where={{"path":{{"$in":{0}}}}}'.format(json.dumps(BACKUPS_LARGE_INSTANCES)))
-    log.debug('Backup all instances | Exclude instances - %s', exclude_instances['_items'])
-    exclude_ids = []
-    for instance in exclude_instances['_items']:
-        exclude_ids.append(instance['_id'])
-    log.debug('Backup all instances | List of IDs to exclude - %s', exclude_ids)
-    # TODO: Max results
-    statistics_query = 'where={{"status":{{"$in":["installed","launched"]}},"days_since_last_edit":0,"site":{{"$nin":{0}}}}}'.format(
-        json.dumps(exclude_ids))
-    log.debug('Backup all instances | Stats query - %s', statistics_query)
-    statistics = utilities.get_eve(
-        'statistics', statistics_query)
+    instances = utilities.get_eve('sites', 'where={{"path":{{"$in":{0}}}}}'.format(
+        json.dumps(BACKUPS_LARGE_INSTANCES)))
+    log.debug('Backup | Large instances | By path - %s', instances['_items'])
+    instances_ids = [instance['_id'] for instance in instances['_items']]
+    for site_id, backup in history.items():
+        if backup['duration'] > BACKUP_LARGE_DURATION and site_id not in instances_ids:
+            instances_ids.append(site_id)
+    log.debug('Backup | Large instances | List of IDs - %s', instances_ids)
+    return instances_ids
+
+
+def _backup_instances_dispatch(statistics, backup_type, history):
+    """Queue a backup for the site of each statistic.
+
+    The site records are fetched in bulk and the backups are dispatched together as one group,
+    longest first by the last backup duration and size, so that the long backups are not left
+    until the end of the window. Sites without a backup are estimated at the average.
+
+    Arguments:
+        statistics {dict} -- Eve response for a statistics query
+        backup_type {str} -- 'routine', 'update', or 'on_demand'
+        history {dict} -- Result of utilities.backup_history
+
+    Returns:
+        int -- Number of backups queued
+    """
+    site_ids = [statistic['site'] for statistic in statistics['_items']]
+    sites = utilities.get_site_items(site_ids)
     batch_id = time.time()
-    if not statistics['_meta']['total'] == 0:
-        for statistic in statistics['_items']:
-            site = utilities.get_single_eve('sites', statistic['site'])
-            backup_create.delay(site=site, backup_type=backup_type, batch=batch_id)
+    missing = [site_id for site_id in site_ids if site_id not in sites]
+    if missing:
+        log.warning('Backup | Dispatch | Batch - %s | Sites not found - %s', batch_id, missing)
+    if history:
+        average = {
+            'duration': sum(backup['duration'] for backup in history.values()) / len(history),
+            'size': sum(backup['size'] for backup in history.values()) / len(history),
+        }
+    else:
+        average = {'duration': 0, 'size': 0}
+    ordered = sorted(sites.values(), reverse=True, key=lambda site: (
+        history.get(site['_id'], average)['duration'], history.get(site['_id'], average)['size']))
+    log.debug('Backup | Dispatch | Batch - %s | Order - %s', batch_id,
+              [(site['sid'], history.get(site['_id'], average)['duration']) for site in ordered])
+    if ordered:
+        group(backup_create.s(site=site, backup_type=backup_type, batch=batch_id)
+              for site in ordered).apply_async()
     # Report to slack
     log.info('Atlas operational statistic | Batch - %s | Type - %s | Count - %s',
-             batch_id, backup_type, statistics['_meta']['total'])
+             batch_id, backup_type, len(sites))
 
-    slack_fallback = '{0} {1} backups started'.format(statistics['_meta']['total'], backup_type)
+    slack_fallback = '{0} {1} backups started'.format(len(sites), backup_type)
     slack_color = 'good'
     slack_payload = {
         "text": 'Backups started',
@@ -1056,17 +1749,43 @@ def backup_instances_all(backup_type='routine'):
                 "fields": [
                     {"title": "Environment", "value": ENVIRONMENT, "short": True},
                     {"title": "Backup Type", "value": backup_type, "short": True},
-                    {"title": "Count", "value": statistics['_meta']['total'], "short": True}
+                    {"title": "Count", "value": len(sites), "short": True}
                 ],
             }
         ],
     }
     utilities.post_to_slack_payload(slack_payload)
+    return len(sites)
+
+
+@celery.task(time_limit=1200)
+def backup_instances_all(backup_type='routine'):
+    """Backup all instance EXCEPT for the ones that we know are too large, the
+    BACKUPS_LARGE_INSTANCES paths and the instances whose last backup took longer than
+    BACKUP_LARGE_DURATION
+
+    20 minute time limit
+
+    Keyword Arguments:
+        backup_type {str} -- 'routine', 'update', or 'on_demand' (default: {'routine'})
+    """
+    log.info('Backup all instances')
+    history = utilities.backup_history()
+    # Get the instance IDs for the large instances, they are backed up weekly.
+    exclude_ids = _backup_large_instances(history)
+    log.debug('Backup all instances | List of IDs to exclude - %s', exclude_ids)
+    statistics_query = 'where={{"status":{{"$in":["installed","launched"]}},"days_since_last_edit":0,"site":{{"$nin":{0}}}}}'.format(
+        json.dumps(exclude_ids))
+    log.debug('Backup all instances | Stats query - %s', statistics_query)
+    statistics = utilities.get_eve(
+        'statistics', statistics_query)
+    _backup_instances_dispatch(statistics, backup_type, history)
 
 
 @celery.task(time_limit=2100)
 def backup_instances_large(backup_type='routine'):
-    """Backup known large instances, currently `today` and `cwa`
+    """Backup known large instances, the BACKUPS_LARGE_INSTANCES paths and the instances whose last
+    backup took longer than BACKUP_LARGE_DURATION
 
     35 minute time limit
 
@@ -1074,62 +1793,74 @@ def backup_instances_large(backup_type='routine'):
         backup_type {str} -- 'routine', 'update', or 'on_demand' (default: {'routine'})
     """
     log.info('Backup large instances')
-    # Get the instance IDs for include paths
-    instances = utilities.get_eve('sites', 'where={{"path":{{"$in":[{0}]}}}}'.format(
-        json.dumps(BACKUPS_LARGE_INSTANCES)))
-    log.debug('Backup large instances | Include instances - %s', instances['_items'])
-    instances_ids = []
-    for instance in instances_instances['_items']:
-        instances_ids.append(instance['_id'])
+    history = utilities.backup_history()
+    # Get the instance IDs for the large instances.
+    instances_ids = _backup_large_instances(history)
     log.debug('Backup large instances | List of IDs to include - %s', instances_ids)
-    statistics_query = 'where={{"status":{{"$in":["installed","launched"]}},"days_since_last_edit":{{"$lte":7}},"site":{{"$in":[{0}]}}}}'.format(
+    statistics_query = 'where={{"status":{{"$in":["installed","launched"]}},"days_since_last_edit":{{"$lte":7}},"site":{{"$in":{0}}}}}'.format(
         json.dumps(instances_ids))
     log.debug('Backup large instances | Stats query - %s', statistics_query)
     statistics = utilities.get_eve(
         'statistics', statistics_query)
-    batch_id = time.time()
-    if not statistics['_meta']['total'] == 0:
-        for statistic in statistics['_items']:
-            site = utilities.get_single_eve('sites', statistic['site'])
-            backup_create.delay(site=site, backup_type=backup_type, batch=batch_id)
-    # Report to slack
-    log.info('Atlas operational statistic | Batch - %s | Type - %s | Count - %s',
-             batch_id, backup_type, statistics['_meta']['total'])
-
-    slack_fallback = '{0} {1} backups started'.format(statistics['_meta']['total'], backup_type)
-    slack_color = 'good'
-    slack_payload = {
-        "text": 'Backups started',
-        "attachments": [
-            {
-                "fallback": slack_fallback,
-                "color": slack_color,
-                "fields": [
-                    {"title": "Environment", "value": ENVIRONMENT, "short": True},
-                    {"title": "Backup Type", "value": backup_type, "short": True},
-                    {"title": "Count", "value": statistics['_meta']['total'], "short": True}
-                ],
-            }
-        ],
-    }
-    utilities.post_to_slack_payload(slack_payload)
+    _backup_instances_dispatch(statistics, backup_type, history)
 
 
-@celery.task
-def backup_create(site, backup_type, batch=None):
+@celery.task(bind=True, time_limit=3600)
+def backup_create(self, site, backup_type, batch=None):
     log.debug('Backup | Create | Batch - %s | Site - %s', batch, site)
     log.info('Backup | Create | Batch - %s | Site - %s', batch, site['_id'])
-    execute(fabric_tasks.backup_create, site=site, backup_type=backup_type)
+    try:
+        execute(fabric_tasks.backup_create, site=site, backup_type=backup_type)
+    except utilities.ResourceSlotTimeout as error:
+        # Queue the backup again instead of holding the worker while the slots are busy.
+        log.info('Backup | Create | Batch - %s | Site - %s | Retry - %s | %s', batch, site['_id'],
+                 self.request.retries, error)
+        raise self.retry(exc=error, countdown=BACKUP_RETRY_COUNTDOWN, max_retries=BACKUP_RETRIES)
     log.info('Backup | Create | Batch - %s | Site - %s | Backup finished', batch, site['_id'])
 
 
 @celery.task
 def backup_restore(backup_record, original_instance, package_list):
+    """Restore a backup to a new instance. Switches an available instance to 'installing' with the
+    packages from the backup. site_update queues backup_restore_load for the files and database
+    once the instance is installed.
+
+    Arguments:
+        backup_record {dict} -- Backup to restore
+        original_instance {dict} -- Instance the backup was created from
+        package_list {list} -- Package '_id's for the new instance
+    """
     log.info('Backup | Restore | Backup ID - %s', backup_record['_id'])
     log.debug('Backup | Restore | Backup Recorsd - %s | Original instance - %s | Package List - %s',
               backup_record, original_instance, package_list)
-    execute(fabric_tasks.backup_restore, backup_record=backup_record,
-            original_instance=original_instance, package_list=package_list)
+    # Grab available instance and add packages if needed
+    available_instances = utilities.get_eve('sites', 'where={"status":"available"}')
+    log.debug('Backup | Restore | Avaiable Instances - %s', available_instances)
+    new_instance = next(iter(available_instances['_items']), None)
+    if new_instance is None:
+        raise Exception('No available instances.')
+    # TODO: Don't switch if the code is the same
+    payload = {'status': 'installing', 'restore_backup': backup_record['_id']}
+    if package_list:
+        payload['code'] = {'package': package_list}
+    utilities.patch_eve('sites', new_instance['_id'], payload)
+    log.info('Backup | Restore | Backup ID - %s | New instance - %s', backup_record['_id'],
+             new_instance['_id'])
+
+
+@celery.task
+def backup_restore_load(backup_id, new_instance):
+    """Load the files and database from a backup into an instance that site_update has installed
+    for it.
+
+    Arguments:
+        backup_id {str} -- Backup '_id'
+        new_instance {dict} -- Installed instance
+    """
+    backup_record = utilities.get_single_eve('backup', backup_id)
+    log.info('Backup | Restore | Load | Backup ID - %s | Instance - %s', backup_id,
+             new_instance['_id'])
+    execute(fabric_tasks.backup_restore, backup_record=backup_record, new_instance=new_instance)
 
 
 @celery.task
@@ -1201,7 +1932,7 @@ def remove_failed_backups():
     """
     # Get all backups
     time_ago = datetime.utcnow() - timedelta(minutes=90)
-    backup_query = 'where={{"state":"pending","_created":{{"$lte":"{0}"}}}}'.format(
+    backup_query = 'where={{"state":{{"$in":["pending","failed"]}},"_created":{{"$lte":"{0}"}}}}'.format(
         time_ago.strftime("%Y-%m-%d %H:%M:%S GMT"))
     backups = utilities.get_eve('backup', backup_query)
     for item in backups['_items']:
@@ -1340,29 +2071,170 @@ def update_homepage_files():
 
 
 @celery.task
-def instance_heal(instances):
+def instance_heal(instances, rebuild=False):
     """
     Verify instance is correctly deployed.
+
+    :param instances: Eve response with the instances to heal.
+    :param rebuild: If True, delete and recreate every instance instead of repairing differences.
     """
-    log.info('Heal | Instances')
+    log.info('Heal | Instances | Rebuild - %s', rebuild)
     log.debug('Heal | Instances | Item - %s', instances)
     # Setup a chord. Takes a 'group' (list of tasks that should be applied in parallel) and executes
     # another task after the group is complete.
-    # In the second task, using .si creates an immutable signature so the return value of the
-    # previous tasks will be ignored.
-    task_group = chord((_instance_heal.s(instance) for instance in instances['_items']), instance_sync.si())()
+    if rebuild:
+        # In the second task, using .si creates an immutable signature so the return value of the
+        # previous tasks will be ignored.
+        task_group = chord((_instance_heal.s(instance, rebuild=True)
+                            for instance in instances['_items']), instance_sync.si())()
+    else:
+        # The report task receives the list of reports from the heal tasks.
+        task_group = chord((_instance_heal.s(instance) for instance in instances['_items']),
+                           _instance_heal_report.s())()
 
 
 @celery.task
-def _instance_heal(instance):
+def _instance_heal(instance, rebuild=False):
     """
     Sub task for instance_heal. Perform actual heal operations
     """
-    log.info('Heal | Instance | Instance - %s', instance['_id'])
+    log.info('Heal | Instance | Instance - %s | Rebuild - %s', instance['_id'], rebuild)
     log.debug('Heal | Instance | Instance - %s', instance)
-    # We are not removing the DB or user uploaded files during heal.
-    instance_operations.instance_delete(instance, nfs_preserve=True)
-    instance_operations.instance_create(instance, nfs_preserve=True)
+    if rebuild:
+        # We are not removing the DB or user uploaded files during heal.
+        instance_operations.instance_delete(instance, nfs_preserve=True)
+        instance_operations.instance_create(instance, nfs_preserve=True)
+        return {'_id': instance['_id'], 'sid': instance['sid'], 'result': 'created',
+                'differences': [], 'unrepaired': [], 'web_root_paths': []}
+    return instance_operations.instance_heal(instance)
+
+
+@celery.task
+def _instance_heal_report(reports):
+    """
+    Sub task for instance_heal. Report on the heal and sync the instances that changed.
+
+    :param reports: List of reports from `instance_operations.instance_heal`
+    """
+    results = Counter(report['result'] for report in reports)
+    correct = [report['sid'] for report in reports if report['result'] == 'correct']
+    changed = [report['sid'] for report in reports if report['result'] != 'correct']
+    unrepaired = [report['sid'] for report in reports if report['unrepaired']]
+    log.info('Heal | Report | Results - %s', dict(results))
+    log.info('Heal | Report | Already correct - %s', correct)
+    log.info('Heal | Report | Changed - %s', changed)
+    if unrepaired:
+        log.error('Heal | Report | Unrepaired - %s', unrepaired)
+
+    # Update homepage files.
+    instance_operations.switch_homepage_files()
+    # Only sync the instances that we touched.
+    if len(changed) > len(reports) / 2:
+        instance_operations.sync_instances()
+    else:
+        # The homepage files and the web root paths that the heal changed, with the web root index.
+        web_root_paths = set(['robots.txt', '.htaccess'])
+        for report in reports:
+            web_root_paths.update(report['web_root_paths'])
+        if changed:
+            instance_operations.sync_instances_batch(changed, sorted(web_root_paths))
+        else:
+            instance_operations.sync_web_root_paths(sorted(web_root_paths))
+
+    slack_fallback = 'Instance heal - {0} correct, {1} repaired, {2} created, {3} unrepaired'.format(
+        results['correct'], results['repaired'], results['created'], len(unrepaired))
+    slack_payload = {
+        "text": 'Instance heal',
+        "attachments": [
+            {
+                "fallback": slack_fallback,
+                "color": 'danger' if unrepaired else 'good',
+                "fields": [
+                    {"title": "Environment", "value": ENVIRONMENT, "short": True},
+                    {"title": "Already correct", "value": results['correct'], "short": True},
+                    {"title": "Repaired", "value": results['repaired'], "short": True},
+                    {"title": "Created", "value": results['created'], "short": True},
+                    {"title": "Unrepaired", "value": ', '.join(unrepaired), "short": False}
+                ],
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
+    return {'results': dict(results), 'correct': correct, 'changed': changed,
+            'unrepaired': unrepaired}
+
+
+@celery.task
+def instance_audit(instances):
+    """
+    Check the structure on disk for every instance against its record without changing anything.
+    Store the result as an `audit` item.
+
+    :param instances: Eve response with the instances to check.
+    """
+    batch_id = str(time.time())
+    log.info('Audit | Instances | Batch - %s', batch_id)
+    # The report task receives the list of results from the audit tasks.
+    task_group = chord((_instance_audit.s(instance) for instance in instances['_items']),
+                       _instance_audit_report.s(batch_id, instances['_items']))()
+
+
+@celery.task
+def _instance_audit(instance):
+    """
+    Sub task for instance_audit. Compare a single instance with its expected layout.
+    """
+    log.debug('Audit | Instance | Instance - %s', instance['sid'])
+    try:
+        differences = instance_operations.instance_diff(instance)
+    except Exception as error:
+        log.error('Audit | Instance | Instance - %s | Error - %s', instance['sid'], error)
+        differences = [{'issue': 'error', 'path': None, 'actual': str(error)}]
+    return {'site': instance['_id'], 'sid': instance['sid'], 'differences': differences}
+
+
+@celery.task
+def _instance_audit_report(results, batch_id, instances):
+    """
+    Sub task for instance_audit. Find orphaned directories and store the report.
+
+    :param results: List of results from the audit tasks.
+    :param batch_id: Identifier for this audit.
+    :param instances: List of instance records that were checked.
+    """
+    drifted = [result for result in results if result['differences']]
+    payload = {
+        'batch': batch_id,
+        'total': len(results),
+        'correct': [result['sid'] for result in results if not result['differences']],
+        'drifted': drifted,
+        'orphans': instance_operations.find_orphans(instances),
+    }
+    audit = utilities.post_eve('audit', payload)
+    log.info('Audit | Report | Batch - %s | Total - %s | Drifted - %s | Orphans - %s',
+             batch_id, len(results), len(drifted), payload['orphans'])
+
+    slack_fallback = 'Instance audit - {0} of {1} instances drifted'.format(
+        len(drifted), len(results))
+    slack_payload = {
+        "text": 'Instance audit',
+        "attachments": [
+            {
+                "fallback": slack_fallback,
+                "color": 'warning' if drifted else 'good',
+                "fields": [
+                    {"title": "Environment", "value": ENVIRONMENT, "short": True},
+                    {"title": "Drifted", "value": len(drifted), "short": True},
+                    {"title": "Total", "value": len(results), "short": True},
+                    {"title": "Orphans", "value": len(payload['orphans']['instance_root']) +
+                     len(payload['orphans']['web_root']), "short": True},
+                    {"title": "Report", "value": '{0}/audit/{1}'.format(
+                        API_URLS[ENVIRONMENT], audit.get('_id')), "short": False}
+                ],
+            }
+        ],
+    }
+    utilities.post_to_slack_payload(slack_payload)
 
 
 @celery.task
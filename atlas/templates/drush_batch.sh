@@ -0,0 +1,20 @@
+#!/bin/bash
+# Run drush commands for a batch of instances in one session.
+# Reads lines of "<sid> <base64 encoded command>" from stdin and runs up to $1 of them at a time.
+# Prints one line per instance: "<sid>\t<exit status>\t<time in ms>\t<base64 encoded output>".
+
+run_instance() {
+    start=$(date +%s%N)
+    output=$(cd "{{ web_root }}/$1" && echo "$2" | base64 -d | bash 2>&1)
+    status=$?
+    end=$(date +%s%N)
+    result=$(printf '%s\t%s\t%s\t%s' "$1" "$status" "$(( (end - start) / 1000000 ))" "$(printf '%s' "$output" | base64 -w0)")
+    # Results can be longer than an atomic pipe write, so take turns printing them.
+    (
+        flock 9
+        printf '%s\n' "$result"
+    ) 9>>"{{ lock_file }}"
+}
+export -f run_instance
+
+xargs -P "$1" -L 1 bash -c 'run_instance "$0" "$1"'
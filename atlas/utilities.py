@@ -3,12 +3,18 @@ Utility functions.
 """
 import os
 import sys
+import fcntl
+import itertools
 import logging
 import json
 import subprocess
 import stat
 import smtplib
 import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from math import ceil
 from random import choice
 from string import lowercase
@@ -29,13 +35,34 @@ from atlas.config import (ATLAS_LOCATION, ALLOWED_USERS, LDAP_SERVER, LDAP_ORG_U
                           SLACK_USERNAME, SLACK_URL, SEND_NOTIFICATION_EMAILS,
                           SEND_NOTIFICATION_FROM_EMAIL, EMAIL_HOST, EMAIL_PORT, EMAIL_USERNAME,
                           EMAIL_PASSWORD, EMAIL_USERS_EXCLUDE, SAML_AUTH, CODE_ROOT,
-                          INSTANCE_CODE_IGNORE_REGEX)
+                          INSTANCE_CODE_IGNORE_REGEX, DATABASE_TEMPLATE_PATH,
+                          CODE_MIRROR_DIRECTORY, CODE_ARTIFACT_DIRECTORY, SSH_CONTROL_OPTIONS,
+                          CLI_HOST_STRATEGY, CLI_DEFAULT_CONCURRENCY, CLI_SLOT_DIRECTORY,
+                          CLI_HOST_WAIT, CLI_LOAD_INTERVAL, BACKUP_COMPRESSION_THREADS,
+                          BACKUP_HISTORY_DAYS, SSH_STATS_DIRECTORY)
 from atlas.config_servers import (SERVERDEFS, API_URLS)
 from atlas.data_structure import PAGINATION_DEFAULT
 
 # Setup a sub-logger. See tasks.py for longer comment.
 log = logging.getLogger('atlas.utilities')
 
+# Position for round robin CLI host selection in this worker.
+CLI_ROUND_ROBIN = itertools.count()
+# Load samples for the CLI servers in this worker, {host: (time, load)}.
+CLI_LOAD_SAMPLES = {}
+
+# Multi-threaded compressors for the streaming backup formats.
+BACKUP_COMPRESSORS = {
+    'zstd': {'extension': '.zst', 'command': 'zstd -q -T{0}'},
+    'pigz': {'extension': '.gz', 'command': 'pigz -p {0}'},
+}
+
+# Join all regex expressions into a single expression with the pipe seperator and compile it once.
+# We use '?:' since we don't care which expression matches. Multiline modifier: ^ and $ to match the
+# begin/end of each line (not only begin/end of string)
+INSTANCE_CODE_IGNORE_PATTERN = re.compile('(?:%s)' % '|'.join(INSTANCE_CODE_IGNORE_REGEX),
+                                          re.MULTILINE)
+
 
 if ATLAS_LOCATION not in sys.path:
     sys.path.append(ATLAS_LOCATION)
@@ -127,12 +154,102 @@ def decrypt_string(string):
     return decrypted
 
 
+def run_stages(stages):
+    """
+    Run a dependency graph of stages. Each stage runs in its own thread as soon as the stages it
+    depends on have finished; stages that depend on a failed stage are skipped.
+
+    :param stages: List of (name, list of stage names it depends on, function) tuples.
+    :return: dict of stage name to time in seconds.
+    """
+    timings = {}
+    errors = {}
+    finished = dict((name, threading.Event()) for name, dependencies, function in stages)
+
+    def run_stage(name, dependencies, function):
+        try:
+            for dependency in dependencies:
+                finished[dependency].wait()
+            if any(dependency in errors for dependency in dependencies):
+                errors[name] = None
+                return
+            stage_start = time.time()
+            try:
+                function()
+            except Exception as error:
+                log.error('Utilities | Stages | Stage - %s | Error - %s', name, error)
+                errors[name] = error
+            else:
+                timings[name] = time.time() - stage_start
+                log.debug('Utilities | Stages | Stage - %s | Time - %s', name, timings[name])
+        finally:
+            finished[name].set()
+
+    threads = [threading.Thread(target=run_stage, args=stage) for stage in stages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Raise the first error in stage order, skipped stages are recorded as None.
+    for name, dependencies, function in stages:
+        if errors.get(name):
+            raise errors[name]
+    return timings
+
+
+def database_template_path(core_id, profile_id):
+    """
+    Path to the installed database template for a core and profile pair.
+
+    :param core_id: _id of the core code item.
+    :param profile_id: _id of the profile code item.
+    """
+    return '{0}/{1}_{2}.sql'.format(DATABASE_TEMPLATE_PATH, core_id, profile_id)
+
+
+def database_template(site):
+    """
+    Find a database template that can be loaded for a site instead of running `site-install`.
+    Sites with packages are installed normally since the template would not know about them.
+
+    :param site: A single site.
+    :return: Path to the template, or None.
+    """
+    if site['code'].get('package'):
+        return None
+    template_path = database_template_path(site['code']['core'], site['code']['profile'])
+    if os.path.isfile(template_path):
+        return template_path
+    return None
+
+
+def remove_database_templates(code_id):
+    """
+    Remove the database templates that were installed from a core or profile.
+
+    :param code_id: _id of the core or profile code item.
+    """
+    for template in os.listdir(DATABASE_TEMPLATE_PATH) if os.path.isdir(DATABASE_TEMPLATE_PATH) else []:
+        if template.endswith('.sql') and str(code_id) in template[:-4].split('_'):
+            log.info('Database template | Remove | %s', template)
+            os.remove('{0}/{1}'.format(DATABASE_TEMPLATE_PATH, template))
+
+
 def create_database(site_sid, site_db_key):
     """
     Create a database and user for the
     :param site: site object
     """
-    log.info('Create Database | %s', site_sid)
+    create_databases([(site_sid, site_db_key)])
+
+
+def create_databases(databases):
+    """
+    Create databases and users for several instances over a single connection.
+
+    :param databases: List of (sid, db_key) tuples.
+    """
+    log.info('Create Database | %s', [sid for sid, db_key in databases])
     # Start connection
     mariadb_connection = mariadb.connect(
         user=DATABASE_USER,
@@ -143,32 +260,35 @@ def create_database(site_sid, site_db_key):
 
     cursor = mariadb_connection.cursor()
 
-    # Create database
-    try:
-        cursor.execute("CREATE DATABASE IF NOT EXISTS `{0}`;".format(site_sid))
-    except mariadb.Error as error:
-        log.error('Create Database | %s | %s', site_sid, error)
-        raise
-
-    instance_database_password = decrypt_string(site_db_key)
-    # Grant privileges/add user
-    try:
-        if ENVIRONMENT != 'local':
-            cursor.execute("GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'{1}' IDENTIFIED BY '{2}';".format(
-                site_sid,
-                SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern'],
-                instance_database_password))
-        else:
-            cursor.execute("GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'localhost' IDENTIFIED BY '{1}';".format(
-                site_sid, instance_database_password))
-    except mariadb.Error as error:
-        log.error('Grant Privileges | %s | %s', site_sid, error)
-        raise
+    for site_sid, site_db_key in databases:
+        # Create database
+        try:
+            cursor.execute("CREATE DATABASE IF NOT EXISTS `{0}`;".format(site_sid))
+        except mariadb.Error as error:
+            log.error('Create Database | %s | %s', site_sid, error)
+            mariadb_connection.close()
+            raise
+
+        instance_database_password = decrypt_string(site_db_key)
+        # Grant privileges/add user
+        try:
+            if ENVIRONMENT != 'local':
+                cursor.execute("GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'{1}' IDENTIFIED BY '{2}';".format(
+                    site_sid,
+                    SERVERDEFS[ENVIRONMENT]['database_servers']['user_host_pattern'],
+                    instance_database_password))
+            else:
+                cursor.execute("GRANT ALL PRIVILEGES ON {0}.* TO '{0}'@'localhost' IDENTIFIED BY '{1}';".format(
+                    site_sid, instance_database_password))
+        except mariadb.Error as error:
+            log.error('Grant Privileges | %s | %s', site_sid, error)
+            mariadb_connection.close()
+            raise
 
     mariadb_connection.commit()
     mariadb_connection.close()
 
-    log.info('Create Database | %s | Success', site_sid)
+    log.info('Create Database | %s | Success', [sid for sid, db_key in databases])
 
 
 def delete_database(site_sid):
@@ -389,6 +509,14 @@ def code_path(item):
     return code_dir
 
 
+def code_mirror_path(item):
+    """
+    Determine the path for the bare mirror that the versions of a code item's repository share.
+    Mirrors are keyed by git URL since the same name can be used by more than one code type.
+    """
+    return '{0}/{1}/{2}.git'.format(CODE_ROOT, CODE_MIRROR_DIRECTORY, sha1(item['git_url']).hexdigest())
+
+
 def code_type_directory_name(code_type):
     """
     Determine the path for a code item
@@ -410,17 +538,85 @@ def ignore_code_file(file_to_check):
     Returns:
         bool -- TRUE if file should be ignored
     """
-    # Join all regex expressions into a single expression with the pipe seperator.
-    # We use '?:' since we don't care which expression matches.
-    regex = '(?:%s)' % '|'.join(INSTANCE_CODE_IGNORE_REGEX)
-    log.debug('Utilities | Ignore code file | regex - %s', regex)
-    # Multiline modifier: ^ and $ to match the begin/end of each line (not only begin/end of string)
-    search = re.search(regex, file_to_check, re.MULTILINE)
+    search = INSTANCE_CODE_IGNORE_PATTERN.search(file_to_check)
     if not search:
         log.debug('Utilities | Ignore code file | File - %s | result - %s', file_to_check, search)
     return bool(search)
 
 
+def code_manifest_path(item):
+    """
+    Determine the path for the linkable file manifest of a code item. The manifest lives next to
+    the code directory so that it is not part of the git working tree.
+    """
+    return '{0}.manifest.json'.format(code_path(item))
+
+
+def build_code_manifest(item):
+    """Scan a code item on disk and list the entries that can be linked into an instance.
+
+    Arguments:
+        item {dict} -- code item
+
+    Returns:
+        dict -- 'commit_hash', 'files' (top level entries that are not ignored), and 'profiles'
+        (entries in the 'profiles' directory, if there is one).
+    """
+    item_path = code_path(item)
+    files = sorted([f for f in os.listdir(item_path) if not ignore_code_file(f)])
+    profiles = []
+    if 'profiles' in files and os.path.isdir(item_path + '/profiles'):
+        profiles = sorted(os.listdir(item_path + '/profiles'))
+    manifest = {
+        'commit_hash': item['commit_hash'],
+        'files': files,
+        'profiles': profiles,
+    }
+    log.debug('Utilities | Build code manifest | Item - %s | Manifest - %s', item['_id'], manifest)
+    return manifest
+
+
+def get_code_manifest(item):
+    """Read the linkable file manifest for a code item. If the manifest is missing or was written
+    for a different commit, rebuild it from disk and store it.
+
+    Arguments:
+        item {dict} -- code item
+
+    Returns:
+        dict -- manifest, see `build_code_manifest`
+    """
+    manifest_path = code_manifest_path(item)
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('commit_hash') == item['commit_hash']:
+            return manifest
+        log.info('Utilities | Code manifest | Stale manifest | Item - %s', item['_id'])
+    except (IOError, ValueError):
+        log.info('Utilities | Code manifest | No usable manifest | Item - %s', item['_id'])
+    manifest = build_code_manifest(item)
+    write_code_manifest(item, manifest)
+    return manifest
+
+
+def write_code_manifest(item, manifest=None):
+    """Write the linkable file manifest for a code item.
+
+    Arguments:
+        item {dict} -- code item
+
+    Keyword Arguments:
+        manifest {dict} -- manifest to write, built from disk if not provided (default: {None})
+    """
+    if manifest is None:
+        manifest = build_code_manifest(item)
+    with open(code_manifest_path(item), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    log.info('Utilities | Code manifest | Written | Item - %s', item['_id'])
+    return manifest
+
+
 def get_code(name, code_type=''):
     """
     Get the code item(s) for a given name and code_type.
@@ -438,6 +634,39 @@ def get_code(name, code_type=''):
     return code_get
 
 
+def get_code_items(code_ids):
+    """
+    Get several code items with a single request.
+
+    :param code_ids: list of code '_id' strings
+    :return: dict of code items keyed by '_id'
+    """
+    code_ids = [str(code_id) for code_id in code_ids]
+    code_query = 'where={{"_id":{{"$in":{0}}}}}'.format(json.dumps(code_ids))
+    code_items = get_eve('code', code_query)
+    log.debug('Get Code Items | Query - %s | Result | %s', code_query, code_items)
+    return {item['_id']: item for item in code_items['_items']}
+
+
+def get_site_items(site_ids):
+    """
+    Get many site records with one request per PAGINATION_DEFAULT ids, which keeps the query string
+    to a reasonable length.
+
+    :param site_ids: list of site '_id' strings
+    :return: dict of site records keyed by '_id'
+    """
+    site_ids = [str(site_id) for site_id in site_ids]
+    sites = {}
+    for i in range(0, len(site_ids), PAGINATION_DEFAULT):
+        site_query = 'where={{"_id":{{"$in":{0}}}}}'.format(
+            json.dumps(site_ids[i:i + PAGINATION_DEFAULT]))
+        site_items = get_eve('sites', site_query)
+        log.debug('Get Site Items | Query - %s | Result | %s', site_query, site_items)
+        sites.update({item['_id']: item for item in site_items['_items']})
+    return sites
+
+
 def get_code_name_version(code_id):
     """
     Get the name and version for a code item.
@@ -663,7 +892,17 @@ def delete_saml_database():
 
 
 def relative_symlink(source, destination):
-    os.symlink(os.path.relpath(source, os.path.dirname(destination)), destination)
+    os.symlink(relative_symlink_target(source, destination), destination)
+
+
+def relative_symlink_target(source, destination):
+    """Determine the target that `relative_symlink` writes for a link at destination.
+
+    Arguments:
+        source {string} -- path the link should resolve to
+        destination {string} -- path of the link
+    """
+    return os.path.relpath(source, os.path.dirname(destination))
 
 
 def sync(source, hosts, target, exclude=None):
@@ -673,10 +912,16 @@ def sync(source, hosts, target, exclude=None):
         source {string} -- source path
         hosts {list} -- list of hosts to sync to, will be deduped by function
         target {string} -- destination path
-        exclude {string} -- directory to exclude from rsync
+        exclude {string|list} -- rsync pattern or patterns to exclude
+
+    Returns:
+        dict -- 'bytes_scanned' and 'bytes_sent' totals for all hosts
     """
 
     log.info('Utilities | Sync | Source - %s', source)
+    if isinstance(exclude, list):
+        exclude = "' --exclude='".join(exclude)
+    stats = {'bytes_scanned': 0, 'bytes_sent': 0}
     # Use `set` to dedupe the host list, and cast it back into a list
     hosts = list(set(hosts))
     for host in hosts:
@@ -684,11 +929,13 @@ def sync(source, hosts, target, exclude=None):
         # -z compress file data during the transfer
         # trailing slash on src copies the contents, not the parent dir itself.
         # --delete delete extraneous files from dest dirs
+        # --stats print the transfer statistics, the only output without -v
         if exclude:
-            cmd = 'rsync -aqz --exclude={0} {1}/ {2}:{3} --delete'.format(
-                exclude, source, host, target)
+            cmd = 'rsync -az --stats -e "ssh {4}" --exclude=\'{0}\' {1}/ {2}:{3} --delete'.format(
+                exclude, source, host, target, SSH_CONTROL_OPTIONS)
         else:
-            cmd = 'rsync -aqz {0}/ {1}:{2} --delete'.format(source, host, target)
+            cmd = 'rsync -az --stats -e "ssh {3}" {0}/ {1}:{2} --delete'.format(
+                source, host, target, SSH_CONTROL_OPTIONS)
         log.debug('Utilities | Sync | Command - %s | Host - %s', cmd, host)
         try:
             output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
@@ -696,7 +943,453 @@ def sync(source, hosts, target, exclude=None):
             log.error('Utilities | Sync | Failed | Return code - %s | StdErr - %s | Host - %s',
                       e.returncode, e.output, host)
         else:
-            log.info('Utilities | Sync | Success | Host - %s', host)
+            host_stats = rsync_stats(output)
+            log.info('Utilities | Sync | Success | Host - %s | Stats - %s', host, host_stats)
+            for key in stats:
+                stats[key] += host_stats[key]
+    return stats
+
+
+def sync_paths(source, paths, hosts, target, recursive=False, exclude=None):
+    """Sync specific paths below a directory between servers. Paths that no longer exist in the
+    source are removed from the target.
+
+    Arguments:
+        source {string} -- source directory
+        paths {list} -- paths relative to the source directory
+        hosts {list} -- list of hosts to sync to, will be deduped by function
+        target {string} -- destination directory
+        recursive {bool} -- sync the contents of directories in paths, with --delete
+        exclude {string} -- directory to exclude from rsync
+
+    Returns:
+        dict -- 'bytes_scanned' and 'bytes_sent' totals for all hosts
+    """
+    log.info('Utilities | Sync paths | Source - %s | Paths - %s', source, paths)
+    stats = {'bytes_scanned': 0, 'bytes_sent': 0}
+    hosts = list(set(hosts))
+    # --relative keeps the path below the source directory on the destination.
+    # --delete-missing-args removes paths from the destination that are gone from the source.
+    # --files-from=- reads the list of paths from stdin.
+    # -d transfers directories without recursing into them.
+    options = '-azr --delete' if recursive else '-azd'
+    if exclude:
+        options += ' --exclude={0}'.format(exclude)
+    for host in hosts:
+        cmd = 'rsync {0} --stats -e "ssh {4}" --relative --delete-missing-args --files-from=- {1}/ {2}:{3}/'.format(
+            options, source, host, target, SSH_CONTROL_OPTIONS)
+        log.debug('Utilities | Sync paths | Command - %s | Host - %s', cmd, host)
+        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate('\n'.join(paths) + '\n')[0]
+        if process.returncode:
+            log.error('Utilities | Sync paths | Failed | Return code - %s | StdErr - %s | Host - %s',
+                      process.returncode, output, host)
+        else:
+            host_stats = rsync_stats(output)
+            log.info('Utilities | Sync paths | Success | Host - %s | Stats - %s', host, host_stats)
+            for key in stats:
+                stats[key] += host_stats[key]
+    return stats
+
+
+def code_artifact_path(tree_hash):
+    """
+    Determine the path for the code artifact of a git tree.
+    """
+    return '{0}/{1}/{2}.tar.gz'.format(CODE_ROOT, CODE_ARTIFACT_DIRECTORY, tree_hash)
+
+
+def push_artifact(artifact, hosts, destination):
+    """Copy a code artifact to servers in parallel and unpack it into place. Hosts that already
+    have the artifact unpacked at the destination are skipped, the copy is resumed if an earlier
+    one was interrupted, and the digest is verified before unpacking.
+
+    Arguments:
+        artifact {dict} -- 'path' and 'digest' (sha256) of the artifact
+        hosts {list} -- list of hosts to push to, will be deduped by function
+        destination {string} -- directory to unpack the artifact into
+
+    Returns:
+        dict -- {host: 'unchanged', 'unpacked', or 'failed'}
+    """
+    log.info('Utilities | Push artifact | Artifact - %s | Destination - %s',
+             artifact['path'], destination)
+    results = {}
+    marker = destination + '/.artifact'
+    artifact_directory = os.path.dirname(artifact['path'])
+    unpack_commands = ' && '.join([
+        'echo "{0}  {1}" | sha256sum -c --quiet -'.format(artifact['digest'], artifact['path']),
+        'rm -rf {0}.tmp'.format(destination),
+        'mkdir -p {0}.tmp'.format(destination),
+        'tar -xzf {0} -C {1}.tmp'.format(artifact['path'], destination),
+        'echo {0} > {1}.tmp/.artifact'.format(artifact['digest'], destination),
+        # Move the old tree aside instead of deleting it first, so the destination is only missing
+        # between the two renames.
+        'rm -rf {0}.old'.format(destination),
+        '{{ [ ! -e {0} ] || mv {0} {0}.old; }}'.format(destination),
+        'mv {0}.tmp {0}'.format(destination),
+        'rm -rf {0}.old'.format(destination),
+    ])
+
+    def push(host):
+        commands = [
+            # Nothing to do if this artifact is already unpacked.
+            ('check', 'ssh {3} {0} \'test "$(cat {1} 2>/dev/null)" = "{2}"\''.format(
+                host, marker, artifact['digest'], SSH_CONTROL_OPTIONS)),
+            # --partial keeps an interrupted transfer so the next push resumes it.
+            ('copy', 'ssh {3} {0} mkdir -p {1} && rsync -aq --partial -e "ssh {3}" {2} {0}:{1}/'.format(
+                host, artifact_directory, artifact['path'], SSH_CONTROL_OPTIONS)),
+            ('unpack', 'ssh {2} {0} \'{1}\''.format(host, unpack_commands, SSH_CONTROL_OPTIONS)),
+        ]
+        for step, cmd in commands:
+            log.debug('Utilities | Push artifact | Command - %s | Host - %s', cmd, host)
+            try:
+                subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                if step == 'check':
+                    continue
+                log.error('Utilities | Push artifact | Failed | Step - %s | Return code - %s | StdErr - %s | Host - %s',
+                          step, e.returncode, e.output, host)
+                results[host] = 'failed'
+                return
+            if step == 'check':
+                results[host] = 'unchanged'
+                return
+        results[host] = 'unpacked'
+
+    threads = [threading.Thread(target=push, args=(host,)) for host in set(hosts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log.info('Utilities | Push artifact | Artifact - %s | Results - %s', artifact['path'], results)
+    return results
+
+
+def rsync_stats(output):
+    """Read the bytes scanned, copied, and sent from the output of `rsync --stats`.
+
+    Arguments:
+        output {string} -- rsync output
+
+    Returns:
+        dict -- 'bytes_scanned', 'bytes_transferred', and 'bytes_sent'
+    """
+    stats = {}
+    for key, label in [('bytes_scanned', 'Total file size'),
+                       ('bytes_transferred', 'Total transferred file size'),
+                       ('bytes_sent', 'Total bytes sent')]:
+        match = re.search(r'{0}: ([\d,]+)'.format(label), output)
+        stats[key] = int(match.group(1).replace(',', '')) if match else 0
+    return stats
+
+
+def cli_hosts():
+    """List the servers that run CLI work for instances.
+
+    Returns:
+        list -- (host, maximum concurrent jobs) tuples, empty when there are no 'cli_servers'
+    """
+    servers = SERVERDEFS[ENVIRONMENT]
+    limits = servers.get('cli_concurrency', {})
+    return [(host, limits.get(host, CLI_DEFAULT_CONCURRENCY))
+            for host in servers.get('cli_servers', [])]
+
+
+def cli_host_limit(host):
+    """Maximum concurrent jobs for a CLI server.
+
+    Returns:
+        int -- limit, None when there are no 'cli_servers' and CLI work is not limited
+    """
+    return dict(cli_hosts()).get(host)
+
+
+def cli_host_load(host):
+    """Get the 1 minute load average per CPU of a host. Sampled over SSH at most every
+    CLI_LOAD_INTERVAL seconds.
+
+    Returns:
+        float -- load per CPU, infinity if the host could not be sampled
+    """
+    sample = CLI_LOAD_SAMPLES.get(host)
+    if sample and time.time() - sample[0] < CLI_LOAD_INTERVAL:
+        return sample[1]
+    cmd = 'ssh {0} {1} "cat /proc/loadavg; nproc"'.format(SSH_CONTROL_OPTIONS, host)
+    try:
+        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).split('\n')
+        load = float(output[0].split()[0]) / int(output[1])
+    except (subprocess.CalledProcessError, IndexError, ValueError) as error:
+        log.error('Utilities | CLI host | Load | Host - %s | Error - %s', host, error)
+        load = float('inf')
+    CLI_LOAD_SAMPLES[host] = (time.time(), load)
+    log.debug('Utilities | CLI host | Load | Host - %s | Load - %s', host, load)
+    return load
+
+
+def cli_host_slot(host, limit):
+    """Take a free job slot for a host. Slots are lock files, so they are shared by every worker
+    on this server and released if the worker dies.
+
+    Arguments:
+        host {string} -- host name
+        limit {int} -- number of slots for the host
+
+    Returns:
+        file -- open, locked slot file, None if all of the slots are taken
+    """
+    for slot in range(limit):
+        slot_file = open('{0}/{1}.{2}.lock'.format(CLI_SLOT_DIRECTORY, host, slot), 'a')
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            slot_file.close()
+            continue
+        return slot_file
+    return None
+
+
+def cli_host_active(host, limit):
+    """Count the jobs a host is running.
+    """
+    active = 0
+    for slot in range(limit):
+        slot_path = '{0}/{1}.{2}.lock'.format(CLI_SLOT_DIRECTORY, host, slot)
+        if not os.path.exists(slot_path):
+            continue
+        with open(slot_path, 'a') as slot_file:
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                active += 1
+            else:
+                fcntl.flock(slot_file, fcntl.LOCK_UN)
+    return active
+
+
+def slot_directory_create():
+    """Create CLI_SLOT_DIRECTORY if it does not exist.
+    """
+    if not os.path.isdir(CLI_SLOT_DIRECTORY):
+        try:
+            os.makedirs(CLI_SLOT_DIRECTORY)
+        except OSError:
+            # Another worker created it.
+            pass
+
+
+@contextmanager
+def cli_host(weight=1):
+    """Reserve job slots on a CLI server for the duration of the block, waiting up to
+    CLI_HOST_WAIT seconds for them to be free. Pass the host to fabric with `execute(...,
+    hosts=[host])`. Without 'cli_servers' the work runs on the operations server with no limit.
+
+    Keyword Arguments:
+        weight {int} -- number of slots to take, the number of processes the job runs at once.
+            Capped at the host's limit. (default: {1})
+
+    Yields:
+        string -- host name
+    """
+    hosts = cli_hosts()
+    if not hosts:
+        yield SERVERDEFS[ENVIRONMENT]['operations_server'][0]
+        return
+    slot_directory_create()
+    deadline = time.time() + CLI_HOST_WAIT
+    while True:
+        hosts = cli_hosts()
+        if CLI_HOST_STRATEGY == 'round_robin':
+            start = next(CLI_ROUND_ROBIN) % len(hosts)
+            hosts = hosts[start:] + hosts[:start]
+        elif CLI_HOST_STRATEGY == 'least_loaded':
+            # Slots taken break ties, hosts sampled in the same interval can have the same load.
+            hosts.sort(key=lambda host: (cli_host_load(host[0]),
+                                         cli_host_active(*host) / float(host[1])))
+        else:
+            # Least active jobs relative to the host's limit.
+            hosts.sort(key=lambda host: cli_host_active(*host) / float(host[1]))
+        for host, limit in hosts:
+            slot_files = []
+            while len(slot_files) < min(weight, limit):
+                slot_file = cli_host_slot(host, limit)
+                if not slot_file:
+                    break
+                slot_files.append(slot_file)
+            if len(slot_files) == min(weight, limit):
+                log.debug('Utilities | CLI host | Host - %s | Slots - %s', host, len(slot_files))
+                try:
+                    yield host
+                finally:
+                    for slot_file in slot_files:
+                        slot_file.close()
+                return
+            # Not enough free slots on this host, let them go for the other jobs.
+            for slot_file in slot_files:
+                slot_file.close()
+        if time.time() > deadline:
+            raise ResourceSlotTimeout('No CLI server had {0} free slots within {1} seconds'.format(
+                weight, CLI_HOST_WAIT))
+        time.sleep(1)
+
+
+class ResourceSlotTimeout(Exception):
+    """
+    A resource did not have a free slot within the wait.
+    """
+    pass
+
+
+def resource_slot_take(resource, limit, wait):
+    """Take one of `limit` slots for a shared resource. The slot is held until the returned file is
+    closed. Uses the same lock files as the CLI host slots.
+
+    Arguments:
+        resource {string} -- name of the resource
+        limit {int} -- number of slots for the resource
+        wait {int} -- seconds to wait for a free slot
+
+    Returns:
+        file -- open, locked slot file
+
+    Raises:
+        ResourceSlotTimeout -- when no slot was free within the wait
+    """
+    slot_directory_create()
+    deadline = time.time() + wait
+    while True:
+        slot_file = cli_host_slot(resource, limit)
+        if slot_file:
+            log.debug('Utilities | Resource slot | Resource - %s', resource)
+            return slot_file
+        if time.time() > deadline:
+            raise ResourceSlotTimeout('{0} did not have a free slot within {1} seconds'.format(
+                resource, wait))
+        time.sleep(1)
+
+
+@contextmanager
+def resource_slot(resource, limit, wait):
+    """Hold one of `limit` slots for a shared resource, like a database server, for the duration
+    of the block. See `resource_slot_take`.
+    """
+    slot_file = resource_slot_take(resource, limit, wait)
+    try:
+        yield
+    finally:
+        slot_file.close()
+
+
+def ssh_stats_write(stats):
+    """Store the SSH connection counts for this worker process.
+
+    Arguments:
+        stats {dict} -- 'handshakes' and 'reused' counts
+    """
+    if not os.path.isdir(SSH_STATS_DIRECTORY):
+        try:
+            os.makedirs(SSH_STATS_DIRECTORY)
+        except OSError:
+            # Another worker created it.
+            pass
+    stats_path = '{0}/{1}.json'.format(SSH_STATS_DIRECTORY, os.getpid())
+    with open(stats_path + '.tmp', 'w') as stats_file:
+        json.dump(stats, stats_file)
+    os.rename(stats_path + '.tmp', stats_path)
+
+
+def ssh_stats():
+    """Sum the SSH connection counts of every worker process, including ones that have exited.
+
+    Returns:
+        dict -- 'handshakes', 'reused', and 'workers' totals
+    """
+    totals = {'handshakes': 0, 'reused': 0, 'workers': 0}
+    if not os.path.isdir(SSH_STATS_DIRECTORY):
+        return totals
+    for stats_file_name in os.listdir(SSH_STATS_DIRECTORY):
+        if not stats_file_name.endswith('.json'):
+            continue
+        try:
+            with open('{0}/{1}'.format(SSH_STATS_DIRECTORY, stats_file_name)) as stats_file:
+                stats = json.load(stats_file)
+        except (IOError, ValueError):
+            continue
+        totals['handshakes'] += stats.get('handshakes', 0)
+        totals['reused'] += stats.get('reused', 0)
+        totals['workers'] += 1
+    return totals
+
+
+def backup_file_names(sid, date_time_string, backup_format):
+    """Names of the database and files backups for a site.
+
+    Arguments:
+        sid {string} -- sid of the instance
+        date_time_string {string} -- time of the backup, as used in the file names
+        backup_format {string} -- 'gzip' or one of BACKUP_COMPRESSORS
+
+    Returns:
+        tuple -- (database file name, files file name)
+    """
+    pretty_filename = '{0}_{1}'.format(sid, date_time_string)
+    if backup_format == 'gzip':
+        return ('{0}.sql'.format(pretty_filename), '{0}.tar.gz'.format(pretty_filename))
+    extension = BACKUP_COMPRESSORS[backup_format]['extension']
+    return ('{0}.sql{1}'.format(pretty_filename, extension),
+            '{0}.tar{1}'.format(pretty_filename, extension))
+
+
+def backup_compress_command(backup_format):
+    """Command that compresses stdin to stdout for a backup format.
+
+    Returns:
+        string -- command, None for 'gzip' which does not stream
+    """
+    if backup_format == 'gzip':
+        return None
+    return BACKUP_COMPRESSORS[backup_format]['command'].format(BACKUP_COMPRESSION_THREADS)
+
+
+def backup_decompress_command(filename):
+    """Command that writes the uncompressed contents of a backup file to stdout.
+
+    Arguments:
+        filename {string} -- name or path of the backup file
+
+    Returns:
+        string -- command that takes the file as its last argument
+    """
+    if filename.endswith('.zst'):
+        return 'zstd -q -d -c'
+    if filename.endswith('.gz'):
+        return 'gzip -d -c'
+    return 'cat'
+
+
+def backup_history():
+    """Get the duration and size of the most recent complete backup for each site that has one in
+    the last BACKUP_HISTORY_DAYS days.
+
+    Returns:
+        dict -- {'duration': seconds, 'size': bytes} keyed by site '_id'
+    """
+    since = datetime.utcnow() - timedelta(days=BACKUP_HISTORY_DAYS)
+    query = ('where={{"state":"complete","duration":{{"$exists":true}},"_created":{{"$gte":"{0}"}}}}'
+             '&sort=[("_created",1)]'
+             '&projection={{"site":1,"duration":1,"database_size":1,"files_size":1}}').format(
+                 since.strftime("%Y-%m-%d %H:%M:%S GMT"))
+    backups = get_eve('backup', query)
+    history = {}
+    # Sorted oldest first, so the most recent backup for a site is kept.
+    for backup in backups['_items']:
+        history[backup['site']] = {
+            'duration': backup['duration'],
+            'size': backup.get('database_size', 0) + backup.get('files_size', 0)
+        }
+    log.debug('Utilities | Backup history | %s', history)
+    return history
 
 
 def file_accessable_and_writable(file):
@@ -189,3 +189,9 @@ def userSearch():
 def instances_cse():
     instance_list = helpers.instances(cse=True)
     return render_template('instances/cse.html', instanceList=instance_list)
+
+
+@atlas_admin.route('/instances/cron')
+def instances_cron():
+    cronReport = helpers.cronHistoryReport()
+    return render_template('instances/cron.html', cronReport=cronReport, envVars=envVars)
@@ -2,7 +2,7 @@ import re
 
 from operator import itemgetter
 from collections import Counter, OrderedDict
-from flask import request
+from flask import request, current_app
 from eve.methods.get import getitem_internal, get_internal
 
 
@@ -389,3 +389,51 @@ def sitesByOtherNode(nodeType=None):
 
     instanceList = sorted(unsortedList, key=lambda x: x[1])
     return instanceList
+
+
+def percentile(values, percent):
+    """Value at a percentile of a sorted list, using the nearest rank.
+    """
+    if not values:
+        return None
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def cronHistoryReport(limit=25):
+    """Summarize the cron history by instance.
+        Slowest instances by 95th percentile duration
+        Instances with the most failed runs
+        Duration percentiles for all runs
+    """
+    pipeline = [{'$group': {
+        '_id': '$sid',
+        'durations': {'$push': '$duration'},
+        'runs': {'$sum': 1},
+        'failures': {'$sum': {'$cond': [{'$eq': ['$status', 'failed']}, 1, 0]}},
+    }}]
+    instances = []
+    all_durations = []
+    for group in current_app.data.driver.db['cron_history'].aggregate(pipeline):
+        durations = sorted(d for d in group['durations'] if d is not None)
+        all_durations += durations
+        instances.append({
+            'sid': group['_id'],
+            'runs': group['runs'],
+            'failures': group['failures'],
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'max': durations[-1] if durations else None,
+            'total': sum(durations),
+        })
+    all_durations.sort()
+
+    return {
+        'runs': len(all_durations),
+        'percentiles': {'p50': percentile(all_durations, 50),
+                        'p90': percentile(all_durations, 90),
+                        'p95': percentile(all_durations, 95),
+                        'p99': percentile(all_durations, 99)},
+        'slowest': sorted(instances, key=itemgetter('p95'), reverse=True)[:limit],
+        'failing': sorted([i for i in instances if i['failures']],
+                          key=itemgetter('failures'), reverse=True)[:limit],
+    }
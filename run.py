@@ -16,13 +16,13 @@ from eve import Eve
 from eve.auth import requires_auth
 from flask import jsonify, make_response, abort, request
 
-from atlas_admin import atlas_admin
+from atlas_admin import atlas_admin, helpers as admin_helpers
 from atlas import callbacks
 from atlas import commands
 from atlas import tasks
 from atlas import utilities
 from atlas.config import (ATLAS_LOCATION, VERSION_NUMBER, SSL_KEY_FILE, SSL_CRT_FILE, LOG_LOCATION,
-                          ENVIRONMENT, API_URLS)
+                          ENVIRONMENT, API_URLS, CRON_HISTORY_SIZE)
 
 
 if ATLAS_LOCATION not in sys.path:
@@ -40,6 +40,11 @@ SETTINGS_FILE = os.path.join(THIS_DIRECTORY, 'atlas/data_structure.py')
 app = Eve(import_name='atlas', auth=utilities.AtlasBasicAuth, settings=SETTINGS_FILE)
 
 app.register_blueprint(atlas_admin, url_prefix='/admin')
+
+# Cron history is a capped collection so that old runs are dropped without a cleanup task.
+with app.app_context():
+    if 'cron_history' not in app.data.driver.db.collection_names():
+        app.data.driver.db.create_collection('cron_history', capped=True, size=CRON_HISTORY_SIZE)
 # TODO: Remove debug mode.
 app.debug = True
 
@@ -101,8 +106,26 @@ def get_command(machine_name):
             code_items = utilities.get_eve('code')
             tasks.code_heal.delay(code_items)
         elif command == 'heal_instances':
+            # Optional payload in the format `{"rebuild": true}` and/or `{"audit": "<audit _id>"}`
+            payload = json.loads(request.data) if request.data else {}
+            if payload.get('audit'):
+                # Only heal the instances that drifted in the audit.
+                audit = utilities.get_single_eve('audit', payload['audit'])
+                if audit.get('_error'):
+                    abort(409, 'Error: Audit not found.')
+                drifted_ids = [str(item['site']) for item in audit['drifted']]
+                # instance_heal takes an Eve response.
+                instances = {'_items': utilities.get_site_items(drifted_ids).values()}
+            else:
+                instances = utilities.get_eve('sites')
+            tasks.instance_heal.delay(instances, rebuild=payload.get('rebuild', False))
+        elif command == 'audit_instances':
             instances = utilities.get_eve('sites')
-            tasks.instance_heal.delay(instances)
+            tasks.instance_audit.delay(instances)
+        elif command == 'provision_benchmark':
+            tasks.provision_benchmark.delay()
+        elif command == 'backup_benchmark':
+            tasks.backup_benchmark.delay()
         elif command == 'sync_instances':
             tasks.instance_sync.delay()
         elif command == 'correct_file_permissions':
@@ -272,6 +295,27 @@ def sites_statistics():
     return response
 
 
+@app.route('/cron_history/report', methods=['GET'])
+@requires_auth('cron_history')
+def cron_history_report():
+    """
+    Slowest and most often failing instances from the cron history, with duration percentiles.
+    Optional `limit` query parameter for the number of instances in each list.
+    """
+    limit = int(request.args.get('limit', 25))
+    app.logger.debug('Cron history | Report | Limit - %s', limit)
+    return make_response(jsonify(admin_helpers.cronHistoryReport(limit)))
+
+
+@app.route('/ssh/stats', methods=['GET'])
+@requires_auth('sites')
+def ssh_stats():
+    """
+    SSH handshakes and reused connections for fabric tasks, summed over the workers.
+    """
+    return make_response(jsonify(utilities.ssh_stats()))
+
+
 @app.route('/sites/<string:site_id>/file_permissions', methods=['POST'])
 # TODO: Test what happens with 404 for site_id
 @requires_auth('sites')
@@ -0,0 +1,22 @@
+"""
+Import every Atlas module so that syntax errors and names that are missing at import time are
+caught before deploy. Needs `atlas/config_local.py` and `atlas/config_servers.py`, copy them from
+the examples.
+"""
+import importlib
+import unittest
+
+MODULES = ['atlas.config', 'atlas.data_structure', 'atlas.utilities', 'atlas.code_operations',
+           'atlas.instance_operations', 'atlas.backup_operations', 'atlas.fabric_tasks',
+           'atlas.tasks', 'atlas.callbacks', 'atlas.commands']
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import(self):
+        for module in MODULES:
+            importlib.import_module(module)
+
+
+if __name__ == '__main__':
+    unittest.main()
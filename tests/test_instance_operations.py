@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import sha1
+
+import mock
+
+from atlas import instance_operations
+
+SETTINGS = 'settings'
+
+
+class InstanceDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance_root = tempfile.mkdtemp()
+        patcher = mock.patch.object(instance_operations, 'INSTANCE_ROOT', self.instance_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.instance_root)
+        self.instance = {'sid': 'p1abc'}
+        self.sid_path = '{0}/p1abc/p1abc'.format(self.instance_root)
+        self.core_path = '{0}/core'.format(self.instance_root)
+        os.makedirs(self.core_path + '/sites/default')
+        open(self.core_path + '/sites/default/default.settings.php', 'w').close()
+        self.layout = {
+            'directories': [self.sid_path, self.sid_path + '/sites/default'],
+            'links': {self.sid_path + '/index.php': '../../core/index.php',
+                      self.sid_path + '/includes': '../../core/includes'},
+            'files': {self.sid_path + '/sites/default/default.settings.php':
+                      self.core_path + '/sites/default/default.settings.php'},
+            'link_directories': [self.sid_path],
+            'settings_hash': sha1(SETTINGS).hexdigest(),
+        }
+
+    def build(self):
+        os.makedirs(self.sid_path + '/sites/default')
+        for path, target in self.layout['links'].items():
+            os.symlink(target, path)
+        for path, source in self.layout['files'].items():
+            shutil.copyfile(source, path)
+        with open(self.sid_path + '/sites/default/settings.php', 'w') as settings_file:
+            settings_file.write(SETTINGS)
+
+    def issues(self):
+        return sorted((difference['issue'], difference['path']) for difference in
+                      instance_operations.instance_diff(self.instance, self.layout))
+
+    def test_missing_instance(self):
+        self.assertEqual(self.issues(), [('missing_instance', self.sid_path)])
+
+    def test_correct(self):
+        self.build()
+        self.assertEqual(self.issues(), [])
+
+    def test_links(self):
+        self.build()
+        os.remove(self.sid_path + '/index.php')
+        os.remove(self.sid_path + '/includes')
+        os.symlink('../../old/includes', self.sid_path + '/includes')
+        os.symlink('../../core/modules', self.sid_path + '/modules')
+        differences = instance_operations.instance_diff(self.instance, self.layout)
+        self.assertIn({'issue': 'missing_link', 'path': self.sid_path + '/index.php',
+                       'expected': '../../core/index.php'}, differences)
+        self.assertIn({'issue': 'wrong_link', 'path': self.sid_path + '/includes',
+                       'expected': '../../core/includes', 'actual': '../../old/includes'},
+                      differences)
+        self.assertIn({'issue': 'stale_link', 'path': self.sid_path + '/modules',
+                       'actual': '../../core/modules'}, differences)
+        self.assertEqual(len(differences), 3)
+
+    def test_not_a_link(self):
+        self.build()
+        os.remove(self.sid_path + '/index.php')
+        open(self.sid_path + '/index.php', 'w').close()
+        self.assertEqual(self.issues(), [('not_a_link', self.sid_path + '/index.php')])
+
+    def test_directories_files_and_settings(self):
+        self.build()
+        shutil.rmtree(self.sid_path + '/sites')
+        self.assertEqual(self.issues(), [
+            ('missing_directory', self.sid_path + '/sites/default'),
+            ('missing_file', self.sid_path + '/sites/default/default.settings.php'),
+            ('stale_settings', self.sid_path + '/sites/default/settings.php'),
+        ])
+
+    def test_heal_order(self):
+        # Every issue that can be repaired in place has a position, and directories are created
+        # before anything is linked or copied into them.
+        self.build()
+        shutil.rmtree(self.sid_path + '/sites')
+        os.remove(self.sid_path + '/index.php')
+        open(self.sid_path + '/index.php', 'w').close()
+        os.remove(self.sid_path + '/includes')
+        os.symlink('../../old/includes', self.sid_path + '/includes')
+        os.symlink('../../core/modules', self.sid_path + '/modules')
+        self.layout['links'][self.sid_path + '/misc'] = '../../core/misc'
+        issues = set(issue for issue, path in self.issues())
+        self.assertEqual(issues, set(instance_operations.HEAL_ORDER))
+        heal_order = instance_operations.HEAL_ORDER
+        for issue in ['wrong_link', 'missing_link', 'missing_file', 'stale_settings']:
+            self.assertLess(heal_order.index('missing_directory'), heal_order.index(issue))
+        # Stale links are removed before links are written in their place.
+        self.assertLess(heal_order.index('stale_link'), heal_order.index('missing_link'))
+
+
+class WebRootCollisionTest(unittest.TestCase):
+
+    def setUp(self):
+        index_file, self.index_path = tempfile.mkstemp()
+        os.close(index_file)
+        self.addCleanup(os.remove, self.index_path)
+        patcher = mock.patch.object(instance_operations, 'WEB_ROOT_INDEX', self.index_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with open(self.index_path, 'w') as index:
+            json.dump({'p1abc': 'p1abc', 'dept/site': 'p1abc', 'homepage': 'p1home',
+                       'p1home': 'p1home'}, index)
+
+    def test_free(self):
+        self.assertIsNone(instance_operations.web_root_collision('other'))
+        self.assertIsNone(instance_operations.web_root_collision('dept/other'))
+        # Paths that only share a prefix with an owned path do not collide.
+        self.assertIsNone(instance_operations.web_root_collision('dept/site2'))
+
+    def test_exact(self):
+        self.assertEqual(instance_operations.web_root_collision('homepage'), 'p1home')
+
+    def test_base_directory(self):
+        self.assertEqual(instance_operations.web_root_collision('homepage/sub'), 'p1home')
+
+    def test_below(self):
+        self.assertEqual(instance_operations.web_root_collision('dept'), 'p1abc')
+
+    def test_own_paths(self):
+        self.assertIsNone(instance_operations.web_root_collision('dept/site', sid='p1abc'))
+        self.assertIsNone(instance_operations.web_root_collision('dept', sid='p1abc'))
+        self.assertEqual(instance_operations.web_root_collision('homepage', sid='p1abc'), 'p1home')
+
+    def test_no_index(self):
+        os.remove(self.index_path)
+        open(self.index_path, 'w').close()
+        self.assertIsNone(instance_operations.web_root_collision('homepage'))
+
+
+if __name__ == '__main__':
+    unittest.main()
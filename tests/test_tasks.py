@@ -0,0 +1,65 @@
+import unittest
+
+import mock
+
+from atlas import tasks
+
+
+class CronOffsetTest(unittest.TestCase):
+
+    def test_stable(self):
+        self.assertEqual(tasks.cron_offset('p1abc', 3600), tasks.cron_offset('p1abc', 3600))
+
+    def test_within_period(self):
+        for i in range(200):
+            offset = tasks.cron_offset('p1{0}'.format(i), 3600)
+            self.assertTrue(0 <= offset < 3600)
+
+    def test_spread(self):
+        offsets = [tasks.cron_offset('p1{0}'.format(i), 3600) for i in range(1000)]
+        # Each quarter of the period gets roughly a quarter of the sites.
+        for quarter in range(4):
+            count = len([o for o in offsets if quarter * 900 <= o < (quarter + 1) * 900])
+            self.assertTrue(150 < count < 350, count)
+
+    def test_no_period(self):
+        self.assertEqual(tasks.cron_offset('p1abc', 0), 0)
+
+
+class CronIntervalsTest(unittest.TestCase):
+
+    def intervals(self, statistics):
+        with mock.patch.object(tasks, 'CRON_ADAPTIVE_TIERS', [(7, 1), (60, 6), (None, 24)]), \
+                mock.patch.object(tasks.utilities, 'get_eve',
+                                  return_value={'_items': statistics}):
+            return tasks.cron_intervals('launched')
+
+    def test_tiers(self):
+        self.assertEqual(self.intervals([
+            {'site': 'active', 'days_since_last_edit': 2, 'days_since_last_login': 30},
+            {'site': 'edge', 'days_since_last_edit': 7},
+            {'site': 'quiet', 'days_since_last_edit': 30, 'days_since_last_login': 45},
+            {'site': 'dormant', 'days_since_last_edit': 400, 'days_since_last_login': 61},
+        ]), {'active': 1, 'edge': 1, 'quiet': 6, 'dormant': 24})
+
+    def test_without_statistics(self):
+        self.assertEqual(self.intervals([
+            {'site': 'new'},
+            {'site': 'unknown', 'days_since_last_edit': None, 'days_since_last_login': None},
+        ]), {})
+
+    def test_site_interval(self):
+        intervals = {'dormant': 24, 'optout': 24, 'large': 24}
+        with mock.patch.object(tasks, 'CRON_ADAPTIVE_EXCLUDE_PATHS', ['large-path']):
+            self.assertEqual(tasks.cron_site_interval(
+                {'_id': 'dormant', 'path': 'dormant-path'}, intervals), 24)
+            self.assertEqual(tasks.cron_site_interval(
+                {'_id': 'optout', 'path': 'optout-path', 'cron_adaptive': False}, intervals), 1)
+            self.assertEqual(tasks.cron_site_interval(
+                {'_id': 'large', 'path': 'large-path'}, intervals), 1)
+            self.assertEqual(tasks.cron_site_interval(
+                {'_id': 'new', 'path': 'new-path'}, intervals), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
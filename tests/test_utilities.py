@@ -0,0 +1,132 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from atlas import utilities
+from atlas.data_structure import PAGINATION_DEFAULT
+
+
+class RunStagesTest(unittest.TestCase):
+
+    def test_dependencies_finish_first(self):
+        order = []
+        lock = threading.Lock()
+
+        def stage(name, delay=0):
+            def run():
+                time.sleep(delay)
+                with lock:
+                    order.append(name)
+            return run
+
+        timings = utilities.run_stages([
+            ('install', ['clone', 'database'], stage('install')),
+            ('clone', [], stage('clone', 0.05)),
+            ('database', [], stage('database')),
+            ('cache', ['install'], stage('cache')),
+        ])
+        self.assertEqual(set(timings), set(['install', 'clone', 'database', 'cache']))
+        self.assertLess(order.index('clone'), order.index('install'))
+        self.assertLess(order.index('database'), order.index('install'))
+        self.assertEqual(order[-1], 'cache')
+
+    def test_independent_stages_run_in_parallel(self):
+        start = time.time()
+        utilities.run_stages([('a', [], lambda: time.sleep(0.2)),
+                              ('b', [], lambda: time.sleep(0.2))])
+        self.assertLess(time.time() - start, 0.35)
+
+    def test_failure_skips_dependents(self):
+        ran = []
+
+        def fail():
+            raise ValueError('clone failed')
+
+        with self.assertRaises(ValueError):
+            utilities.run_stages([
+                ('clone', [], fail),
+                ('install', ['clone'], lambda: ran.append('install')),
+                ('cache', ['install'], lambda: ran.append('cache')),
+                ('database', [], lambda: ran.append('database')),
+            ])
+        self.assertEqual(ran, ['database'])
+
+    def test_first_error_in_stage_order(self):
+        def fail(error):
+            def run():
+                raise error
+            return run
+
+        with self.assertRaises(KeyError):
+            utilities.run_stages([('a', [], fail(KeyError('a'))),
+                                  ('b', [], fail(ValueError('b')))])
+
+
+class BackupFileNamesTest(unittest.TestCase):
+
+    def test_gzip(self):
+        self.assertEqual(utilities.backup_file_names('p1abc', '2019-01-01-00-00-00', 'gzip'),
+                         ('p1abc_2019-01-01-00-00-00.sql', 'p1abc_2019-01-01-00-00-00.tar.gz'))
+
+    def test_compressors(self):
+        self.assertEqual(utilities.backup_file_names('p1abc', 'now', 'zstd'),
+                         ('p1abc_now.sql.zst', 'p1abc_now.tar.zst'))
+        self.assertEqual(utilities.backup_file_names('p1abc', 'now', 'pigz'),
+                         ('p1abc_now.sql.gz', 'p1abc_now.tar.gz'))
+
+    def test_decompress_round_trip(self):
+        for backup_format in ['gzip', 'zstd', 'pigz']:
+            database, files = utilities.backup_file_names('p1abc', 'now', backup_format)
+            self.assertEqual(utilities.backup_decompress_command(files),
+                             {'zstd': 'zstd -q -d -c'}.get(backup_format, 'gzip -d -c'))
+        # Plain database dumps from the gzip format are not compressed.
+        self.assertEqual(utilities.backup_decompress_command('p1abc_now.sql'), 'cat')
+        self.assertEqual(utilities.backup_decompress_command('/backups/p1abc_now.sql.zst'),
+                         'zstd -q -d -c')
+
+
+class RelativeSymlinkTargetTest(unittest.TestCase):
+
+    def test_sibling(self):
+        self.assertEqual(
+            utilities.relative_symlink_target('/data/code/p1abc/p1abc', '/data/code/p1abc/current'),
+            'p1abc')
+
+    def test_across_trees(self):
+        self.assertEqual(
+            utilities.relative_symlink_target('/data/code/core/drupal-7.67/index.php',
+                                              '/data/code/p1abc/p1abc/index.php'),
+            '../../core/drupal-7.67/index.php')
+
+    def test_web_root_multipart_path(self):
+        self.assertEqual(
+            utilities.relative_symlink_target('/data/code/p1abc/current', '/data/web/dept/site'),
+            '../../code/p1abc/current')
+
+
+class GetSiteItemsTest(unittest.TestCase):
+
+    def test_chunks(self):
+        site_ids = ['id{0}'.format(i) for i in range(PAGINATION_DEFAULT * 2 + 1)]
+
+        def get_eve(resource, query):
+            ids = utilities.json.loads(query[len('where='):])['_id']['$in']
+            return {'_items': [{'_id': site_id} for site_id in ids]}
+
+        with mock.patch.object(utilities, 'get_eve', side_effect=get_eve) as get_eve_mock:
+            sites = utilities.get_site_items(site_ids)
+        self.assertEqual(get_eve_mock.call_count, 3)
+        for call in get_eve_mock.call_args_list:
+            self.assertEqual(call[0][0], 'sites')
+        self.assertEqual(sorted(sites), sorted(site_ids))
+
+    def test_empty(self):
+        with mock.patch.object(utilities, 'get_eve') as get_eve_mock:
+            self.assertEqual(utilities.get_site_items([]), {})
+        self.assertFalse(get_eve_mock.called)
+
+
+if __name__ == '__main__':
+    unittest.main()